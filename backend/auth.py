@@ -1,42 +1,162 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 import os
+import time
+import uuid
 
-from models import TokenData, UserProfile
+from models import Principal, Token, UserProfile
+import indexes
 
 # Configuração de segurança
 SECRET_KEY = os.environ.get("SECRET_KEY", "your-secret-key-for-development")
 ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 dias
+# Tokens de acesso curtos carregam os dados do usuário usados pelas rotas;
+# o token de atualização, guardado no banco, renova o par
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES", 15))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.environ.get("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+# Tokens emitidos antes dos tokens de acesso curtos (só `sub` e `exp`, válidos
+# por 7 dias) continuam aceitos como tokens de acesso, com o usuário lido do
+# banco. Como não são mais emitidos, deixam de existir 7 dias após a
+# atualização; depois disso a opção pode ser desligada com 0.
+ACCEPT_LEGACY_TOKENS = int(os.environ.get("ACCEPT_LEGACY_TOKENS", 1))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Custo do bcrypt; hashes com custo menor são refeitos no próximo login
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+# Processos de hashing e limite de operações aguardando um deles
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", PASSWORD_HASH_WORKERS * 8))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# Tokens de atualização ativos (o `jti` é removido ao usar, renovar ou sair)
+indexes.declare("refresh_tokens", [("jti", 1)], unique=True)
+indexes.declare("refresh_tokens", [("expires_at", 1)], expireAfterSeconds=0)
+
+
+class TokenRevocations:
+    """
+    Revogações conhecidas pelo worker: `jti` de tokens de acesso encerrados
+    por logout (até expirarem) e a versão mínima de token de cada usuário,
+    elevada quando todas as sessões são encerradas (troca de senha, logout
+    geral). Outros workers deixam de aceitar esses tokens quando eles
+    expiram, em até ACCESS_TOKEN_EXPIRE_MINUTES.
+    """
+    def __init__(self):
+        self._revoked: Dict[str, float] = {}
+        self._min_versions: Dict[str, int] = {}
+    
+    def revoke(self, jti: str, expires_at: float):
+        self._revoked[jti] = expires_at
+        # Descartar as revogações de tokens que já expiraram
+        if len(self._revoked) % 256 == 0:
+            now = time.time()
+            self._revoked = {j: exp for j, exp in self._revoked.items() if exp > now}
+    
+    def revoke_versions_below(self, user_id: str, version: int):
+        self._min_versions[user_id] = max(version, self._min_versions.get(user_id, 0))
+    
+    def is_revoked(self, claims: dict) -> bool:
+        if claims.get("jti") in self._revoked:
+            return True
+        return claims.get("ver", 0) < self._min_versions.get(claims["sub"], 0)
+
+
+revocations = TokenRevocations()
+
 # Funções de autenticação
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password, hashed_password):
+    # (senha confere, novo hash se o atual usa parâmetros antigos)
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+
+class PasswordHasher:
+    """
+    Executa o bcrypt em um pool de processos, fora do event loop. O número
+    de operações em andamento é limitado: acima de `max_pending`, login e
+    cadastro falham na hora com 503 em vez de formar uma fila sem fim.
+    """
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+    
+    async def _run(self, function, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, please retry",
+                headers={"Retry-After": "1"},
+            )
+        if self._executor is None:
+            # Criado no primeiro uso, já dentro do processo do worker
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self.pending -= 1
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+    
+    async def verify_and_update(self, password: str, hashed_password: str):
+        return await self._run(verify_and_update_password, password, hashed_password)
+    
+    def stats(self) -> dict:
+        return {"workers": self.workers, "pending": self.pending, "max_pending": self.max_pending, "rejected": self.rejected}
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
+
 async def get_user(db: AsyncIOMotorClient, email: str):
     user = await db.users.find_one({"email": email})
     if user:
         return UserProfile(**user)
 
 async def authenticate_user(db: AsyncIOMotorClient, email: str, password: str):
+    """Devolve o documento do usuário se a senha confere, ou False"""
     user = await db.users.find_one({"email": email})
     if not user:
         return False
-    if not verify_password(password, user["password"]):
+    verified, new_hash = await password_hasher.verify_and_update(password, user["password"])
+    if not verified:
         return False
-    return UserProfile(**user)
+    if new_hash:
+        # Atualizar o hash para o custo atual sem exigir troca de senha
+        await db.users.update_one(
+            {"id": user["id"], "password": user["password"]},
+            {"$set": {"password": new_hash}}
+        )
+    return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -48,7 +168,43 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncIOMotorClient = None):
+def principal_claims(user: dict) -> dict:
+    """Dados do usuário levados no token de acesso"""
+    return {
+        "sub": user["id"],
+        "name": user["name"],
+        "avatar": user.get("avatar"),
+        "is_verified": user.get("is_verified", False),
+        "ver": user.get("token_version", 0)
+    }
+
+async def issue_tokens(db: AsyncIOMotorClient, user: dict) -> Token:
+    """Gera um token de acesso e um token de atualização para o usuário"""
+    access_token = create_access_token({**principal_claims(user), "type": "access", "jti": str(uuid.uuid4())})
+    
+    refresh_jti = str(uuid.uuid4())
+    refresh_expires = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    refresh_token = create_access_token(
+        {"sub": user["id"], "ver": user.get("token_version", 0), "type": "refresh", "jti": refresh_jti},
+        expires_delta=timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    )
+    await db.refresh_tokens.insert_one({
+        "jti": refresh_jti,
+        "user_id": user["id"],
+        "expires_at": refresh_expires
+    })
+    
+    return Token(
+        access_token=access_token,
+        refresh_token=refresh_token,
+        token_type="bearer",
+        user_id=user["id"],
+        name=user["name"],
+        avatar=user.get("avatar")
+    )
+
+def decode_token(token: str, token_type: str) -> dict:
+    """Valida assinatura, expiração e tipo do token; levanta 401 se inválido"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -56,16 +212,72 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncIOMotor
     )
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            raise credentials_exception
-        token_data = TokenData(user_id=user_id)
     except JWTError:
         raise credentials_exception
-    user = await db.users.find_one({"id": token_data.user_id})
-    if user is None:
+    if payload.get("sub") is None:
         raise credentials_exception
-    return UserProfile(**user)
+    legacy = "type" not in payload and token_type == "access" and ACCEPT_LEGACY_TOKENS
+    if payload.get("type") != token_type and not legacy:
+        raise credentials_exception
+    if revocations.is_revoked(payload):
+        raise credentials_exception
+    return payload
+
+async def revoke_all_sessions(db: AsyncIOMotorClient, user_id: str):
+    """Invalida todos os tokens do usuário (troca de senha, logout geral)"""
+    user = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$inc": {"token_version": 1}},
+        projection={"_id": 0, "token_version": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    await db.refresh_tokens.delete_many({"user_id": user_id})
+    if user:
+        revocations.revoke_versions_below(user_id, user["token_version"])
 
-async def get_current_active_user(current_user: UserProfile = Depends(get_current_user)):
-    return current_user
\ No newline at end of file
+async def _legacy_principal(db: AsyncIOMotorClient, payload: dict) -> Principal:
+    # Token antigo, sem claims do usuário nem `jti`
+    user = await db.users.find_one({"id": payload["sub"]}, {"_id": 0, "id": 1, "name": 1, "avatar": 1, "is_verified": 1, "token_version": 1})
+    # Sessões encerradas depois da emissão (troca de senha, logout geral)
+    if user is None or user.get("token_version", 0) > 0:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return Principal(
+        id=user["id"],
+        name=user.get("name", ""),
+        avatar=user.get("avatar"),
+        is_verified=user.get("is_verified", False),
+        expires_at=payload.get("exp")
+    )
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncIOMotorClient = Depends()) -> Principal:
+    # Sem consulta ao banco: os dados vêm das claims do token de acesso
+    payload = decode_token(token, "access")
+    if "type" not in payload:
+        return await _legacy_principal(db, payload)
+    return Principal(
+        id=payload["sub"],
+        name=payload.get("name", ""),
+        avatar=payload.get("avatar"),
+        is_verified=payload.get("is_verified", False),
+        token_version=payload.get("ver", 0),
+        token_id=payload.get("jti"),
+        expires_at=payload.get("exp")
+    )
+
+async def get_current_active_user(current_user: Principal = Depends(get_current_user)):
+    return current_user
+
+async def get_current_profile(current_user: Principal = Depends(get_current_active_user), db: AsyncIOMotorClient = Depends()) -> UserProfile:
+    """Perfil completo do usuário autenticado, carregado só pelas rotas que precisam dele"""
+    user = await db.users.find_one({"id": current_user.id})
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return UserProfile(**user)
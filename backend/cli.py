@@ -0,0 +1,159 @@
+"""
+Tarefas administrativas do backend.
+
+Uso: python cli.py --help
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import typer
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import comments
+import indexes
+import media_blobs
+import reactions
+import suggestions
+import timelines
+import unread_counters
+import user_search
+# Os módulos de rotas registram seus índices ao serem importados
+from routes import auth, users, friends, posts, notifications, media, realtime  # noqa: F401
+
+ROOT_DIR = Path(__file__).parent
+load_dotenv(ROOT_DIR / '.env')
+
+app = typer.Typer(help="Tarefas administrativas do backend")
+
+
+@app.callback()
+def main():
+    """Tarefas administrativas do backend"""
+
+
+def run_with_db(task):
+    """Executa `task(db)` com uma conexão própria ao MongoDB"""
+    async def runner():
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+        try:
+            return await task(client[os.environ['DB_NAME']])
+        finally:
+            client.close()
+
+    return asyncio.run(runner())
+
+
+@app.command("backfill-timelines")
+def backfill_timelines(batch_size: int = typer.Option(200, help="Usuários por lote")):
+    """Reconstrói as timelines materializadas de todos os usuários"""
+    total = run_with_db(lambda db: timelines.backfill_timelines(db, batch_size))
+    typer.echo(f"{total} timelines reconstruídas")
+
+
+@app.command("migrate-comments")
+def migrate_comments(batch_size: int = typer.Option(100, help="Posts por lote")):
+    """Move os comentários embutidos nos posts para a coleção de comentários"""
+    total = run_with_db(lambda db: comments.migrate_embedded_comments(db, batch_size))
+    typer.echo(f"{total} posts migrados")
+
+
+@app.command("migrate-likes")
+def migrate_likes(batch_size: int = typer.Option(100, help="Documentos por lote")):
+    """Move os arrays de curtidas de posts e comentários para a coleção de reações"""
+    async def task(db):
+        post_total = await reactions.migrate_likes(db, "posts", reactions.POST, batch_size)
+        comment_total = await reactions.migrate_likes(db, "comments", reactions.COMMENT, batch_size)
+        return post_total, comment_total
+
+    post_total, comment_total = run_with_db(task)
+    typer.echo(f"{post_total} posts e {comment_total} comentários migrados")
+
+
+@app.command("reconcile-likes")
+def reconcile_likes(
+    since_minutes: int = typer.Option(60, help="Alvos curtidos ou descurtidos nos últimos N minutos"),
+    full: bool = typer.Option(False, "--full", help="Conferir todos os posts e comentários")
+):
+    """Recalcula os contadores de curtidas a partir da coleção de reações"""
+    since = None if full else datetime.utcnow() - timedelta(minutes=since_minutes)
+
+    async def task(db):
+        post_total = await reactions.reconcile_like_counts(db, "posts", reactions.POST, since)
+        comment_total = await reactions.reconcile_like_counts(db, "comments", reactions.COMMENT, since)
+        return post_total, comment_total
+
+    post_total, comment_total = run_with_db(task)
+    typer.echo(f"{post_total} posts e {comment_total} comentários corrigidos")
+
+
+@app.command("refresh-suggestions")
+def refresh_suggestions(
+    full: bool = typer.Option(False, "--full", help="Recalcular todos os usuários com a matriz de adjacência"),
+    top_k: int = typer.Option(suggestions.SUGGESTIONS_TOP_K, help="Candidatos guardados por usuário")
+):
+    """Recalcula as sugestões de amizade (só os usuários marcados, sem --full)"""
+    if full:
+        total = run_with_db(lambda db: suggestions.build_all(db, top_k))
+    else:
+        total = run_with_db(lambda db: suggestions.refresh_stale(db, top_k))
+    typer.echo(f"Sugestões recalculadas para {total} usuários")
+
+
+@app.command("sweep-media")
+def sweep_media(
+    grace_seconds: int = typer.Option(media_blobs.MEDIA_SWEEP_GRACE_SECONDS, help="Tempo mínimo sem referências"),
+    stale_seconds: int = typer.Option(media_blobs.MEDIA_UPLOAD_STALE_SECONDS, help="Tempo para expirar envios abandonados")
+):
+    """Remove do armazenamento as mídias sem referências e mostra a economia da deduplicação"""
+    async def task(db):
+        removed = await media_blobs.sweep(db, grace_seconds, stale_seconds)
+        return removed, await media_blobs.savings(db)
+
+    removed, savings = run_with_db(task)
+    typer.echo(f"{removed} arquivos removidos")
+    for name, value in savings.items():
+        typer.echo(f"  {name}: {value}")
+
+
+@app.command("reconcile-unread")
+def reconcile_unread(
+    since_minutes: int = typer.Option(60, help="Usuários com notificações ou contadores alterados nos últimos N minutos"),
+    full: bool = typer.Option(False, "--full", help="Conferir todos os usuários")
+):
+    """Recalcula os contadores de notificações não lidas a partir das notificações"""
+    since = None if full else datetime.utcnow() - timedelta(minutes=since_minutes)
+    repaired = run_with_db(lambda db: unread_counters.counters.reconcile(db, since))
+    typer.echo(f"{repaired} contadores corrigidos")
+
+
+@app.command("reindex-users")
+def reindex_users(
+    full: bool = typer.Option(False, "--full", help="Regravar todos os usuários, não só os sem índice"),
+    batch_size: int = typer.Option(1000, help="Usuários por lote")
+):
+    """Preenche os campos do índice de busca de usuários"""
+    total = run_with_db(lambda db: user_search.reindex(db, full, batch_size))
+    typer.echo(f"{total} usuários indexados")
+
+
+@app.command("indexes")
+def indexes_command(apply: bool = typer.Option(False, "--apply", help="Criar os índices que faltam")):
+    """Compara os índices declarados com os existentes no banco"""
+    async def task(db):
+        if apply:
+            await indexes.ensure_indexes(db)
+        return await indexes.diff_indexes(db)
+
+    diff = run_with_db(task)
+    for collection, changes in sorted(diff.items()):
+        typer.echo(f"{collection}: {'ok' if not any(changes.values()) else 'divergente'}")
+        for kind in ("missing", "changed", "extra"):
+            for name in changes[kind]:
+                typer.echo(f"  {kind}: {name}")
+
+
+if __name__ == "__main__":
+    app()
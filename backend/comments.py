@@ -0,0 +1,143 @@
+"""
+Comentários em coleção própria (`comments`), fora do documento do post.
+
+O post guarda apenas `comment_count` e uma prévia com os últimos
+`COMMENT_PREVIEW_SIZE` comentários (`latest_comments`); a lista completa é
+paginada por `GET /posts/{id}/comments`.
+
+Posts antigos ainda podem ter o array `comments` embutido até passarem por
+`python cli.py migrate-comments`; as rotas aceitam os dois formatos enquanto
+a migração roda. A migração também converte o array `likes` de cada
+comentário em `reactions` e `like_count`, já que `migrate-likes` pode ter
+rodado antes e não enxerga comentários ainda embutidos.
+"""
+import logging
+import os
+from typing import List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import indexes
+import pagination
+import reactions
+
+logger = logging.getLogger(__name__)
+
+COMMENT_PREVIEW_SIZE = int(os.environ.get("COMMENT_PREVIEW_SIZE", 3))
+
+indexes.declare("comments", [("id", 1)], unique=True)
+indexes.declare("comments", [("post_id", 1), ("created_at", 1), ("id", 1)])
+
+
+def preview_entry(comment: dict) -> dict:
+    """Versão reduzida do comentário guardada na prévia do post"""
+    return {
+        "id": comment["id"],
+        "author_id": comment["author_id"],
+        "content": comment["content"],
+        "created_at": comment["created_at"]
+    }
+
+
+def comment_count(post: dict) -> int:
+    # Soma os comentários ainda embutidos em posts não migrados
+    return post.get("comment_count", 0) + len(post.get("comments", []))
+
+
+def latest_comments(post: dict) -> List[dict]:
+    """Prévia dos últimos comentários, em ordem cronológica"""
+    return _merge(post.get("comments", []), post.get("latest_comments", []))[-COMMENT_PREVIEW_SIZE:]
+
+
+def _merge(embedded: List[dict], stored: List[dict]) -> List[dict]:
+    # Uma migração interrompida pode deixar o mesmo comentário nos dois lugares
+    merged = {comment["id"]: comment for comment in embedded}
+    merged.update((comment["id"], comment) for comment in stored)
+    return sorted(merged.values(), key=lambda c: (c["created_at"], c["id"]))
+
+
+async def recent_comments(db: AsyncIOMotorClient, post: dict) -> List[dict]:
+    """Últimos comentários completos do post, em ordem cronológica"""
+    recent = await db.comments.find(
+        {"post_id": post["id"]}
+    ).sort([("created_at", -1), ("id", -1)]).limit(COMMENT_PREVIEW_SIZE).to_list(COMMENT_PREVIEW_SIZE)
+    return _merge(post.get("comments", []), recent)[-COMMENT_PREVIEW_SIZE:]
+
+
+def merge_embedded(post: dict, page: List[dict], cursor: Optional[str], limit: int) -> List[dict]:
+    """Mescla na página os comentários ainda embutidos em um post não migrado"""
+    embedded = post.get("comments", [])
+    if cursor:
+        created_at, comment_id = pagination.decode_cursor(cursor)
+        embedded = [c for c in embedded if (c["created_at"], c["id"]) > (created_at, comment_id)]
+    return _merge(embedded, page)[:limit]
+
+
+async def refresh_preview(db: AsyncIOMotorClient, post_id: str):
+    """Recalcula a prévia do post a partir da coleção de comentários"""
+    recent = await recent_comments(db, {"id": post_id})
+    await db.posts.update_one(
+        {"id": post_id},
+        {"$set": {"latest_comments": [preview_entry(c) for c in recent]}}
+    )
+
+
+async def migrate_post_comments(db: AsyncIOMotorClient, post: dict) -> bool:
+    """
+    Move os comentários embutidos de um post para a coleção `comments`.
+    Retorna False se o array mudou durante a cópia (o post deve ser tentado de novo).
+    """
+    embedded = post.get("comments", [])
+    for comment in embedded:
+        likes = list(dict.fromkeys(comment.get("likes", [])))
+        for user_id in likes:
+            await reactions.add(db, reactions.COMMENT, comment["id"], user_id)
+        # Copiado uma única vez: numa nova tentativa, o comentário já na coleção
+        # pode ter recebido curtidas pelo contador
+        copied = {key: value for key, value in comment.items() if key != "likes"}
+        await db.comments.update_one(
+            {"id": comment["id"]},
+            {"$setOnInsert": {**copied, "post_id": post["id"], "like_count": comment.get("like_count", 0) + len(likes)}},
+            upsert=True
+        )
+
+    # Comentários copiados por versões anteriores da migração, ainda com o array
+    async for comment in db.comments.find({"post_id": post["id"], "likes": {"$exists": True}}, {"_id": 0, "id": 1, "likes": 1}):
+        await reactions.migrate_target_likes(db, "comments", reactions.COMMENT, comment)
+
+    # Só remove o array se ele não mudou; comentários novos já vão para a
+    # coleção e incrementam `comment_count`, então basta somar os migrados
+    preview = [preview_entry(c) for c in await recent_comments(db, {"id": post["id"]})]
+    result = await db.posts.update_one(
+        {"id": post["id"], "comments": embedded},
+        {
+            "$unset": {"comments": ""},
+            "$inc": {"comment_count": len(embedded)},
+            "$set": {"latest_comments": preview}
+        }
+    )
+    return result.modified_count == 1
+
+
+async def migrate_embedded_comments(db: AsyncIOMotorClient, batch_size: int = 100, max_attempts: int = 5) -> int:
+    """Migra os comentários de todos os posts que ainda os têm embutidos"""
+    migrated = 0
+    cursor = db.posts.find(
+        {"comments": {"$exists": True}},
+        {"_id": 0, "id": 1, "comments": 1}
+    ).batch_size(batch_size)
+
+    async for post in cursor:
+        for _ in range(max_attempts):
+            if await migrate_post_comments(db, post):
+                migrated += 1
+                break
+            post = await db.posts.find_one({"id": post["id"]}, {"_id": 0, "id": 1, "comments": 1})
+            if post is None or "comments" not in post:
+                break
+        else:
+            logger.warning("Post %s alterado durante a migração; tente novamente", post["id"])
+
+        if migrated and migrated % batch_size == 0:
+            logger.info("Posts migrados: %d", migrated)
+    return migrated
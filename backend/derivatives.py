@@ -0,0 +1,157 @@
+"""
+Versões redimensionadas (derivadas) das imagens enviadas.
+
+Depois do upload, o original é lido do armazenamento e convertido em WebP
+nos tamanhos de `VARIANTS` por um pool de processos (Pillow), fora do event
+loop. As URLs das versões são gravadas no documento:
+
+- posts: `media` = [{"url": original, "variants": {tamanho: url}}]
+- usuários: `avatar_variants` e `cover_photo_variants`
+
+Enquanto as versões não ficam prontas (ou se a geração falhar), `pick`
+devolve a URL original.
+
+As versões não têm registro próprio em `media_blobs`: ficam em
+`variant_key(chave, nome)` e são apagadas junto com o original quando a
+varredura remove o registro dele (trocar a imagem libera o original). Por
+isso só são geradas para originais com registro ativo, e descartadas se o
+registro sumir enquanto eram enviadas.
+"""
+import asyncio
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import loaders
+from storage import media_storage
+
+logger = logging.getLogger(__name__)
+
+# Nome da versão -> maior dimensão em pixels
+VARIANTS = {
+    "thumb": 160,
+    "feed": 720,
+    "full": 1600
+}
+VARIANT_QUALITY = int(os.environ.get("MEDIA_VARIANT_QUALITY", 80))
+MEDIA_WORKERS = int(os.environ.get("MEDIA_WORKERS", 2))
+
+
+def variant_key(key: str, name: str) -> str:
+    """Chave da versão `name` do arquivo em `key`"""
+    return f"{key.rsplit('.', 1)[0]}_{name}.webp"
+
+
+async def _is_active(db: AsyncIOMotorClient, key: str) -> bool:
+    # Original registrado e fora do alcance da varredura
+    return await db.media_blobs.find_one({"key": key, "state": "active"}, {"_id": 1}) is not None
+
+
+def render_variants(data: bytes) -> Dict[str, bytes]:
+    """Gera as versões em WebP de uma imagem (executado no pool de processos)"""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+
+        rendered = {}
+        for name, max_size in VARIANTS.items():
+            variant = image.copy()
+            variant.thumbnail((max_size, max_size))
+            output = io.BytesIO()
+            variant.save(output, "WEBP", quality=VARIANT_QUALITY)
+            rendered[name] = output.getvalue()
+        return rendered
+
+
+def pick(url: Optional[str], variants: Optional[Dict[str, str]], size: Optional[str]) -> Optional[str]:
+    """URL da versão pedida, ou a original se ela ainda não existe"""
+    if url and size and variants:
+        return variants.get(size, url)
+    return url
+
+
+def avatar_thumb(user: dict) -> Optional[str]:
+    # Avatar usado nos cartões de usuário (autores, amigos, remetentes)
+    return pick(user.get("avatar"), user.get("avatar_variants"), "thumb")
+
+
+def media_urls(post: dict, size: Optional[str]) -> List[str]:
+    """URLs das imagens do post no tamanho pedido"""
+    variants = {item["url"]: item.get("variants") for item in post.get("media", [])}
+    return [pick(url, variants.get(url), size) for url in post.get("media_urls") or []]
+
+
+class DerivativeProcessor:
+    def __init__(self, workers: int = MEDIA_WORKERS):
+        self.workers = workers
+        self.processed = 0
+        self.failures = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def generate(self, db: AsyncIOMotorClient, url: str) -> Optional[Dict[str, str]]:
+        """Gera e envia as versões da imagem em `url`; None se não for possível"""
+        key = media_storage.key_from_url(url)
+        if key is None or not await _is_active(db, key):
+            return None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        try:
+            data = await media_storage.get(key)
+            rendered = await asyncio.get_running_loop().run_in_executor(self._executor, render_variants, data)
+            urls = await asyncio.gather(*(
+                media_storage.put(variant_key(key, name), io.BytesIO(body), "image/webp")
+                for name, body in rendered.items()
+            ))
+            # A varredura marca o registro antes de apagar os arquivos: se ele
+            # ainda está ativo, as versões enviadas serão apagadas com o original
+            if not await _is_active(db, key):
+                await asyncio.gather(*(media_storage.delete(variant_key(key, name)) for name in rendered))
+                return None
+        except Exception as exc:
+            self.failures += 1
+            logger.warning("Falha ao gerar versões de %s: %s", url, exc)
+            return None
+
+        self.processed += 1
+        return dict(zip(rendered, urls))
+
+    async def process_post(self, db: AsyncIOMotorClient, post_id: str, urls: List[str]):
+        """Gera as versões das imagens de um post e as registra em `media`"""
+        for url, variants in zip(urls, await asyncio.gather(*(self.generate(db, url) for url in urls))):
+            if variants:
+                await db.posts.update_one(
+                    {"id": post_id, "media.url": url},
+                    {"$set": {"media.$.variants": variants}}
+                )
+
+    async def process_user_image(self, db: AsyncIOMotorClient, user_id: str, field: str, url: str):
+        """Gera as versões do avatar ou da capa (`field`) do usuário"""
+        variants = await self.generate(db, url)
+        if variants:
+            # Só registra se a imagem não foi trocada enquanto as versões eram geradas
+            result = await db.users.update_one(
+                {"id": user_id, field: url},
+                {"$set": {f"{field}_variants": variants}}
+            )
+            if result.modified_count and field == "avatar":
+                # O cartão do usuário passa a usar a miniatura
+                await loaders.invalidate_user_card(user_id)
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "processed": self.processed, "failures": self.failures}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+processor = DerivativeProcessor()
@@ -0,0 +1,196 @@
+"""
+Cache em processo do grafo de amizades.
+
+Guarda, para cada usuário consultado, o conjunto de amigos (amizades
+aceitas) em um LRU limitado. `friends_of` e `are_friends` respondem em O(1)
+quando o usuário está no cache; `friends_of_many` carrega vários usuários
+com uma única consulta.
+
+Para contagens de amigos em comum, cada entrada guarda também os amigos como
+array ordenado de ids inteiros (os UUIDs são internados em inteiros pelo
+próprio grafo), e a interseção é feita com `numpy.intersect1d`. A tabela de
+internação acompanha o LRU: quando passa de `FRIEND_GRAPH_MAX_INTERNED` ids,
+é refeita só com os ids das entradas ainda em cache, que são renumeradas.
+
+As rotas que alteram amizades chamam `invalidate` para os dois usuários. Como
+cada worker tem seu próprio cache, as entradas também expiram após
+`FRIEND_GRAPH_TTL_SECONDS`, o que limita o tempo de uma entrada desatualizada
+em outro worker.
+"""
+import os
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorClient
+
+FRIEND_GRAPH_MAX_USERS = int(os.environ.get("FRIEND_GRAPH_MAX_USERS", 50000))
+FRIEND_GRAPH_TTL_SECONDS = float(os.environ.get("FRIEND_GRAPH_TTL_SECONDS", 60))
+FRIEND_GRAPH_MAX_INTERNED = int(os.environ.get("FRIEND_GRAPH_MAX_INTERNED", 1000000))
+
+EDGE_PROJECTION = {"_id": 0, "id": 1, "requester_id": 1, "recipient_id": 1, "updated_at": 1}
+
+
+class FriendGraph:
+    def __init__(self, max_users: int = FRIEND_GRAPH_MAX_USERS, ttl: float = FRIEND_GRAPH_TTL_SECONDS, max_interned: int = FRIEND_GRAPH_MAX_INTERNED):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_interned = max_interned
+        # user_id -> (momento da carga, {friend_id: {"friendship_id", "since"}}, ids inteiros ordenados)
+        self._adjacency: "OrderedDict[str, tuple]" = OrderedDict()
+        # UUID -> id inteiro e o inverso, para os amigos das entradas do cache
+        self._int_ids: Dict[str, int] = {}
+        self._user_ids: List[str] = []
+        self._reintern_at = max_interned
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.reinterns = 0
+
+    def _get(self, user_id: str):
+        entry = self._adjacency.get(user_id)
+        if entry is None:
+            return None
+        loaded_at, friends, _ = entry
+        if time.monotonic() - loaded_at > self.ttl:
+            del self._adjacency[user_id]
+            return None
+        self._adjacency.move_to_end(user_id)
+        return friends
+
+    def _intern(self, user_id: str) -> int:
+        int_id = self._int_ids.get(user_id)
+        if int_id is None:
+            int_id = self._int_ids[user_id] = len(self._user_ids)
+            self._user_ids.append(user_id)
+        return int_id
+
+    def _sorted_ids(self, friends: Iterable[str]) -> np.ndarray:
+        ids = np.fromiter((self._intern(friend_id) for friend_id in friends), dtype=np.int64)
+        ids.sort()
+        return ids
+
+    def _reintern(self):
+        # Renumerar só os ids ainda referenciados; os arrays das entradas são refeitos
+        self._int_ids = {}
+        self._user_ids = []
+        for cached_id, (loaded_at, friends, _) in list(self._adjacency.items()):
+            self._adjacency[cached_id] = (loaded_at, friends, self._sorted_ids(friends))
+        # Cache grande de verdade: não refazer a cada inserção
+        self._reintern_at = max(self.max_interned, 2 * len(self._user_ids))
+        self.reinterns += 1
+
+    def _put(self, user_id: str, friends: Dict[str, dict]):
+        # Só aqui: arrays devolvidos por friend_arrays_of_many continuam válidos até o uso
+        if len(self._user_ids) > self._reintern_at:
+            self._reintern()
+        self._adjacency[user_id] = (time.monotonic(), MappingProxyType(friends), self._sorted_ids(friends))
+        self._adjacency.move_to_end(user_id)
+        while len(self._adjacency) > self.max_users:
+            self._adjacency.popitem(last=False)
+
+    async def friends_of_many(self, db: AsyncIOMotorClient, user_ids: Iterable[str]) -> Dict[str, Mapping[str, dict]]:
+        """
+        Amigos de cada usuário, como mapeamento friend_id -> dados da amizade
+        (`friendship_id`, `since`). Os usuários fora do cache são carregados juntos.
+        """
+        result = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            friends = self._get(user_id)
+            if friends is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = friends
+        self.hits += len(result)
+        self.misses += len(missing)
+
+        if missing:
+            loaded = {user_id: {} for user_id in missing}
+            friendships = await db.friend_requests.find({
+                "$or": [
+                    {"requester_id": {"$in": missing}, "status": "accepted"},
+                    {"recipient_id": {"$in": missing}, "status": "accepted"}
+                ]
+            }, EDGE_PROJECTION).to_list(None)
+
+            for friendship in friendships:
+                edge = {"friendship_id": friendship["id"], "since": friendship.get("updated_at")}
+                requester_id, recipient_id = friendship["requester_id"], friendship["recipient_id"]
+                if requester_id in loaded:
+                    loaded[requester_id][recipient_id] = edge
+                if recipient_id in loaded:
+                    loaded[recipient_id][requester_id] = edge
+
+            for user_id, friends in loaded.items():
+                self._put(user_id, friends)
+                result[user_id] = self._adjacency[user_id][1]
+
+        return result
+
+    async def friends_of(self, db: AsyncIOMotorClient, user_id: str) -> Mapping[str, dict]:
+        return (await self.friends_of_many(db, [user_id]))[user_id]
+
+    async def are_friends(self, db: AsyncIOMotorClient, user_id: str, other_id: str) -> bool:
+        if user_id == other_id:
+            return False
+        # Aproveitar o lado que já estiver no cache
+        other_friends = self._get(other_id)
+        if other_friends is not None and self._get(user_id) is None:
+            self.hits += 1
+            return user_id in other_friends
+        return other_id in await self.friends_of(db, user_id)
+
+    async def friend_arrays_of_many(self, db: AsyncIOMotorClient, user_ids: Iterable[str]) -> Dict[str, np.ndarray]:
+        """Amigos de cada usuário como array ordenado de ids inteiros"""
+        result = {}
+        for user_id, friends in (await self.friends_of_many(db, user_ids)).items():
+            entry = self._adjacency.get(user_id)
+            # A entrada pode ter sido descartada do LRU durante a carga
+            result[user_id] = entry[2] if entry is not None and entry[1] is friends else self._sorted_ids(friends)
+        return result
+
+    async def mutual_counts(self, db: AsyncIOMotorClient, user_id: str, other_ids: Iterable[str]) -> Dict[str, int]:
+        """Número de amigos em comum entre o usuário e cada um dos outros"""
+        other_ids = list(dict.fromkeys(other_ids))
+        arrays = await self.friend_arrays_of_many(db, [user_id, *other_ids])
+        own = arrays[user_id]
+        return {
+            other_id: int(np.intersect1d(own, arrays[other_id], assume_unique=True).size)
+            for other_id in other_ids
+        }
+
+    async def mutual_friends(self, db: AsyncIOMotorClient, user_id: str, other_id: str) -> List[str]:
+        """Ids dos amigos em comum entre dois usuários"""
+        arrays = await self.friend_arrays_of_many(db, [user_id, other_id])
+        common = np.intersect1d(arrays[user_id], arrays[other_id], assume_unique=True)
+        return [self._user_ids[int_id] for int_id in common]
+
+    def invalidate(self, *user_ids: str):
+        for user_id in user_ids:
+            if self._adjacency.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self._adjacency.clear()
+        self._int_ids = {}
+        self._user_ids = []
+        self._reintern_at = self.max_interned
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users_cached": len(self._adjacency),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "invalidations": self.invalidations,
+            "interned": len(self._user_ids),
+            "reinterns": self.reinterns
+        }
+
+
+# Grafo compartilhado pelas rotas do worker
+graph = FriendGraph()
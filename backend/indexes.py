@@ -0,0 +1,115 @@
+"""
+Registro declarativo dos índices do MongoDB.
+
+Cada módulo declara, junto das consultas que os usam, os índices de que
+precisa com `declare(...)`. Na inicialização da aplicação os índices
+declarados são criados em segundo plano (`start_background_reconcile`), e
+`python cli.py indexes` compara os índices declarados com os existentes.
+Se o banco ainda não está acessível na inicialização, a criação é repetida
+com espera crescente até `INDEX_RECONCILE_MAX_DELAY_SECONDS`.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+INDEX_RECONCILE_INITIAL_DELAY_SECONDS = float(os.environ.get("INDEX_RECONCILE_INITIAL_DELAY_SECONDS", 1))
+INDEX_RECONCILE_MAX_DELAY_SECONDS = float(os.environ.get("INDEX_RECONCILE_MAX_DELAY_SECONDS", 60))
+
+# coleção -> nome do índice -> definição
+_registry: Dict[str, Dict[str, IndexModel]] = {}
+_reconcile_task: Optional[asyncio.Task] = None
+
+# Opções que fazem parte da definição de um índice (para o diff)
+_COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def declare(collection: str, keys, **options) -> IndexModel:
+    """Declara um índice usado pelas consultas de um módulo"""
+    model = IndexModel(keys, **options)
+    _registry.setdefault(collection, {})[model.document["name"]] = model
+    return model
+
+
+def declared() -> Dict[str, List[IndexModel]]:
+    return {collection: list(models.values()) for collection, models in _registry.items()}
+
+
+async def ensure_indexes(db: AsyncIOMotorClient) -> Dict[str, List[str]]:
+    """
+    Cria os índices declarados. Falhas em uma coleção (por exemplo, dados
+    duplicados impedindo um índice único) são registradas e não interrompem as
+    demais; erros de conexão (`PyMongoError`) são repassados a quem chamou.
+    """
+    created = {}
+    for collection, models in declared().items():
+        try:
+            created[collection] = await db[collection].create_indexes(models)
+        except OperationFailure as exc:
+            logger.error("Falha ao criar índices em %s: %s", collection, exc)
+    return created
+
+
+def _spec(document: dict) -> dict:
+    # `index_information` devolve as chaves como lista de pares; IndexModel, como SON
+    key = document["key"]
+    return {
+        "key": [tuple(pair) for pair in (key.items() if hasattr(key, "items") else key)],
+        **{option: document[option] for option in _COMPARED_OPTIONS if option in document}
+    }
+
+
+async def diff_indexes(db: AsyncIOMotorClient) -> Dict[str, dict]:
+    """Compara os índices declarados com os existentes em cada coleção"""
+    diff = {}
+    existing_collections = set(await db.list_collection_names())
+    for collection, models in declared().items():
+        actual = {}
+        if collection in existing_collections:
+            actual = {
+                name: _spec(info)
+                for name, info in (await db[collection].index_information()).items()
+                if name != "_id_"
+            }
+        wanted = {model.document["name"]: _spec(model.document) for model in models}
+
+        diff[collection] = {
+            "missing": sorted(name for name in wanted if name not in actual),
+            "extra": sorted(name for name in actual if name not in wanted),
+            "changed": sorted(
+                name for name in wanted
+                if name in actual and wanted[name] != actual[name]
+            )
+        }
+    return diff
+
+
+def start_background_reconcile(db: AsyncIOMotorClient) -> asyncio.Task:
+    """Agenda a criação dos índices sem bloquear a inicialização"""
+    global _reconcile_task
+
+    async def reconcile():
+        delay = INDEX_RECONCILE_INITIAL_DELAY_SECONDS
+        while True:
+            try:
+                created = await ensure_indexes(db)
+            except PyMongoError as exc:
+                # Banco indisponível (ex.: ServerSelectionTimeoutError, AutoReconnect)
+                logger.warning("Falha ao conferir os índices, nova tentativa em %.0fs: %s", delay, exc)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, INDEX_RECONCILE_MAX_DELAY_SECONDS)
+                continue
+            except Exception:
+                logger.exception("Falha inesperada ao conferir os índices")
+                return
+            logger.info("Índices conferidos: %s", {c: len(names) for c, names in created.items()})
+            return
+
+    _reconcile_task = asyncio.get_running_loop().create_task(reconcile())
+    return _reconcile_task
@@ -0,0 +1,239 @@
+"""
+Carregamento de usuários em lote, no estilo DataLoader.
+
+Cada requisição recebe um `UserLoader` próprio. Todas as chamadas a `load`
+feitas antes do próximo ciclo do event loop são agrupadas em uma única
+consulta `$in`, com projeção reduzida, e ids repetidos são resolvidos uma
+única vez durante toda a requisição.
+
+Os documentos carregados são "cartões de usuário": só os campos usados nos
+autores, remetentes e cartões de amigos (`USER_PROJECTION`), sem senha,
+configurações, eventos ou conquistas. Entre requisições eles ficam no cache
+em processo `cards` (LRU com TTL de `USER_CARD_TTL_SECONDS`), e o loader só
+consulta o banco pelos que faltam. Quem altera nome, localização, avatar ou
+verificação chama `invalidate_user_card`, que descarta o cartão em todos os
+workers; o TTL limita o atraso se alguma alteração não passar por ali. Uma
+consulta iniciada antes da invalidação não devolve o cartão antigo ao cache:
+`put` recebe a geração lida antes da consulta e descarta o cartão se o
+usuário foi invalidado depois dela.
+
+`UserLoaderStatsMiddleware` expõe as estatísticas do loader da requisição no
+cabeçalho `X-User-Loader-Stats`.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Depends, Request
+from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.datastructures import MutableHeaders
+
+import realtime
+
+USER_CARD_TTL_SECONDS = float(os.environ.get("USER_CARD_TTL_SECONDS", 60))
+USER_CARD_MAX_USERS = int(os.environ.get("USER_CARD_MAX_USERS", 50000))
+
+# Campos usados para montar autores, remetentes e cartões de amigos
+USER_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "avatar": 1, "avatar_variants.thumb": 1, "is_verified": 1, "location": 1
+}
+
+TOPIC = "user_cards"
+
+
+class UserCardCache:
+    def __init__(self, max_users: int = USER_CARD_MAX_USERS, ttl: float = USER_CARD_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl = ttl
+        # user_id -> (momento da carga, cartão)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # Relógio de invalidações: user_id -> geração da última invalidação
+        self._generation = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        # Maior geração já descartada de `_invalidated` (mesmo limite de tamanho do cache)
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def generation(self) -> int:
+        """Geração atual, lida antes de consultar o banco e passada a `put`"""
+        return self._generation
+
+    def get_many(self, user_ids: Iterable[str]) -> Tuple[Dict[str, dict], List[str]]:
+        """Cartões em cache e a lista dos ids que precisam ser buscados"""
+        found: Dict[str, dict] = {}
+        missing: List[str] = []
+        now = time.monotonic()
+        for user_id in user_ids:
+            entry = self._cache.get(user_id)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._cache.move_to_end(user_id)
+                found[user_id] = entry[1]
+            else:
+                missing.append(user_id)
+        self.hits += len(found)
+        self.misses += len(missing)
+        return found, missing
+
+    def put(self, user: dict, generation: Optional[int] = None):
+        # Cartão lido antes de uma invalidação do usuário: já pode estar desatualizado
+        if generation is not None and (
+            generation < self._forgotten or self._invalidated.get(user["id"], 0) > generation
+        ):
+            self.stale_puts += 1
+            return
+        self._cache[user["id"]] = (time.monotonic(), user)
+        self._cache.move_to_end(user["id"])
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        self._generation += 1
+        self._invalidated[user_id] = self._generation
+        self._invalidated.move_to_end(user_id)
+        while len(self._invalidated) > self.max_users:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+        if self._cache.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "invalidations": self.invalidations,
+            "stale_puts": self.stale_puts
+        }
+
+
+# Cartões compartilhados pelas rotas do worker
+cards = UserCardCache()
+realtime.subscribe(TOPIC, lambda payload: cards.invalidate(payload["user_id"]))
+
+
+async def invalidate_user_card(user_id: str):
+    """Descarta o cartão do usuário em todos os workers (perfil ou avatar alterado)"""
+    cards.invalidate(user_id)
+    await realtime.broadcast(TOPIC, {"user_id": user_id})
+
+
+class UserLoader:
+    def __init__(self, db: AsyncIOMotorClient):
+        self.db = db
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._pending: List[str] = []
+        self._dispatch_scheduled = False
+        # Estatísticas da requisição
+        self.requested = 0
+        self.cache_hits = 0
+        self.queries = 0
+
+    def load(self, user_id: str) -> asyncio.Future:
+        """Agenda a busca de um usuário; resolve para o documento ou None"""
+        self.requested += 1
+        future = self._futures.get(user_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[user_id] = future
+            self._pending.append(user_id)
+            if not self._dispatch_scheduled:
+                self._dispatch_scheduled = True
+                loop.create_task(self._dispatch())
+        return future
+
+    async def load_many(self, user_ids: Iterable[str]) -> Dict[str, Optional[dict]]:
+        """Busca vários usuários de uma vez e retorna um dicionário id -> usuário"""
+        user_ids = list(user_ids)
+        users = await asyncio.gather(*[self.load(user_id) for user_id in user_ids])
+        return dict(zip(user_ids, users))
+
+    async def _dispatch(self):
+        user_ids, self._pending, self._dispatch_scheduled = self._pending, [], False
+        cached, missing = cards.get_many(user_ids)
+        self.cache_hits += len(cached)
+        # Os que já estavam em cache não dependem da consulta
+        for user_id, user in cached.items():
+            future = self._futures[user_id]
+            if not future.done():
+                future.set_result(user)
+        if not missing:
+            return
+
+        generation = cards.generation()
+        try:
+            fetched = await self.db.users.find(
+                {"id": {"$in": missing}}, USER_PROJECTION
+            ).to_list(None)
+            self.queries += 1
+        except Exception as exc:
+            for user_id in missing:
+                future = self._futures.pop(user_id)
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for user in fetched:
+            cards.put(user, generation)
+        users_by_id = {user["id"]: user for user in fetched}
+        for user_id in missing:
+            future = self._futures[user_id]
+            if not future.done():
+                future.set_result(users_by_id.get(user_id))
+
+    def stats(self) -> dict:
+        unique = len(self._futures)
+        return {
+            "requested": self.requested,
+            "unique": unique,
+            # Chamadas repetidas resolvidas pelo mesmo future
+            "deduplicated": self.requested - unique,
+            "cache_hits": self.cache_hits,
+            "queries": self.queries
+        }
+
+
+def get_user_loader(request: Request, db: AsyncIOMotorClient = Depends()) -> UserLoader:
+    """Dependência que devolve o loader da requisição atual"""
+    loader = getattr(request.state, "user_loader", None)
+    if loader is None:
+        loader = UserLoader(db)
+        request.state.user_loader = loader
+    return loader
+
+
+class UserLoaderStatsMiddleware:
+    """
+    Middleware ASGI que acrescenta `X-User-Loader-Stats` à resposta. Só altera
+    a mensagem de início da resposta e repassa o corpo sem intermediá-lo, então
+    streams (SSE) não ficam presos a ele como com `@app.middleware("http")`.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                # `request.state` guarda os atributos em scope["state"]
+                loader = scope.get("state", {}).get("user_loader")
+                if loader is not None:
+                    MutableHeaders(scope=message).append("X-User-Loader-Stats", ";".join(
+                        f"{key}={value}" for key, value in loader.stats().items()
+                    ))
+            await send(message)
+
+        await self.app(scope, receive, send_with_stats)
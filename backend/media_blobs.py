@@ -0,0 +1,275 @@
+"""
+Registro de arquivos de mídia com deduplicação por conteúdo.
+
+Os uploads recebidos pela API são lidos em partes e resumidos com SHA-256
+antes do envio; o arquivo fica na chave `blobs/<hash[:2]>/<hash>.<ext>`. Se
+o hash já está em `media_blobs`, o envio é dispensado e só o contador de
+referências sobe. Uploads diretos (presigned) são registrados pela chave,
+sem hash.
+
+Excluir um post ou trocar avatar/capa chama `release`, que decrementa o
+contador. Arquivos sem referências há mais de `MEDIA_SWEEP_GRACE_SECONDS`
+são removidos do armazenamento (com suas versões redimensionadas) pela
+varredura periódica (`start_background_sweeper`, `python cli.py sweep-media`).
+
+Estados de um registro: `uploading` (envio em andamento), `active` e
+`deleting` (a varredura está removendo o arquivo). Um registro preso em
+`uploading` por mais de `MEDIA_UPLOAD_STALE_SECONDS` (worker encerrado no
+meio do envio) também é removido pela varredura, liberando o hash para a
+deduplicação.
+"""
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+from datetime import datetime, timedelta
+from typing import BinaryIO, Iterable, List, Optional
+
+from fastapi import UploadFile
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import derivatives
+import indexes
+from storage import media_storage, STORAGE_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+MEDIA_SWEEP_INTERVAL_SECONDS = int(os.environ.get("MEDIA_SWEEP_INTERVAL_SECONDS", 60 * 60))
+MEDIA_SWEEP_GRACE_SECONDS = int(os.environ.get("MEDIA_SWEEP_GRACE_SECONDS", 24 * 60 * 60))
+MEDIA_UPLOAD_STALE_SECONDS = int(os.environ.get("MEDIA_UPLOAD_STALE_SECONDS", 60 * 60))
+
+indexes.declare("media_blobs", [("key", 1)], unique=True)
+indexes.declare("media_blobs", [("hash", 1)], unique=True, partialFilterExpression={"hash": {"$type": "string"}})
+indexes.declare("media_blobs", [("ref_count", 1), ("unreferenced_at", 1)])
+indexes.declare("media_blobs", [("state", 1), ("created_at", 1)])
+
+_sweeper_task: Optional[asyncio.Task] = None
+
+
+class DedupStats:
+    def __init__(self):
+        self.uploads = 0
+        self.deduplicated = 0
+        self.bytes_saved = 0
+        self.swept = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "uploads": self.uploads,
+            "deduplicated": self.deduplicated,
+            "bytes_saved": self.bytes_saved,
+            "swept": self.swept
+        }
+
+
+stats = DedupStats()
+
+
+def _digest(body: BinaryIO) -> tuple:
+    # Resumo SHA-256 e tamanho lendo o arquivo em partes; volta ao início depois
+    sha256 = hashlib.sha256()
+    size = 0
+    body.seek(0)
+    for chunk in iter(lambda: body.read(STORAGE_CHUNK_SIZE), b""):
+        sha256.update(chunk)
+        size += len(chunk)
+    body.seek(0)
+    return sha256.hexdigest(), size
+
+
+def blob_key(digest: str, content_type: Optional[str]) -> str:
+    extension = mimetypes.guess_extension(content_type or "") or ""
+    return f"blobs/{digest[:2]}/{digest}{extension}"
+
+
+async def _reference(db: AsyncIOMotorClient, query: dict) -> Optional[dict]:
+    return await db.media_blobs.find_one_and_update(
+        {**query, "state": "active"},
+        {"$inc": {"ref_count": 1, "dedup_hits": 1}, "$unset": {"unreferenced_at": ""}},
+        projection={"_id": 0, "key": 1, "size": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def store_upload(db: AsyncIOMotorClient, file: UploadFile, folder: str, attempts: int = 3) -> str:
+    """
+    Guarda um arquivo recebido e devolve a URL pública. Se o mesmo conteúdo
+    já existe, devolve a URL existente sem enviar os bytes de novo.
+    """
+    digest, size = await asyncio.to_thread(_digest, file.file)
+    stats.uploads += 1
+
+    for _ in range(attempts):
+        existing = await _reference(db, {"hash": digest})
+        if existing:
+            stats.deduplicated += 1
+            stats.bytes_saved += existing["size"]
+            return media_storage.url(existing["key"])
+
+        key = blob_key(digest, file.content_type)
+        try:
+            await db.media_blobs.insert_one({
+                "hash": digest,
+                "key": key,
+                "size": size,
+                "content_type": file.content_type,
+                "ref_count": 1,
+                "dedup_hits": 0,
+                "state": "uploading",
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            # Outro envio do mesmo conteúdo em andamento (ou sendo varrido)
+            await asyncio.sleep(0.2)
+            continue
+
+        try:
+            url = await media_storage.put(key, file.file, file.content_type)
+        except Exception:
+            await db.media_blobs.delete_one({"key": key, "state": "uploading"})
+            raise
+        activated = await db.media_blobs.update_one({"key": key, "state": "uploading"}, {"$set": {"state": "active"}})
+        if activated.matched_count == 1:
+            return url
+        # Envio mais lento que MEDIA_UPLOAD_STALE_SECONDS: a varredura já expirou o registro
+        logger.warning("Registro de %s expirado durante o envio", key)
+        file.file.seek(0)
+        break
+
+    # Não foi possível deduplicar: guardar como arquivo próprio do usuário
+    url = await media_storage.upload(file, folder)
+    await register_keys(db, [media_storage.key_from_url(url)])
+    return url
+
+
+async def store_uploads(db: AsyncIOMotorClient, files: List[UploadFile], folder: str) -> List[str]:
+    """Guarda vários arquivos em paralelo, devolvendo as URLs na mesma ordem"""
+    return list(await asyncio.gather(*(store_upload(db, file, folder) for file in files)))
+
+
+async def register_keys(db: AsyncIOMotorClient, keys: Iterable[str], sizes: Optional[List[int]] = None):
+    """Registra (ou referencia de novo) arquivos enviados direto ao armazenamento"""
+    keys = list(keys)
+    for key, size in zip(keys, sizes or [None] * len(keys)):
+        await db.media_blobs.update_one(
+            {"key": key},
+            {
+                "$inc": {"ref_count": 1},
+                "$unset": {"unreferenced_at": ""},
+                "$setOnInsert": {"size": size, "state": "active", "dedup_hits": 0, "created_at": datetime.utcnow()}
+            },
+            upsert=True
+        )
+
+
+async def release(db: AsyncIOMotorClient, urls: Iterable[Optional[str]]):
+    """Decrementa as referências dos arquivos; os sem referência ficam para a varredura"""
+    for url in urls:
+        key = media_storage.key_from_url(url) if url else None
+        if key is None:
+            continue
+        blob = await db.media_blobs.find_one_and_update(
+            {"key": key, "ref_count": {"$gt": 0}},
+            {"$inc": {"ref_count": -1}},
+            projection={"_id": 0, "ref_count": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if blob and blob["ref_count"] == 0:
+            await db.media_blobs.update_one(
+                {"key": key, "ref_count": 0},
+                {"$set": {"unreferenced_at": datetime.utcnow()}}
+            )
+
+
+async def _remove(db: AsyncIOMotorClient, key: str, previous_state: str) -> bool:
+    # Apagar o arquivo (e versões) de um registro já marcado como `deleting`
+    variant_keys = [derivatives.variant_key(key, name) for name in derivatives.VARIANTS]
+    try:
+        await asyncio.gather(*(media_storage.delete(k) for k in [key, *variant_keys]))
+    except Exception as exc:
+        logger.warning("Falha ao remover %s: %s", key, exc)
+        await db.media_blobs.update_one({"key": key, "state": "deleting"}, {"$set": {"state": previous_state}})
+        return False
+
+    await db.media_blobs.delete_one({"key": key, "state": "deleting"})
+    return True
+
+
+async def sweep(db: AsyncIOMotorClient, grace_seconds: int = MEDIA_SWEEP_GRACE_SECONDS, stale_seconds: int = MEDIA_UPLOAD_STALE_SECONDS) -> int:
+    """
+    Remove do armazenamento os arquivos sem referências há mais de
+    `grace_seconds` e os envios abandonados há mais de `stale_seconds`.
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=grace_seconds)
+    removed = 0
+    async for blob in db.media_blobs.find(
+        {"ref_count": 0, "unreferenced_at": {"$lte": cutoff}, "state": "active"},
+        {"_id": 0, "key": 1}
+    ):
+        # Marcar antes de apagar: uma nova referência neste meio-tempo cancela a remoção
+        claimed = await db.media_blobs.update_one(
+            {"key": blob["key"], "ref_count": 0, "state": "active"},
+            {"$set": {"state": "deleting"}}
+        )
+        if claimed.modified_count == 1 and await _remove(db, blob["key"], "active"):
+            removed += 1
+
+    # Envios que nunca terminaram: a referência do registro não chegou a ninguém
+    stale_cutoff = now - timedelta(seconds=stale_seconds)
+    async for blob in db.media_blobs.find(
+        {"state": "uploading", "created_at": {"$lte": stale_cutoff}},
+        {"_id": 0, "key": 1}
+    ):
+        claimed = await db.media_blobs.update_one(
+            {"key": blob["key"], "state": "uploading", "created_at": {"$lte": stale_cutoff}},
+            {"$set": {"state": "deleting"}}
+        )
+        if claimed.modified_count == 1 and await _remove(db, blob["key"], "uploading"):
+            removed += 1
+
+    stats.swept += removed
+    return removed
+
+
+async def savings(db: AsyncIOMotorClient) -> dict:
+    """Armazenamento e transferência economizados pela deduplicação (todos os workers)"""
+    result = await db.media_blobs.aggregate([
+        {"$match": {"state": "active"}},
+        {"$group": {
+            "_id": None,
+            "blobs": {"$sum": 1},
+            "stored_bytes": {"$sum": {"$ifNull": ["$size", 0]}},
+            "storage_saved_bytes": {"$sum": {"$multiply": [
+                {"$ifNull": ["$size", 0]}, {"$max": [{"$subtract": ["$ref_count", 1]}, 0]}
+            ]}},
+            "upload_saved_bytes": {"$sum": {"$multiply": [
+                {"$ifNull": ["$size", 0]}, {"$ifNull": ["$dedup_hits", 0]}
+            ]}}
+        }}
+    ]).to_list(1)
+    if not result:
+        return {"blobs": 0, "stored_bytes": 0, "storage_saved_bytes": 0, "upload_saved_bytes": 0}
+    result[0].pop("_id")
+    return result[0]
+
+
+def start_background_sweeper(db: AsyncIOMotorClient) -> asyncio.Task:
+    """Agenda a varredura periódica dos arquivos sem referências"""
+    global _sweeper_task
+
+    async def run():
+        while True:
+            await asyncio.sleep(MEDIA_SWEEP_INTERVAL_SECONDS)
+            try:
+                removed = await sweep(db)
+                if removed:
+                    logger.info("Arquivos de mídia removidos: %d", removed)
+            except Exception as exc:
+                logger.error("Falha na varredura de mídia: %s", exc)
+
+    _sweeper_task = asyncio.get_running_loop().create_task(run())
+    return _sweeper_task
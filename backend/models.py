@@ -40,6 +40,8 @@ class UserProfile(BaseModel):
     name: str
     avatar: Optional[str] = None
     cover_photo: Optional[str] = None
+    avatar_variants: Dict[str, str] = {}  # Resized versions of the avatar by size
+    cover_photo_variants: Dict[str, str] = {}
     bio: Optional[str] = None
     location: Optional[str] = None
     work: Optional[str] = None
@@ -64,8 +66,6 @@ class UserProfile(BaseModel):
 
 class UserProfileUpdate(BaseModel):
     name: Optional[str] = None
-    avatar: Optional[str] = None
-    cover_photo: Optional[str] = None
     bio: Optional[str] = None
     location: Optional[str] = None
     work: Optional[str] = None
@@ -76,6 +76,10 @@ class UserProfileUpdate(BaseModel):
     website: Optional[str] = None
     interests: Optional[List[str]] = None
     privacy_settings: Optional[Dict[str, PrivacyLevel]] = None
+    # Iguais aos atuais são ignorados; outros valores precisam ser URLs de
+    # uploads diretos do usuário e seguem o caminho de /users/me/avatar e /cover
+    avatar: Optional[str] = None
+    cover_photo: Optional[str] = None
 
 class PasswordReset(BaseModel):
     email: EmailStr
@@ -105,6 +109,9 @@ class FriendRequestCreate(BaseModel):
 class FriendRequestUpdate(BaseModel):
     status: FriendshipStatus
 
+class MutualCountsRequest(BaseModel):
+    user_ids: List[str] = Field(..., max_length=500)
+
 # Post Models
 class PostCreate(BaseModel):
     content: str
@@ -116,11 +123,13 @@ class Post(BaseModel):
     author_id: str
     content: str
     media_urls: Optional[List[str]] = None
+    media: List[Dict[str, Any]] = []  # Original URL and resized variants of each image
     privacy: PrivacyLevel = PrivacyLevel.FRIENDS
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
-    likes: List[str] = []  # List of user IDs who liked the post
-    comments: List[Dict[str, Any]] = []  # List of comment objects
+    like_count: int = 0  # Likes live in the reactions collection
+    comment_count: int = 0  # Comments live in the comments collection
+    latest_comments: List[Dict[str, Any]] = []  # Preview of the most recent comments
     shares: int = 0
 
 class PostUpdate(BaseModel):
@@ -140,7 +149,7 @@ class Comment(BaseModel):
     content: str
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
-    likes: List[str] = []  # List of user IDs who liked the comment
+    like_count: int = 0  # Likes live in the reactions collection
 
 # Notification Models
 class NotificationType(str, Enum):
@@ -161,6 +170,85 @@ class Notification(BaseModel):
     message: str
     is_read: bool = False
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    # Notificações agrupadas: número de eventos e últimos remetentes
+    actor_count: int = 1
+    actor_ids: List[str] = []
+
+# Media Models
+class UploadFileSpec(BaseModel):
+    content_type: str
+    size: int
+
+class UploadTargetsRequest(BaseModel):
+    purpose: str  # post, avatar or cover
+    files: List[UploadFileSpec] = Field(..., min_length=1, max_length=10)
+
+class MediaKeyCommit(BaseModel):
+    key: str
+
+# Response Models (montados por serializers.py; documentam o formato das listagens)
+class UserCard(BaseModel):
+    id: str
+    name: str
+    avatar: Optional[str] = None
+    is_verified: bool = False
+
+class FriendCard(UserCard):
+    location: Optional[str] = None
+
+class Friend(FriendCard):
+    friendship_id: str
+    since: Optional[datetime] = None
+
+class FriendSuggestion(FriendCard):
+    mutual_friends: int = 0
+
+class FriendRequestCard(BaseModel):
+    request_id: str
+    requester: UserCard
+    created_at: datetime
+
+class PostLiker(UserCard):
+    liked_at: datetime
+
+class CommentPreview(BaseModel):
+    id: str
+    content: str
+    created_at: datetime
+    author: UserCard
+
+class CommentOut(CommentPreview):
+    like_count: int = 0
+    is_liked: bool = False
+
+class PostSummary(BaseModel):
+    id: str
+    content: str
+    media_urls: List[str] = []
+    created_at: datetime
+    updated_at: datetime
+    like_count: int = 0
+    comment_count: int = 0
+    share_count: int = 0
+    author: UserCard
+    is_liked: bool = False
+
+class FeedPost(PostSummary):
+    latest_comments: List[CommentPreview] = []
+
+class PostDetail(PostSummary):
+    comments: List[CommentOut] = []
+
+class NotificationOut(BaseModel):
+    id: str
+    type: NotificationType
+    message: str
+    reference_id: Optional[str] = None
+    is_read: bool = False
+    created_at: datetime
+    actor_count: int = 1
+    sender: Optional[UserCard] = None
+    actors: List[UserCard] = []
 
 # Token Models
 class Token(BaseModel):
@@ -169,6 +257,24 @@ class Token(BaseModel):
     user_id: str
     name: str
     avatar: Optional[str] = None
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class LogoutRequest(BaseModel):
+    refresh_token: Optional[str] = None
+    all_sessions: bool = False
+
+class Principal(BaseModel):
+    # Usuário autenticado, montado a partir das claims do token de acesso
+    id: str
+    name: str
+    avatar: Optional[str] = None
+    is_verified: bool = False
+    token_version: int = 0
+    token_id: Optional[str] = None
+    expires_at: Optional[int] = None
 
 class TokenData(BaseModel):
     user_id: str
\ No newline at end of file
@@ -0,0 +1,461 @@
+"""
+Emissor de notificações com outbox em processo.
+
+As rotas chamam `notify(...)`, que só monta a notificação e a coloca no
+buffer, sem esperar o banco nem o disco. O buffer é gravado no banco quando
+atinge `NOTIFICATION_OUTBOX_BATCH_SIZE` eventos ou a cada
+`NOTIFICATION_OUTBOX_FLUSH_INTERVAL` segundos.
+
+O journal (`NOTIFICATION_OUTBOX_DIR/outbox-<pid>_<boot>.jsonl`) guarda os
+eventos ainda não gravados. Os eventos de uma rodada do event loop são
+escritos juntos, em uma thread própria do outbox que faz todo o I/O de
+arquivos em ordem; um evento só fica fora do journal até essa escrita. A
+cada flush o arquivo atual vira um segmento (`.<n>.flushing`), apagado
+quando a gravação termina.
+
+`<boot>` é um id aleatório de cada inicialização do processo: em containers,
+o pid de um worker encerrado se repete no seguinte. Enquanto vive, o worker
+mantém um `flock` em `outbox-<pid>_<boot>.lock`; na inicialização, os
+journals e segmentos cujo lock está livre (o dono morreu) são lidos de novo.
+
+Agrupamento: eventos com o mesmo (destinatário, tipo, reference_id) dentro de
+uma janela de `NOTIFICATION_GROUP_WINDOW_SECONDS` viram um único documento
+(`group_key`), com `actor_count`, os últimos `NOTIFICATION_GROUP_ACTORS`
+remetentes em `actor_ids` e `created_at` do evento mais recente; um novo
+evento torna o grupo não lido de novo. Cada flush junta os eventos do lote e
+faz um upsert por grupo; os grupos criados ou que voltaram a ficar não lidos
+somam aos contadores de `unread_counters`.
+
+Os remetentes distintos de cada grupo ficam em `notification_actors` (um
+documento por grupo e remetente, expirado depois da janela), e `actor_count`
+só sobe até a contagem dessa coleção (`$max`). Assim regravar um lote, ao
+recuperar um journal já gravado ou repetir um flush que falhou no meio, não
+conta o mesmo remetente duas vezes.
+"""
+import asyncio
+import calendar
+import fcntl
+import json
+import logging
+import os
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from models import Notification, NotificationType
+import indexes
+import realtime
+import unread_counters
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_OUTBOX_BATCH_SIZE = int(os.environ.get("NOTIFICATION_OUTBOX_BATCH_SIZE", 100))
+NOTIFICATION_OUTBOX_FLUSH_INTERVAL = float(os.environ.get("NOTIFICATION_OUTBOX_FLUSH_INTERVAL", 0.5))
+NOTIFICATION_OUTBOX_DIR = Path(os.environ.get("NOTIFICATION_OUTBOX_DIR", Path(__file__).parent / "outbox"))
+# fsync a cada evento: mais durável, porém mais lento
+NOTIFICATION_OUTBOX_FSYNC = os.environ.get("NOTIFICATION_OUTBOX_FSYNC", "false").lower() == "true"
+
+NOTIFICATION_GROUP_WINDOW_SECONDS = int(os.environ.get("NOTIFICATION_GROUP_WINDOW_SECONDS", 6 * 60 * 60))
+NOTIFICATION_GROUP_ACTORS = int(os.environ.get("NOTIFICATION_GROUP_ACTORS", 3))
+
+DUPLICATE_KEY_ERROR = 11000
+
+indexes.declare("notifications", [("group_key", 1)], unique=True, partialFilterExpression={"group_key": {"$type": "string"}})
+indexes.declare("notification_actors", [("group_key", 1), ("actor_id", 1)], unique=True)
+# Depois da janela o grupo não recebe eventos novos; a margem cobre journals recuperados com atraso
+indexes.declare("notification_actors", [("created_at", 1)], expireAfterSeconds=2 * NOTIFICATION_GROUP_WINDOW_SECONDS)
+
+MESSAGES = {
+    NotificationType.FRIEND_REQUEST: "{name} sent you a friend request",
+    NotificationType.FRIEND_ACCEPT: "{name} accepted your friend request",
+    NotificationType.POST_LIKE: "{name} liked your post",
+    NotificationType.POST_COMMENT: "{name} commented on your post",
+    NotificationType.COMMENT_LIKE: "{name} liked your comment",
+    NotificationType.POST_SHARE: "{name} shared your post"
+}
+
+
+def group_message(notification_type: NotificationType, sender_name: str, actor_count: int = 1) -> str:
+    """Mensagem da notificação, ex.: Ana and 37 others liked your post"""
+    others = actor_count - 1
+    if others > 0:
+        sender_name = f"{sender_name} and {others} other{'s' if others > 1 else ''}"
+    return MESSAGES.get(notification_type, "You have a new notification from {name}").format(name=sender_name)
+
+
+def group_key(notification: dict) -> str:
+    # Destinatário, tipo, objeto e janela de tempo do evento
+    bucket = calendar.timegm(notification["created_at"].utctimetuple()) // NOTIFICATION_GROUP_WINDOW_SECONDS
+    notification_type = NotificationType(notification["type"]).value
+    return f"{notification['recipient_id']}:{notification_type}:{notification.get('reference_id')}:{bucket}"
+
+
+def _group_events(batch: List[dict]) -> Dict[str, List[dict]]:
+    groups: Dict[str, List[dict]] = {}
+    for notification in batch:
+        groups.setdefault(group_key(notification), []).append(notification)
+    return groups
+
+
+def actor_upserts(batch: List[dict]) -> List[UpdateOne]:
+    """Um upsert por (grupo, remetente) do lote; repetir o lote não cria documentos novos"""
+    operations = {}
+    for notification in batch:
+        key = group_key(notification)
+        operations[key, notification["sender_id"]] = UpdateOne(
+            {"group_key": key, "actor_id": notification["sender_id"]},
+            {"$max": {"created_at": notification["created_at"]}},
+            upsert=True
+        )
+    return list(operations.values())
+
+
+def group_upserts(batch: List[dict]) -> Dict[str, tuple]:
+    """Um upsert por grupo com os eventos do lote: group_key -> (destinatário, operação)"""
+    groups = _group_events(batch)
+
+    operations = {}
+    for key, events in groups.items():
+        events.sort(key=lambda event: event["created_at"])
+        first, last = events[0], events[-1]
+        # Remetentes distintos, do mais antigo ao mais recente
+        actors = list(dict.fromkeys(event["sender_id"] for event in reversed(events)))[::-1]
+        operations[key] = (first["recipient_id"], UpdateOne(
+            {"group_key": key},
+            {
+                "$setOnInsert": {
+                    "id": first["id"],
+                    "recipient_id": first["recipient_id"],
+                    "type": first["type"],
+                    "reference_id": first.get("reference_id"),
+                    "first_at": first["created_at"]
+                },
+                "$set": {
+                    "sender_id": last["sender_id"],
+                    "message": last["message"],
+                    "is_read": False,
+                    "created_at": last["created_at"]
+                },
+                # Limite inferior; `_count_actors` sobe até o total de remetentes distintos
+                "$max": {"actor_count": len(actors)},
+                "$push": {"actor_ids": {"$each": actors, "$slice": -NOTIFICATION_GROUP_ACTORS}}
+            },
+            upsert=True
+        ))
+    return operations
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _lock_free(path: Path) -> Optional[int]:
+    """Descritor com o lock de `path`, se nenhum processo vivo o detém"""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class NotificationOutbox:
+    def __init__(self, directory: Path = NOTIFICATION_OUTBOX_DIR, batch_size: int = NOTIFICATION_OUTBOX_BATCH_SIZE, interval: float = NOTIFICATION_OUTBOX_FLUSH_INTERVAL):
+        self.directory = Path(directory)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.db: Optional[AsyncIOMotorClient] = None
+        # Dono dos arquivos: pid e id desta inicialização
+        self.owner = f"{os.getpid()}_{uuid.uuid4().hex[:12]}"
+        self._buffer: List[dict] = []
+        # Eventos do buffer ainda não enviados à thread do journal
+        self._unjournaled: List[dict] = []
+        self._journal_scheduled = False
+        self._journal = None
+        self._lock_fd: Optional[int] = None
+        self._segment = 0
+        self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox-journal")
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_scheduled = False
+        # Estatísticas do worker
+        self.emitted = 0
+        self.flushed = 0
+        self.batches = 0
+        self.groups = 0
+        self.failures = 0
+
+    @property
+    def journal_path(self) -> Path:
+        return self.directory / f"outbox-{self.owner}.jsonl"
+
+    @property
+    def lock_path(self) -> Path:
+        return self.directory / f"outbox-{self.owner}.lock"
+
+    def _open_journal(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self._lock_fd is None:
+            # O lock existe antes do journal: quem vê o journal vê o dono vivo
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _append(self, notifications: List[dict]):
+        if not notifications:
+            return
+        if self._journal is None:
+            self._open_journal()
+        self._journal.write("".join(json.dumps(notification, default=str) + "\n" for notification in notifications))
+        self._journal.flush()
+        if NOTIFICATION_OUTBOX_FSYNC:
+            os.fsync(self._journal.fileno())
+
+    def _rotate(self, notifications: List[dict]) -> Optional[Path]:
+        # Escreve o restante do lote; o journal atual vira um segmento com exatamente os eventos do lote
+        self._append(notifications)
+        if self._journal is None:
+            return None
+        self._journal.close()
+        self._journal = None
+        self._segment += 1
+        segment = self.journal_path.with_suffix(f".{self._segment}.flushing")
+        os.replace(self.journal_path, segment)
+        return segment
+
+    def _close(self):
+        # Encerramento limpo: sem eventos pendentes, journal e lock deixam de existir
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.journal_path.unlink(missing_ok=True)
+        if self._lock_fd is not None:
+            self.lock_path.unlink(missing_ok=True)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    async def _run_io(self, function, *args):
+        # Todo o I/O do journal passa pela mesma thread, na ordem em que foi pedido
+        return await asyncio.get_running_loop().run_in_executor(self._io, function, *args)
+
+    def _submit_journal(self):
+        # Uma escrita por rodada do event loop, com todos os eventos emitidos nela
+        self._journal_scheduled = False
+        notifications, self._unjournaled = self._unjournaled, []
+        if notifications:
+            future = asyncio.get_running_loop().run_in_executor(self._io, self._append, notifications)
+            future.add_done_callback(self._journal_written)
+
+    def _journal_written(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Falha ao escrever o journal do outbox: %s", future.exception())
+
+    async def sync_journal(self):
+        """Espera os eventos já emitidos chegarem ao journal"""
+        self._submit_journal()
+        await self._run_io(lambda: None)
+
+    def emit(self, notification: dict):
+        """Enfileira uma notificação já montada"""
+        loop = asyncio.get_running_loop()
+        self._buffer.append(notification)
+        self._unjournaled.append(notification)
+        if not self._journal_scheduled:
+            self._journal_scheduled = True
+            loop.call_soon(self._submit_journal)
+        self.emitted += 1
+        if len(self._buffer) >= self.batch_size and not self._flush_scheduled and self.db is not None:
+            self._flush_scheduled = True
+            loop.create_task(self.flush())
+
+    async def _write(self, collection: str, operations: List[UpdateOne]) -> List[int]:
+        # Devolve as posições das operações que criaram um documento novo
+        try:
+            result = await self.db[collection].bulk_write(operations, ordered=False)
+        except BulkWriteError as exc:
+            # Dois workers criando o mesmo documento: o upsert perdedor é repetido e o encontra
+            errors = exc.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            await self.db[collection].bulk_write([operations[error["index"]] for error in errors], ordered=False)
+            return [upserted["index"] for upserted in exc.details.get("upserted", [])]
+        return list(result.upserted_ids)
+
+    async def _count_actors(self, keys: List[str]):
+        # actor_count = remetentes distintos já gravados; `$max` nunca desfaz uma contagem mais nova
+        counts = self.db.notification_actors.aggregate([
+            {"$match": {"group_key": {"$in": keys}}},
+            {"$group": {"_id": "$group_key", "actors": {"$sum": 1}}}
+        ])
+        operations = [
+            UpdateOne({"group_key": count["_id"]}, {"$max": {"actor_count": count["actors"]}})
+            async for count in counts
+        ]
+        if operations:
+            await self.db.notifications.bulk_write(operations, ordered=False)
+
+    async def _count_unread(self, groups: Dict[str, tuple], already_read: set, created: List[int]):
+        # Grupos novos ou que voltaram a ficar não lidos somam ao contador do destinatário
+        keys = list(groups)
+        became_unread = already_read | {keys[index] for index in created}
+        deltas = Counter(groups[key][0] for key in became_unread)
+        try:
+            await unread_counters.counters.increment(self.db, deltas)
+        except Exception as exc:
+            # As notificações já foram gravadas: a reconciliação corrige os contadores
+            logger.warning("Falha ao atualizar contadores de não lidas: %s", exc)
+
+    async def flush(self):
+        """Grava o buffer no banco, com um upsert por grupo de notificações"""
+        async with self._lock:
+            self._flush_scheduled = False
+            if not self._buffer or self.db is None:
+                return
+            batch, self._buffer = self._buffer, []
+            unjournaled, self._unjournaled = self._unjournaled, []
+            segment = await self._run_io(self._rotate, unjournaled)
+
+            groups = group_upserts(batch)
+            operations = [operation for _, operation in groups.values()]
+            try:
+                already_read = {
+                    group["group_key"]
+                    async for group in self.db.notifications.find(
+                        {"group_key": {"$in": list(groups)}, "is_read": True},
+                        {"_id": 0, "group_key": 1}
+                    )
+                }
+                created = await self._write("notifications", operations)
+                await self._write("notification_actors", actor_upserts(batch))
+                await self._count_actors(list(groups))
+            except Exception as exc:
+                await self._requeue(batch, segment, exc)
+                return
+
+            if segment is not None:
+                await self._run_io(segment.unlink, True)
+            await self._count_unread(groups, already_read, created)
+            await realtime.publish((recipient for recipient, _ in groups.values()), {"type": "notifications"})
+            self.flushed += len(batch)
+            self.groups += len(operations)
+            self.batches += 1
+
+    async def _requeue(self, batch: List[dict], segment: Optional[Path], exc: Exception):
+        # Devolver o lote ao journal e ao buffer para a próxima tentativa
+        self.failures += 1
+        logger.warning("Falha ao gravar %d notificações: %s", len(batch), exc)
+        await self._run_io(self._append, batch)
+        self._buffer = batch + self._buffer
+        if segment is not None:
+            await self._run_io(segment.unlink, True)
+
+    def _replay(self):
+        """Recupera os eventos dos journals de processos encerrados"""
+        if not self.directory.exists():
+            return
+        recovered = 0
+        # outbox-<dono>.jsonl, outbox-<dono>.<n>.flushing, outbox-<dono>.lock e
+        # replay-<dono>-... (recuperação interrompida)
+        owners: Dict[str, List[Path]] = {}
+        for path in sorted(self.directory.glob("*-*")):
+            owners.setdefault(path.name.split("-")[1].split(".")[0], []).append(path)
+
+        for owner, paths in owners.items():
+            if owner == self.owner:
+                continue
+            lock_path = self.directory / f"outbox-{owner}.lock"
+            lock_fd = _lock_free(lock_path)
+            if lock_fd is None and lock_path.exists():
+                continue
+            if "_" not in owner and int(owner) != os.getpid() and _pid_alive(int(owner)):
+                # Journal anterior aos ids de inicialização: só o pid indica o dono
+                continue
+            for path in paths:
+                if path != lock_path:
+                    recovered += self._recover(path)
+            if lock_fd is not None:
+                lock_path.unlink(missing_ok=True)
+                os.close(lock_fd)
+        if recovered:
+            logger.info("Notificações recuperadas do journal: %d", recovered)
+
+    def _recover(self, path: Path) -> int:
+        # Reivindicar o arquivo antes de ler, para outro worker não o reler
+        claimed = path.with_name(f"replay-{self.owner}-{path.name}")
+        try:
+            os.replace(path, claimed)
+        except FileNotFoundError:
+            return 0
+        with open(claimed, encoding="utf-8") as journal:
+            notifications = [Notification(**json.loads(line)).dict() for line in journal if line.strip()]
+        # No journal deste worker antes de apagar a cópia (na thread do journal, em ordem)
+        self._io.submit(self._append, notifications).result()
+        self._buffer.extend(notifications)
+        claimed.unlink()
+        return len(notifications)
+
+    def start(self, db: AsyncIOMotorClient) -> asyncio.Task:
+        """Recupera journals pendentes e inicia os flushes periódicos"""
+        self.db = db
+        self._replay()
+
+        async def run():
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+
+        self._task = asyncio.get_running_loop().create_task(run())
+        return self._task
+
+    async def stop(self):
+        """Para os flushes periódicos e grava o que restou no buffer"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if not self._buffer:
+            await self._run_io(self._close)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._buffer),
+            "emitted": self.emitted,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "groups": self.groups,
+            "failures": self.failures
+        }
+
+
+# Outbox compartilhado pelas rotas do worker
+outbox = NotificationOutbox()
+
+
+def notify(recipient_id: str, sender_id: str, sender_name: str, notification_type: NotificationType, reference_id: Optional[str] = None):
+    """Emite uma notificação para `recipient_id` (ignorada se for para o próprio remetente)"""
+    if recipient_id == sender_id:
+        return
+    notification = Notification(
+        recipient_id=recipient_id,
+        sender_id=sender_id,
+        type=notification_type,
+        reference_id=reference_id,
+        message=group_message(notification_type, sender_name)
+    )
+    outbox.emit(notification.dict())
@@ -0,0 +1,67 @@
+"""
+Paginação por cursor (keyset) para listagens ordenadas por data.
+
+O cursor é opaco para o cliente: codifica o par (data, id) do último item
+da página. A próxima página é uma faixa `(data, id) < cursor` sobre um
+índice composto, sem o custo de `skip` percorrer os documentos anteriores.
+O cursor da próxima página é devolvido no cabeçalho `X-Next-Cursor`.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Response
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(created_at: datetime, item_id: str) -> str:
+    payload = json.dumps({"t": created_at.isoformat(), "id": item_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(payload["t"]), str(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_sort(field: str = "created_at", descending: bool = True) -> List[tuple]:
+    direction = -1 if descending else 1
+    return [(field, direction), ("id", direction)]
+
+
+def keyset_filter(cursor: str, field: str = "created_at", descending: bool = True) -> dict:
+    """Filtro Mongo que seleciona os itens posteriores ao cursor na ordenação"""
+    value, item_id = decode_cursor(cursor)
+    op = "$lt" if descending else "$gt"
+    return {
+        "$or": [
+            {field: {op: value}},
+            {field: value, "id": {op: item_id}}
+        ]
+    }
+
+
+def paginate_query(query: dict, cursor: Optional[str], field: str = "created_at", descending: bool = True) -> dict:
+    """Combina a consulta da listagem com o filtro do cursor, se houver"""
+    if not cursor:
+        return query
+    return {"$and": [query, keyset_filter(cursor, field, descending)]}
+
+
+def next_cursor(items: List[dict], limit: int, field: str = "created_at") -> Optional[str]:
+    """Cursor da próxima página, ou None quando a página veio incompleta"""
+    if limit <= 0 or len(items) < limit:
+        return None
+    last = items[-1]
+    return encode_cursor(last[field], last["id"])
+
+
+def set_next_cursor(response: Response, cursor: Optional[str]):
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
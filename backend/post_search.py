@@ -0,0 +1,333 @@
+"""
+Busca textual nos posts com índice invertido em processo.
+
+Cada worker mantém um índice termo -> lista de posts (posting list). Os posts
+recebem números sequenciais (docno) na ordem em que são indexados, e a tabela
+de documentos guarda, por docno, id, autor, privacidade e data. Os termos são
+os tokens do conteúdo com a mesma normalização da busca de usuários (sem
+acentos, em minúsculas).
+
+As posting lists são comprimidas em blocos de `POST_SEARCH_BLOCK_SIZE`
+docnos: o primeiro valor e as diferenças (delta) no menor tipo inteiro sem
+sinal que as comporta. A decodificação é vetorizada (`numpy.cumsum`) e a
+interseção dos termos usa `numpy.intersect1d`, a partir da lista mais curta.
+
+O índice é montado a partir da coleção `posts` na inicialização e depois
+atualizado por `create_post`, `share_post`, `update_post` e `delete_post`,
+que publicam a alteração para todos os workers (`realtime.broadcast`). Posts
+alterados ou excluídos viram lápides; quando elas passam de
+`POST_SEARCH_COMPACT_RATIO` da tabela de documentos, uma tarefa em segundo
+plano monta listas e tabela novas só com os posts vivos, renumerados.
+
+A montagem e a compactação preenchem um índice novo, em lotes que devolvem o
+controle ao event loop, enquanto o atual continua atendendo buscas e
+alterações. As alterações recebidas nesse meio-tempo também são guardadas e
+reaplicadas no índice novo antes da troca, para uma exclusão publicada antes
+de o post ser lido do banco não o trazer de volta.
+
+A busca devolve os candidatos do mais recente ao mais antigo, com autor e
+privacidade, para a rota aplicar `PostVisibility` sem consultar o banco.
+"""
+import asyncio
+import calendar
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import realtime
+from user_search import normalize
+
+logger = logging.getLogger(__name__)
+
+POST_SEARCH_BLOCK_SIZE = int(os.environ.get("POST_SEARCH_BLOCK_SIZE", 128))
+POST_SEARCH_COMPACT_RATIO = float(os.environ.get("POST_SEARCH_COMPACT_RATIO", 0.25))
+
+TOPIC = "post_search"
+INDEX_PROJECTION = {"_id": 0, "id": 1, "content": 1, "author_id": 1, "privacy": 1, "created_at": 1}
+
+
+def timestamp(value: datetime) -> int:
+    # Milissegundos UTC, a mesma precisão das datas gravadas no Mongo
+    return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+
+
+def _delta_dtype(max_delta: int):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if max_delta <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+class PostingList:
+    """Docnos crescentes, em blocos (primeiro valor, deltas) e uma cauda aberta"""
+
+    __slots__ = ("_blocks", "_tail")
+
+    def __init__(self):
+        self._blocks: List[Tuple[int, np.ndarray]] = []
+        self._tail: List[int] = []
+
+    def append(self, docno: int):
+        self._tail.append(docno)
+        if len(self._tail) >= POST_SEARCH_BLOCK_SIZE:
+            self._seal()
+
+    def _seal(self):
+        self._blocks.append(self._block(np.array(self._tail, dtype=np.int64)))
+        self._tail = []
+
+    @staticmethod
+    def _block(values: np.ndarray) -> Tuple[int, np.ndarray]:
+        deltas = np.diff(values)
+        return int(values[0]), deltas.astype(_delta_dtype(int(deltas.max()) if len(deltas) else 0))
+
+    def __len__(self) -> int:
+        return sum(len(deltas) + 1 for _, deltas in self._blocks) + len(self._tail)
+
+    def to_array(self) -> np.ndarray:
+        parts = [
+            np.concatenate(([first], first + np.cumsum(deltas, dtype=np.int64)))
+            for first, deltas in self._blocks
+        ]
+        parts.append(np.array(self._tail, dtype=np.int64))
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(8 + deltas.nbytes for _, deltas in self._blocks) + 8 * len(self._tail)
+
+    @classmethod
+    def from_array(cls, docnos: np.ndarray) -> "PostingList":
+        postings = cls()
+        sealed = len(docnos) - len(docnos) % POST_SEARCH_BLOCK_SIZE
+        postings._blocks = [
+            cls._block(docnos[start:start + POST_SEARCH_BLOCK_SIZE])
+            for start in range(0, sealed, POST_SEARCH_BLOCK_SIZE)
+        ]
+        postings._tail = docnos[sealed:].tolist()
+        return postings
+
+
+class PostSearchIndex:
+    def __init__(self):
+        self._postings: Dict[str, PostingList] = {}
+        self._docnos: Dict[str, int] = {}
+        # Tabela de documentos, por docno
+        self._post_ids: List[str] = []
+        self._authors: List[str] = []
+        self._privacy: List[str] = []
+        self._created = np.empty(1024, dtype=np.int64)
+        self._alive = np.zeros(1024, dtype=bool)
+        self.dead = 0
+        self.ready = False
+        self.searches = 0
+        self.compactions = 0
+        # Alterações recebidas durante uma montagem ou compactação, para reaplicar no índice novo
+        self._pending: Optional[List[dict]] = None
+        self._compact_task: Optional[asyncio.Task] = None
+
+    def _grow(self):
+        size = len(self._created) * 2
+        self._created = np.resize(self._created, size)
+        alive = np.zeros(size, dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+
+    def upsert(self, post_id: str, content: str, author_id: str, privacy: str, created_at: int):
+        """Indexa (ou reindexa) um post"""
+        self.remove(post_id)
+        docno = len(self._post_ids)
+        if docno >= len(self._created):
+            self._grow()
+        self._post_ids.append(post_id)
+        self._authors.append(author_id)
+        self._privacy.append(privacy)
+        self._created[docno] = created_at
+        self._alive[docno] = True
+        self._docnos[post_id] = docno
+        for term in normalize(content):
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = PostingList()
+            postings.append(docno)
+
+    def remove(self, post_id: str):
+        docno = self._docnos.pop(post_id, None)
+        if docno is None:
+            return
+        self._alive[docno] = False
+        self.dead += 1
+
+    def _adopt(self, other: "PostSearchIndex"):
+        # Trocar o conteúdo pelo de um índice montado à parte (sem await: a troca é atômica)
+        self._postings, self._docnos = other._postings, other._docnos
+        self._post_ids, self._authors, self._privacy = other._post_ids, other._authors, other._privacy
+        self._created, self._alive, self.dead = other._created, other._alive, other.dead
+
+    def _replay(self, fresh: "PostSearchIndex"):
+        for change in self._pending:
+            fresh._change(change)
+
+    async def compact(self, batch_size: int = 1000):
+        """Monta listas e tabela de documentos só com os posts vivos, com docnos novos"""
+        if self._pending is not None:
+            return
+        self._pending = []
+        try:
+            size = len(self._post_ids)
+            alive = self._alive[:size].copy()
+            kept = np.flatnonzero(alive)
+            # Docno antigo -> novo, mantendo a ordem (e o desempate da busca)
+            renumber = np.cumsum(alive) - 1
+
+            fresh = PostSearchIndex()
+            fresh._post_ids = [self._post_ids[docno] for docno in kept.tolist()]
+            fresh._authors = [self._authors[docno] for docno in kept.tolist()]
+            fresh._privacy = [self._privacy[docno] for docno in kept.tolist()]
+            while len(fresh._created) < len(kept):
+                fresh._grow()
+            fresh._created[:len(kept)] = self._created[kept]
+            fresh._alive[:len(kept)] = True
+            fresh._docnos = {post_id: docno for docno, post_id in enumerate(fresh._post_ids)}
+
+            for count, (term, postings) in enumerate(list(self._postings.items()), 1):
+                # Docnos a partir de `size` são de alterações guardadas em `_pending`
+                docnos = postings.to_array()
+                docnos = docnos[docnos < size]
+                docnos = docnos[alive[docnos]]
+                if len(docnos):
+                    fresh._postings[term] = PostingList.from_array(renumber[docnos])
+                if count % batch_size == 0:
+                    await asyncio.sleep(0)
+
+            self._replay(fresh)
+            self._adopt(fresh)
+            self.compactions += 1
+        finally:
+            self._pending = None
+
+    def search(self, query: str, before: Optional[Tuple[int, str]] = None) -> Iterator[dict]:
+        """
+        Posts com todos os termos de `query`, do mais recente ao mais antigo,
+        depois de `before` (data em ms, id do último post da página anterior)
+        """
+        self.searches += 1
+        # Tabelas desta versão do índice: uma compactação no meio da iteração troca as do objeto
+        post_ids, authors, privacy = self._post_ids, self._authors, self._privacy
+        terms = normalize(query)
+        postings = [self._postings.get(term) for term in terms]
+        if not terms or any(posting is None for posting in postings):
+            return
+
+        postings.sort(key=len)
+        docnos = postings[0].to_array()
+        for posting in postings[1:]:
+            if not len(docnos):
+                return
+            docnos = np.intersect1d(docnos, posting.to_array(), assume_unique=True)
+        docnos = docnos[self._alive[docnos]]
+
+        created = self._created[docnos]
+        if before is not None:
+            # No empate de data, vale a ordem dos docnos (decrescente)
+            keep = created < before[0]
+            before_docno = self._docnos.get(before[1])
+            if before_docno is not None:
+                keep |= (created == before[0]) & (docnos < before_docno)
+            docnos, created = docnos[keep], created[keep]
+
+        # Mais recentes primeiro
+        for i in np.lexsort((-docnos, -created)):
+            docno = int(docnos[i])
+            yield {
+                "id": post_ids[docno],
+                "author_id": authors[docno],
+                "privacy": privacy[docno],
+                "created_at": int(created[i])
+            }
+
+    def _change(self, change: dict):
+        if change["op"] == "delete":
+            self.remove(change["id"])
+        else:
+            self.upsert(change["id"], change["content"], change["author_id"], change["privacy"], change["created_at"])
+
+    def apply(self, change: dict):
+        """Aplica uma alteração publicada por algum worker"""
+        self._change(change)
+        if self._pending is not None:
+            self._pending.append(change)
+        elif self.dead > POST_SEARCH_COMPACT_RATIO * len(self._post_ids) and (self._compact_task is None or self._compact_task.done()):
+            # Compactar fora do caminho da requisição que publicou a alteração
+            self._compact_task = asyncio.get_running_loop().create_task(self.compact())
+
+    async def build(self, db: AsyncIOMotorClient, batch_size: int = 1000):
+        """Indexa todos os posts da coleção"""
+        self._pending = []
+        try:
+            fresh = PostSearchIndex()
+            count = 0
+            async for post in db.posts.find({}, INDEX_PROJECTION).sort("created_at", 1).batch_size(batch_size):
+                fresh.upsert(post["id"], post.get("content") or "", post["author_id"], post["privacy"], timestamp(post["created_at"]))
+                count += 1
+                if count % batch_size == 0:
+                    # Não monopolizar o event loop durante a carga
+                    await asyncio.sleep(0)
+            self._replay(fresh)
+            self._adopt(fresh)
+        finally:
+            self._pending = None
+        self.ready = True
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "posts": len(self._docnos),
+            "terms": len(self._postings),
+            "dead": self.dead,
+            "compactions": self.compactions,
+            "postings_bytes": sum(postings.nbytes for postings in self._postings.values()),
+            "searches": self.searches
+        }
+
+
+# Índice compartilhado pelas rotas do worker
+index = PostSearchIndex()
+_build_task: Optional[asyncio.Task] = None
+
+
+def start(db: AsyncIOMotorClient) -> asyncio.Task:
+    """Assina as alterações dos outros workers e monta o índice em segundo plano"""
+    global _build_task
+    realtime.subscribe(TOPIC, index.apply)
+
+    async def run():
+        try:
+            count = await index.build(db)
+            logger.info("Índice de busca de posts montado: %d posts", count)
+        except Exception as exc:
+            logger.error("Falha ao montar o índice de busca de posts: %s", exc)
+
+    _build_task = asyncio.get_running_loop().create_task(run())
+    return _build_task
+
+
+async def publish_post(post: dict):
+    """Indexa o post (novo ou alterado) em todos os workers"""
+    await realtime.broadcast(TOPIC, {
+        "op": "upsert",
+        "id": post["id"],
+        "content": post.get("content") or "",
+        "author_id": post["author_id"],
+        "privacy": post["privacy"],
+        "created_at": timestamp(post["created_at"])
+    })
+
+
+async def publish_delete(post_id: str):
+    await realtime.broadcast(TOPIC, {"op": "delete", "id": post_id})
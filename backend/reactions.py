@@ -0,0 +1,297 @@
+"""
+Armazenamento de curtidas (reações) fora do documento curtido.
+
+Cada curtida é um documento em `reactions` (target_type, target_id,
+user_id), com índice único por alvo e usuário. O documento curtido guarda
+só o contador `like_count`. Para uma página inteira de posts, `liked_ids`
+resolve o "curtiu?" do usuário com uma única consulta.
+
+Alternar uma curtida são duas escritas separadas, sem transação: a reação
+(a inserção no índice único decide entre curtir e descurtir) e o `$inc` do
+contador, que também marca `likes_updated_at` e devolve o valor atualizado.
+Se o processo cair entre as duas, o contador fica diferente da coleção
+`reactions`; `reconcile_like_counts` (`python cli.py reconcile-likes`,
+periódico) recalcula os alvos alterados desde um instante, ou todos com
+`--full`, e grava só se o contador ainda é o valor lido.
+
+Com `Idempotency-Key`, a primeira chamada grava em `reaction_requests` o
+estado pretendido (curtir ou descurtir) e um prazo (`lease_until`). Se ela
+cair antes de gravar o resultado, uma repetição assume a chave depois do
+prazo e aplica o mesmo estado, o que não alterna de novo se a reação já
+tinha sido escrita.
+
+Documentos antigos com o array `likes` são migrados uma única vez com
+`python cli.py migrate-likes`, antes de colocar este caminho de escrita no
+ar; a leitura ainda soma o array, mas a curtida não o altera mais.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import indexes
+
+logger = logging.getLogger(__name__)
+
+POST = "post"
+COMMENT = "comment"
+
+indexes.declare("reactions", [("target_id", 1), ("user_id", 1)], unique=True)
+indexes.declare("reactions", [("target_id", 1), ("created_at", -1), ("id", -1)])
+indexes.declare("reactions", [("target_type", 1), ("created_at", 1)])
+# Alvos com curtidas alteradas, para a reconciliação incremental dos contadores
+indexes.declare("posts", [("likes_updated_at", 1)], sparse=True)
+indexes.declare("comments", [("likes_updated_at", 1)], sparse=True)
+
+# Tentativas de alternar a curtida quando outra requisição do mesmo usuário interfere
+TOGGLE_MAX_ATTEMPTS = 5
+
+# Chaves de idempotência das curtidas, expiradas pelo TTL
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("REACTION_IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+# Prazo da chamada que detém a chave; vencido, uma repetição pode assumi-la
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get("REACTION_IDEMPOTENCY_LEASE_SECONDS", 10))
+indexes.declare("reaction_requests", [("user_id", 1), ("key", 1)], unique=True)
+indexes.declare("reaction_requests", [("created_at", 1)], expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS)
+
+
+def like_count(target: dict) -> int:
+    # Soma as curtidas ainda guardadas no array legado
+    return target.get("like_count", 0) + len(target.get("likes", []))
+
+
+async def liked_ids(db: AsyncIOMotorClient, user_id: str, targets: Iterable[dict]) -> Set[str]:
+    """Ids dos alvos (posts ou comentários) curtidos pelo usuário, em uma única consulta"""
+    targets = list(targets)
+    liked = {target["id"] for target in targets if user_id in target.get("likes", [])}
+    if targets:
+        reactions = await db.reactions.find(
+            {"target_id": {"$in": [target["id"] for target in targets]}, "user_id": user_id},
+            {"_id": 0, "target_id": 1}
+        ).to_list(None)
+        liked.update(reaction["target_id"] for reaction in reactions)
+    return liked
+
+
+async def add(db: AsyncIOMotorClient, target_type: str, target_id: str, user_id: str) -> bool:
+    """Registra a curtida; retorna False se ela já existia"""
+    try:
+        await db.reactions.insert_one({
+            "id": str(uuid.uuid4()),
+            "target_type": target_type,
+            "target_id": target_id,
+            "user_id": user_id,
+            "created_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+async def remove(db: AsyncIOMotorClient, target_id: str, user_id: str) -> bool:
+    """Remove a curtida; retorna False se ela não existia"""
+    result = await db.reactions.delete_one({"target_id": target_id, "user_id": user_id})
+    return result.deleted_count == 1
+
+
+async def migrate_target_likes(db: AsyncIOMotorClient, collection: str, target_type: str, target: dict) -> bool:
+    """
+    Move o array `likes` de um documento para `reactions` e soma o contador.
+    Retorna False se o array mudou durante a cópia.
+    """
+    likes = target.get("likes", [])
+    inserted = [user_id for user_id in likes if await add(db, target_type, target["id"], user_id)]
+
+    result = await db[collection].update_one(
+        {"id": target["id"], "likes": likes},
+        {"$unset": {"likes": ""}, "$inc": {"like_count": len(likes)}}
+    )
+    if result.modified_count == 1:
+        return True
+
+    # Desfazer as cópias desta tentativa; a próxima parte do array atualizado
+    await db.reactions.delete_many({"target_id": target["id"], "user_id": {"$in": inserted}})
+    return False
+
+
+async def migrate_likes(db: AsyncIOMotorClient, collection: str, target_type: str, batch_size: int = 100, max_attempts: int = 5) -> int:
+    """Migra as curtidas de todos os documentos da coleção que ainda têm o array"""
+    migrated = 0
+    cursor = db[collection].find(
+        {"likes": {"$exists": True}},
+        {"_id": 0, "id": 1, "likes": 1}
+    ).batch_size(batch_size)
+
+    async for target in cursor:
+        for _ in range(max_attempts):
+            if await migrate_target_likes(db, collection, target_type, target):
+                migrated += 1
+                break
+            target = await db[collection].find_one({"id": target["id"]}, {"_id": 0, "id": 1, "likes": 1})
+            if target is None or "likes" not in target:
+                break
+        else:
+            logger.warning("Documento %s alterado durante a migração; tente novamente", target["id"])
+
+        if migrated and migrated % batch_size == 0:
+            logger.info("Documentos migrados em %s: %d", collection, migrated)
+    return migrated
+
+
+async def _bump(db: AsyncIOMotorClient, collection: str, target_id: str, delta: int) -> int:
+    # Um único $inc que devolve o contador já atualizado
+    target = await db[collection].find_one_and_update(
+        {"id": target_id},
+        {"$inc": {"like_count": delta}, "$set": {"likes_updated_at": datetime.utcnow()}},
+        projection={"_id": 0, "like_count": 1, "likes": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return like_count(target) if target else 0
+
+
+async def _toggle(db: AsyncIOMotorClient, collection: str, target_type: str, target_id: str, user_id: str) -> dict:
+    # O índice único (target_id, user_id) torna a inserção a escrita condicional:
+    # quem inserir primeiro curte; se a curtida já existe, a remoção descurte
+    for _ in range(TOGGLE_MAX_ATTEMPTS):
+        if await add(db, target_type, target_id, user_id):
+            return {"liked": True, "like_count": await _bump(db, collection, target_id, 1)}
+        if await remove(db, target_id, user_id):
+            return {"liked": False, "like_count": await _bump(db, collection, target_id, -1)}
+    raise HTTPException(status_code=409, detail="Concurrent like update, please retry")
+
+
+async def _repair_counts(db: AsyncIOMotorClient, collection: str, target_ids: List[str]) -> int:
+    targets = await db[collection].find(
+        {"id": {"$in": target_ids}, "likes": {"$exists": False}},
+        {"_id": 0, "id": 1, "like_count": 1}
+    ).to_list(None)
+    if not targets:
+        return 0
+
+    counts: Dict[str, int] = {target["id"]: 0 for target in targets}
+    async for row in db.reactions.aggregate([
+        {"$match": {"target_id": {"$in": list(counts)}}},
+        {"$group": {"_id": "$target_id", "count": {"$sum": 1}}}
+    ]):
+        counts[row["_id"]] = row["count"]
+
+    repaired = 0
+    for target in targets:
+        stored = target.get("like_count")
+        if (stored or 0) == counts[target["id"]]:
+            continue
+        # Só grava se nenhum $inc chegou depois da leitura; se chegou, o alvo
+        # ganhou um likes_updated_at novo e volta na próxima reconciliação
+        result = await db[collection].update_one(
+            {"id": target["id"], "like_count": stored},
+            {"$set": {"like_count": counts[target["id"]]}}
+        )
+        repaired += result.modified_count
+    return repaired
+
+
+async def _changed_target_ids(db: AsyncIOMotorClient, collection: str, target_type: str, since: Optional[datetime], batch_size: int):
+    if since is None:
+        async for target in db[collection].find({}, {"_id": 0, "id": 1}).batch_size(batch_size):
+            yield target["id"]
+        return
+    # Alvos com $inc recente e alvos com reação nova sem $inc (queda entre as escritas);
+    # uma queda entre a remoção da reação e o $inc só aparece na reconciliação completa
+    changed = await db[collection].distinct("id", {"likes_updated_at": {"$gte": since}})
+    added = await db.reactions.distinct("target_id", {"target_type": target_type, "created_at": {"$gte": since}})
+    for target_id in dict.fromkeys([*changed, *added]):
+        yield target_id
+
+
+async def reconcile_like_counts(db: AsyncIOMotorClient, collection: str, target_type: str, since: Optional[datetime] = None, batch_size: int = 500) -> int:
+    """
+    Recalcula `like_count` a partir de `reactions` para os alvos curtidos ou
+    descurtidos desde `since` (todos, sem `since`). Retorna quantos foram corrigidos.
+    """
+    repaired = 0
+    batch: List[str] = []
+    async for target_id in _changed_target_ids(db, collection, target_type, since, batch_size):
+        batch.append(target_id)
+        if len(batch) >= batch_size:
+            repaired += await _repair_counts(db, collection, batch)
+            batch = []
+    if batch:
+        repaired += await _repair_counts(db, collection, batch)
+    return repaired
+
+
+async def _set(db: AsyncIOMotorClient, collection: str, target_type: str, target_id: str, user_id: str, liked: bool) -> Tuple[dict, bool]:
+    # Leva a curtida ao estado pedido; False se ela já estava nele
+    changed = await (add(db, target_type, target_id, user_id) if liked else remove(db, target_id, user_id))
+    if changed:
+        return {"liked": liked, "like_count": await _bump(db, collection, target_id, 1 if liked else -1)}, True
+    target = await db[collection].find_one({"id": target_id}, {"_id": 0, "like_count": 1, "likes": 1})
+    return {"liked": liked, "like_count": like_count(target) if target else 0}, False
+
+
+async def _claim(db: AsyncIOMotorClient, request: dict, target_id: str, liked: bool) -> Optional[dict]:
+    """Registra a chave de idempotência ou assume uma cujo prazo venceu; None se outra chamada a detém"""
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+    try:
+        await db.reaction_requests.insert_one({
+            **request,
+            "target_id": target_id,
+            "liked": liked,
+            "result": None,
+            "lease_until": lease_until,
+            "created_at": now
+        })
+        return {"liked": liked}
+    except DuplicateKeyError:
+        pass
+    # A chamada que registrou a chave caiu antes de gravar o resultado
+    return await db.reaction_requests.find_one_and_update(
+        {**request, "target_id": target_id, "result": None, "lease_until": {"$lt": now}},
+        {"$set": {"lease_until": lease_until}},
+        projection={"_id": 0, "liked": 1}
+    )
+
+
+async def toggle(db: AsyncIOMotorClient, collection: str, target_type: str, target_id: str, user_id: str, idempotency_key: Optional[str] = None) -> Tuple[dict, bool]:
+    """
+    Alterna a curtida do usuário no alvo e devolve `liked` e o `like_count`
+    atualizado, junto com um indicador de que a alteração foi aplicada agora.
+    Repetições com a mesma `idempotency_key` devolvem o resultado da primeira
+    chamada (e False) em vez de alternar de novo.
+    """
+    if not idempotency_key:
+        return await _toggle(db, collection, target_type, target_id, user_id), True
+
+    request = {"user_id": user_id, "key": idempotency_key}
+    existing = await db.reactions.find_one({"target_id": target_id, "user_id": user_id}, {"_id": 0, "id": 1})
+    for _ in range(20):
+        claimed = await _claim(db, request, target_id, existing is None)
+        if claimed is not None:
+            break
+        # Repetição: aguardar a primeira chamada terminar e devolver o resultado dela
+        previous = await db.reaction_requests.find_one(request)
+        if previous is None:
+            continue
+        if previous["target_id"] != target_id:
+            raise HTTPException(status_code=422, detail="Idempotency key reused for another target")
+        if previous["result"] is not None:
+            return previous["result"], False
+        await asyncio.sleep(0.05)
+    else:
+        raise HTTPException(status_code=409, detail="Request with this idempotency key is in progress")
+
+    try:
+        result, applied = await _set(db, collection, target_type, target_id, user_id, claimed["liked"])
+    except Exception:
+        # Libera a chave para a próxima repetição, que aplica o mesmo estado
+        await db.reaction_requests.update_one(request, {"$set": {"lease_until": datetime.utcnow()}})
+        raise
+    await db.reaction_requests.update_one(request, {"$set": {"result": result}})
+    return result, applied
@@ -0,0 +1,260 @@
+"""
+Envio em tempo real de eventos aos clientes conectados (notificações e feed).
+
+Os clientes abrem `GET /api/realtime/stream` (server-sent events) e passam a
+receber eventos em vez de consultar as listas periodicamente:
+
+- `{"type": "notifications"}`: há notificações novas (buscar a lista e
+  `unread-count` de novo)
+- `{"type": "feed", "post_id", "author_id"}`: um post novo entrou na timeline
+
+Quem gera eventos chama `publish(user_ids, event)`. A mensagem passa pelo
+pub/sub, que a entrega a todos os workers; cada worker a repassa às conexões
+locais dos usuários, registradas em `registry`. O pub/sub é escolhido por
+`REALTIME_PUBSUB`: `memory` (um único worker, e testes) ou `redis` (vários
+workers, usando `REDIS_URL`; requer o pacote `redis`, opcional). O mesmo
+pub/sub leva mensagens entre workers com `broadcast(topic, payload)`, entregues
+a quem chamou `subscribe(topic, handler)`.
+
+Cada conexão tem uma fila de até `REALTIME_QUEUE_SIZE` eventos; um cliente
+que não consome a fila é desconectado (ele reconecta e busca o estado atual),
+para um cliente lento não acumular memória no worker. Sem eventos, um
+comentário SSE é enviado a cada `REALTIME_HEARTBEAT_SECONDS` para manter a
+conexão aberta em proxies e detectar clientes que sumiram.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterable, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+REALTIME_PUBSUB = os.environ.get("REALTIME_PUBSUB", "memory")
+REALTIME_CHANNEL = os.environ.get("REALTIME_CHANNEL", "realtime")
+REALTIME_QUEUE_SIZE = int(os.environ.get("REALTIME_QUEUE_SIZE", 100))
+REALTIME_HEARTBEAT_SECONDS = float(os.environ.get("REALTIME_HEARTBEAT_SECONDS", 25))
+REALTIME_MAX_CONNECTIONS = int(os.environ.get("REALTIME_MAX_CONNECTIONS", 20000))
+
+
+class Connection:
+    def __init__(self, user_id: str, queue_size: int = REALTIME_QUEUE_SIZE):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+
+    def push(self, event: dict) -> bool:
+        """Enfileira o evento; False se a fila está cheia (cliente lento)"""
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.closed = True
+            return False
+        return True
+
+
+class ConnectionRegistry:
+    def __init__(self, max_connections: int = REALTIME_MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        self._connections: Dict[str, Set[Connection]] = {}
+        self.count = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.max_connections
+
+    def register(self, user_id: str) -> Optional[Connection]:
+        """Nova conexão do usuário, ou None se o worker atingiu o limite"""
+        if self.full:
+            return None
+        connection = Connection(user_id)
+        self._connections.setdefault(user_id, set()).add(connection)
+        self.count += 1
+        return connection
+
+    def unregister(self, connection: Connection):
+        connections = self._connections.get(connection.user_id)
+        if connections and connection in connections:
+            connections.discard(connection)
+            self.count -= 1
+            if not connections:
+                del self._connections[connection.user_id]
+
+    def deliver(self, user_ids: Iterable[str], event: dict):
+        """Repassa o evento às conexões locais dos usuários"""
+        for user_id in user_ids:
+            for connection in list(self._connections.get(user_id, ())):
+                if connection.push(event):
+                    self.delivered += 1
+                else:
+                    # Fila cheia: desconectar em vez de acumular eventos
+                    self.dropped += 1
+                    self.unregister(connection)
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.count,
+            "users": len(self._connections),
+            "delivered": self.delivered,
+            "dropped": self.dropped
+        }
+
+
+class InProcessPubSub:
+    """Entrega as mensagens só no próprio worker"""
+
+    def __init__(self):
+        self._handler: Optional[Callable[[dict], None]] = None
+
+    async def start(self, handler: Callable[[dict], None]):
+        self._handler = handler
+
+    async def publish(self, message: dict):
+        if self._handler is not None:
+            self._handler(message)
+
+    async def stop(self):
+        self._handler = None
+
+
+class RedisPubSub:
+    """Entrega as mensagens a todos os workers por um canal do Redis"""
+
+    def __init__(self, url: Optional[str] = None, channel: str = REALTIME_CHANNEL):
+        self.url = url or os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+        self.channel = channel
+        self._redis = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Callable[[dict], None]):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(self.url)
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self.channel)
+
+        async def listen():
+            while True:
+                try:
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            handler(json.loads(message["data"]))
+                except asyncio.CancelledError:
+                    await pubsub.close()
+                    raise
+                except Exception as exc:
+                    logger.warning("Falha ao ler o canal %s: %s", self.channel, exc)
+                    await asyncio.sleep(1)
+
+        self._task = asyncio.get_running_loop().create_task(listen())
+
+    async def publish(self, message: dict):
+        await self._redis.publish(self.channel, json.dumps(message, default=str))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+def _pubsub_from_env():
+    if REALTIME_PUBSUB == "redis":
+        return RedisPubSub()
+    return InProcessPubSub()
+
+
+# Conexões e pub/sub compartilhados pelas rotas do worker
+registry = ConnectionRegistry()
+pubsub = _pubsub_from_env()
+_started = False
+published = 0
+# Tópico -> função chamada em todos os workers (ex.: atualizações do índice de busca)
+_topics: Dict[str, Callable[[dict], None]] = {}
+
+
+def _on_message(message: dict):
+    if "topic" in message:
+        handler = _topics.get(message["topic"])
+        if handler is not None:
+            handler(message["payload"])
+        return
+    registry.deliver(message["users"], message["event"])
+
+
+def subscribe(topic: str, handler: Callable[[dict], None]):
+    """Registra a função que recebe as mensagens de `topic` neste worker"""
+    _topics[topic] = handler
+
+
+async def broadcast(topic: str, payload: dict):
+    """Entrega `payload` aos assinantes de `topic` em todos os workers"""
+    if _started:
+        try:
+            await pubsub.publish({"topic": topic, "payload": payload})
+            return
+        except Exception as exc:
+            logger.warning("Falha ao publicar no tópico %s: %s", topic, exc)
+    # Sem pub/sub (ou com falha nele), aplicar ao menos neste worker
+    _on_message({"topic": topic, "payload": payload})
+
+
+async def start():
+    global _started
+    await pubsub.start(_on_message)
+    _started = True
+
+
+async def stop():
+    global _started
+    _started = False
+    await pubsub.stop()
+
+
+async def publish(user_ids: Iterable[str], event: dict):
+    """Envia o evento aos usuários conectados em qualquer worker"""
+    global published
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids or not _started:
+        return
+    try:
+        await pubsub.publish({"users": user_ids, "event": event})
+    except Exception as exc:
+        # Push é um complemento: a falha não pode afetar quem publicou
+        logger.warning("Falha ao publicar evento em tempo real: %s", exc)
+        return
+    published += 1
+
+
+async def stream(user_id: str, is_disconnected: Callable):
+    """
+    Gera o corpo SSE de uma conexão até o cliente sair ou ficar para trás. A
+    conexão só é registrada quando o corpo começa a ser enviado, para um
+    cliente que sai antes disso não ocupar uma vaga.
+    """
+    connection = registry.register(user_id)
+    if connection is None:
+        # O limite foi atingido entre a verificação da rota e o início do corpo
+        yield "retry: 30000\n\n"
+        return
+    try:
+        yield "retry: 5000\n\n"
+        while not connection.closed:
+            try:
+                event = await asyncio.wait_for(connection.queue.get(), REALTIME_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    break
+                yield ": ping\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+    finally:
+        registry.unregister(connection)
+
+
+def stats() -> dict:
+    return {"pubsub": type(pubsub).__name__, "published": published, **registry.stats()}
@@ -1,21 +1,28 @@
 from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
+from datetime import datetime, timedelta
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 import uuid
 import os
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-from models import UserCreate, UserLogin, Token, UserProfile, PasswordReset, PasswordUpdate
+from models import UserCreate, Token, UserProfile, PasswordReset, PasswordUpdate, Principal, RefreshRequest, LogoutRequest
 from auth import (
-    authenticate_user, create_access_token, get_password_hash, 
-    ACCESS_TOKEN_EXPIRE_MINUTES, get_current_active_user
+    authenticate_user, password_hasher, issue_tokens, decode_token,
+    revoke_all_sessions, revocations, get_current_active_user, get_current_profile
 )
+import indexes
+import user_search
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
+# Tokens de recuperação: busca por token e expiração automática pelo TTL
+indexes.declare("password_resets", [("token", 1)], unique=True)
+indexes.declare("password_resets", [("expires_at", 1)], expireAfterSeconds=0)
+
 # Função para enviar email de recuperação de senha
 async def send_password_reset_email(email: str, token: str):
     sender_email = os.environ.get("EMAIL_USER")
@@ -86,7 +93,7 @@ async def register_user(user: UserCreate, db: AsyncIOMotorClient = Depends()):
     
     # Criar novo usuário
     user_id = str(uuid.uuid4())
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await password_hasher.hash(user.password)
     
     user_data = UserProfile(
         id=user_id,
@@ -99,21 +106,19 @@ async def register_user(user: UserCreate, db: AsyncIOMotorClient = Depends()):
     # Adicionar o usuário ao banco de dados
     user_dict = user_data.dict()
     user_dict["password"] = hashed_password
+    user_dict.update(user_search.search_fields(user.name))
     
-    await db.users.insert_one(user_dict)
-    
-    # Gerar token de acesso
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user_id}, expires_delta=access_token_expires
-    )
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        # Cadastro simultâneo com o mesmo email (índice único em users.email)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
     
-    return Token(
-        access_token=access_token,
-        token_type="bearer",
-        user_id=user_id,
-        name=user.name
-    )
+    # Gerar tokens de acesso e de atualização
+    return await issue_tokens(db, user_dict)
 
 @router.post("/login", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncIOMotorClient = Depends()):
@@ -125,18 +130,45 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncIOMot
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.id}, expires_delta=access_token_expires
-    )
+    return await issue_tokens(db, user)
+
+@router.post("/refresh", response_model=Token)
+async def refresh_tokens(refresh_data: RefreshRequest, db: AsyncIOMotorClient = Depends()):
+    # Validar o token de atualização e consumi-lo (cada token é usado uma única vez)
+    payload = decode_token(refresh_data.refresh_token, "refresh")
+    consumed = await db.refresh_tokens.delete_one({"jti": payload["jti"], "user_id": payload["sub"]})
+    if consumed.deleted_count != 1:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     
-    return Token(
-        access_token=access_token,
-        token_type="bearer",
-        user_id=user.id,
-        name=user.name,
-        avatar=user.avatar
-    )
+    # Recarregar o usuário para renovar as claims (nome, avatar, verificação)
+    user = await db.users.find_one({"id": payload["sub"]})
+    if not user or user.get("token_version", 0) != payload.get("ver", 0):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    
+    return await issue_tokens(db, user)
+
+@router.post("/logout")
+async def logout(logout_data: LogoutRequest, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
+    if logout_data.all_sessions or current_user.token_id is None:
+        # Encerrar todas as sessões do usuário (um token antigo, sem `jti`, não
+        # pode ser revogado sozinho)
+        await revoke_all_sessions(db, current_user.id)
+    else:
+        # Encerrar só esta sessão: o token de acesso atual e o de atualização informado
+        revocations.revoke(current_user.token_id, current_user.expires_at)
+        if logout_data.refresh_token:
+            payload = decode_token(logout_data.refresh_token, "refresh")
+            await db.refresh_tokens.delete_one({"jti": payload["jti"], "user_id": current_user.id})
+    
+    return {"message": "Logged out successfully"}
 
 @router.post("/password-reset")
 async def request_password_reset(reset_data: PasswordReset, background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends()):
@@ -176,17 +208,22 @@ async def update_password(password_data: PasswordUpdate, db: AsyncIOMotorClient
         )
     
     # Atualizar senha do usuário
-    hashed_password = get_password_hash(password_data.new_password)
-    await db.users.update_one(
+    hashed_password = await password_hasher.hash(password_data.new_password)
+    user = await db.users.find_one_and_update(
         {"email": reset_record["email"]},
-        {"$set": {"password": hashed_password}}
+        {"$set": {"password": hashed_password}},
+        projection={"_id": 0, "id": 1}
     )
     
+    # Encerrar as sessões abertas com a senha anterior
+    if user:
+        await revoke_all_sessions(db, user["id"])
+    
     # Remover token usado
     await db.password_resets.delete_one({"token": password_data.token})
     
     return {"message": "Password updated successfully"}
 
 @router.get("/me", response_model=UserProfile)
-async def get_current_user_profile(current_user: UserProfile = Depends(get_current_active_user)):
+async def get_current_user_profile(current_user: UserProfile = Depends(get_current_profile)):
     return current_user
\ No newline at end of file
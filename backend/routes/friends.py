@@ -1,17 +1,33 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import List
 from datetime import datetime
 
-from models import FriendRequest, FriendRequestCreate, FriendRequestUpdate, UserProfile, NotificationType
+from models import (
+    FriendRequest, FriendRequestCreate, FriendRequestUpdate, MutualCountsRequest, Principal, NotificationType,
+    FriendCard, Friend, FriendSuggestion, FriendRequestCard
+)
 from auth import get_current_active_user
+import timelines
+import indexes
+import friend_graph
+import suggestions
+import outbox
+import serializers
+from loaders import UserLoader, get_user_loader
 
 router = APIRouter(prefix="/friends", tags=["friends"])
 
+# Índices usados pelas consultas de amizades
+indexes.declare("friend_requests", [("id", 1)], unique=True)
+indexes.declare("friend_requests", [("requester_id", 1), ("status", 1)])
+indexes.declare("friend_requests", [("recipient_id", 1), ("status", 1)])
+indexes.declare("friend_requests", [("requester_id", 1), ("recipient_id", 1)])
+
 @router.post("/requests", status_code=status.HTTP_201_CREATED)
-async def send_friend_request(request_data: FriendRequestCreate, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def send_friend_request(request_data: FriendRequestCreate, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader)):
     # Verificar se o destinatário existe
-    recipient = await db.users.find_one({"id": request_data.recipient_id})
+    recipient = await users.load(request_data.recipient_id)
     if not recipient:
         raise HTTPException(status_code=404, detail="Recipient not found")
     
@@ -36,50 +52,37 @@ async def send_friend_request(request_data: FriendRequestCreate, db: AsyncIOMoto
     )
     
     await db.friend_requests.insert_one(friend_request.dict())
+    await suggestions.discard_candidate(db, current_user.id, request_data.recipient_id)
     
     # Criar notificação para o destinatário
-    notification = {
-        "id": str(uuid.uuid4()),
-        "recipient_id": request_data.recipient_id,
-        "sender_id": current_user.id,
-        "type": NotificationType.FRIEND_REQUEST,
-        "reference_id": friend_request.id,
-        "message": f"{current_user.name} sent you a friend request",
-        "is_read": False,
-        "created_at": datetime.utcnow()
-    }
-    
-    await db.notifications.insert_one(notification)
+    outbox.notify(request_data.recipient_id, current_user.id, current_user.name, NotificationType.FRIEND_REQUEST, friend_request.id)
     
     return {"message": "Friend request sent successfully"}
 
-@router.get("/requests", response_model=List[dict])
-async def get_friend_requests(db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+@router.get("/requests", response_model=List[FriendRequestCard])
+async def get_friend_requests(db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader)):
     # Buscar solicitações recebidas pendentes
     requests = await db.friend_requests.find({
         "recipient_id": current_user.id,
         "status": "pending"
     }).to_list(100)
     
-    # Adicionar informações do solicitante
-    result = []
-    for request in requests:
-        requester = await db.users.find_one({"id": request["requester_id"]})
-        if requester:
-            result.append({
-                "request_id": request["id"],
-                "requester": {
-                    "id": requester["id"],
-                    "name": requester["name"],
-                    "avatar": requester.get("avatar")
-                },
-                "created_at": request["created_at"]
-            })
+    # Buscar todos os solicitantes em uma única consulta
+    requesters = await users.load_many(request["requester_id"] for request in requests)
     
-    return result
+    # Adicionar informações do solicitante
+    return serializers.json_response([
+        {
+            "request_id": request["id"],
+            "requester": serializers.user_card(requesters[request["requester_id"]]),
+            "created_at": request["created_at"]
+        }
+        for request in requests
+        if requesters.get(request["requester_id"])
+    ])
 
 @router.put("/requests/{request_id}")
-async def respond_to_friend_request(request_id: str, response: FriendRequestUpdate, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def respond_to_friend_request(request_id: str, response: FriendRequestUpdate, background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Buscar solicitação
     request = await db.friend_requests.find_one({"id": request_id})
     if not request:
@@ -94,56 +97,41 @@ async def respond_to_friend_request(request_id: str, response: FriendRequestUpda
         {"id": request_id},
         {"$set": {"status": response.status, "updated_at": datetime.utcnow()}}
     )
+    friend_graph.graph.invalidate(request["requester_id"], request["recipient_id"])
+    await suggestions.discard_candidate(db, request["requester_id"], request["recipient_id"])
     
     # Se aceita, criar notificação para o solicitante
     if response.status == "accepted":
-        # Criar notificação
-        notification = {
-            "id": str(uuid.uuid4()),
-            "recipient_id": request["requester_id"],
-            "sender_id": current_user.id,
-            "type": NotificationType.FRIEND_ACCEPT,
-            "reference_id": request_id,
-            "message": f"{current_user.name} accepted your friend request",
-            "is_read": False,
-            "created_at": datetime.utcnow()
-        }
+        # Incluir os posts do novo amigo nas timelines dos dois usuários
+        background_tasks.add_task(timelines.rebuild_timeline, db, request["requester_id"])
+        background_tasks.add_task(timelines.rebuild_timeline, db, request["recipient_id"])
+        background_tasks.add_task(suggestions.mark_stale, db, request["requester_id"], request["recipient_id"])
         
-        await db.notifications.insert_one(notification)
+        # Criar notificação
+        outbox.notify(request["requester_id"], current_user.id, current_user.name, NotificationType.FRIEND_ACCEPT, request_id)
     
     return {"message": f"Friend request {response.status}"}
 
-@router.get("/", response_model=List[dict])
-async def get_friends(db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
-    # Buscar amizades aceitas
-    friendships = await db.friend_requests.find({
-        "$or": [
-            {"requester_id": current_user.id, "status": "accepted"},
-            {"recipient_id": current_user.id, "status": "accepted"}
-        ]
-    }).to_list(1000)
-    
-    # Buscar informações dos amigos
-    friends = []
-    for friendship in friendships:
-        friend_id = friendship["recipient_id"] if friendship["requester_id"] == current_user.id else friendship["requester_id"]
-        friend = await db.users.find_one({"id": friend_id})
-        
-        if friend:
-            friends.append({
-                "id": friend["id"],
-                "name": friend["name"],
-                "avatar": friend.get("avatar"),
-                "location": friend.get("location"),
-                "is_verified": friend.get("is_verified", False),
-                "friendship_id": friendship["id"],
-                "since": friendship["updated_at"]
-            })
-    
-    return friends
+@router.get("/", response_model=List[Friend])
+async def get_friends(db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader)):
+    # Buscar amizades aceitas no grafo de amizades
+    friendships = await friend_graph.graph.friends_of(db, current_user.id)
+    
+    # Buscar informações dos amigos em uma única consulta
+    friend_profiles = await users.load_many(friendships)
+    
+    return serializers.json_response([
+        serializers.friend_card(
+            friend_profiles[friend_id],
+            friendship_id=friendship["friendship_id"],
+            since=friendship["since"]
+        )
+        for friend_id, friendship in friendships.items()
+        if friend_profiles.get(friend_id)
+    ])
 
 @router.delete("/friends/{friendship_id}")
-async def remove_friend(friendship_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def remove_friend(friendship_id: str, background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Buscar amizade
     friendship = await db.friend_requests.find_one({"id": friendship_id})
     if not friendship:
@@ -155,116 +143,61 @@ async def remove_friend(friendship_id: str, db: AsyncIOMotorClient = Depends(),
     
     # Remover amizade
     await db.friend_requests.delete_one({"id": friendship_id})
+    friend_graph.graph.invalidate(friendship["requester_id"], friendship["recipient_id"])
+    
+    # Retirar os posts do ex-amigo das timelines dos dois usuários
+    background_tasks.add_task(timelines.rebuild_timeline, db, friendship["requester_id"])
+    background_tasks.add_task(timelines.rebuild_timeline, db, friendship["recipient_id"])
+    background_tasks.add_task(suggestions.mark_stale, db, friendship["requester_id"], friendship["recipient_id"])
     
     return {"message": "Friend removed successfully"}
 
-@router.get("/suggestions", response_model=List[dict])
-async def get_friend_suggestions(db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
-    # Buscar amigos atuais
-    friendships = await db.friend_requests.find({
-        "$or": [
-            {"requester_id": current_user.id, "status": "accepted"},
-            {"recipient_id": current_user.id, "status": "accepted"}
-        ]
-    }).to_list(1000)
-    
-    friend_ids = []
-    for friendship in friendships:
-        friend_id = friendship["recipient_id"] if friendship["requester_id"] == current_user.id else friendship["requester_id"]
-        friend_ids.append(friend_id)
-    
-    # Buscar amigos de amigos que não são amigos do usuário atual
-    suggestions = []
-    for friend_id in friend_ids:
-        friend_of_friend_ships = await db.friend_requests.find({
-            "$or": [
-                {"requester_id": friend_id, "status": "accepted"},
-                {"recipient_id": friend_id, "status": "accepted"}
-            ]
-        }).to_list(100)
-        
-        for friendship in friend_of_friend_ships:
-            suggestion_id = friendship["recipient_id"] if friendship["requester_id"] == friend_id else friendship["requester_id"]
-            
-            # Verificar se não é o usuário atual e não é um amigo atual
-            if suggestion_id != current_user.id and suggestion_id not in friend_ids:
-                # Verificar se já existe uma solicitação pendente
-                existing_request = await db.friend_requests.find_one({
-                    "$or": [
-                        {"requester_id": current_user.id, "recipient_id": suggestion_id},
-                        {"requester_id": suggestion_id, "recipient_id": current_user.id}
-                    ]
-                })
-                
-                if not existing_request:
-                    suggestion = await db.users.find_one({"id": suggestion_id})
-                    if suggestion:
-                        # Contar amigos em comum
-                        mutual_friends = [fid for fid in friend_ids if fid in [friendship["requester_id"], friendship["recipient_id"]]]
-                        
-                        suggestions.append({
-                            "id": suggestion["id"],
-                            "name": suggestion["name"],
-                            "avatar": suggestion.get("avatar"),
-                            "location": suggestion.get("location"),
-                            "mutual_friends": len(mutual_friends)
-                        })
-    
-    # Remover duplicatas e ordenar por número de amigos em comum
-    unique_suggestions = {}
-    for suggestion in suggestions:
-        if suggestion["id"] not in unique_suggestions or suggestion["mutual_friends"] > unique_suggestions[suggestion["id"]]["mutual_friends"]:
-            unique_suggestions[suggestion["id"]] = suggestion
-    
-    return sorted(list(unique_suggestions.values()), key=lambda x: x["mutual_friends"], reverse=True)[:20]
+@router.get("/suggestions", response_model=List[FriendSuggestion])
+async def get_friend_suggestions(background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader)):
+    # Sugestões pré-calculadas (python cli.py refresh-suggestions)
+    stored = await db.friend_suggestions.find_one({"user_id": current_user.id}, {"_id": 0, "candidates": 1, "stale": 1})
+    
+    if stored is None:
+        # Usuário ainda não processado: calcular agora e guardar
+        candidates = await suggestions.refresh_user(db, current_user.id)
+    else:
+        candidates = stored["candidates"]
+        if stored.get("stale"):
+            # Amizades mudaram: servir a versão anterior e recalcular em segundo plano
+            background_tasks.add_task(suggestions.refresh_user, db, current_user.id)
+    
+    candidates = [(candidate["id"], candidate["mutual_friends"]) for candidate in candidates[:20]]
+    
+    # Buscar os perfis sugeridos em uma única consulta
+    profiles = await users.load_many(suggestion_id for suggestion_id, _ in candidates)
+    
+    return serializers.json_response([
+        serializers.friend_card(profiles[suggestion_id], mutual_friends=mutual_count)
+        for suggestion_id, mutual_count in candidates
+        if profiles.get(suggestion_id)
+    ])
 
-@router.get("/{user_id}/mutual", response_model=List[dict])
-async def get_mutual_friends(user_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+@router.post("/mutual-counts")
+async def get_mutual_counts(request_data: MutualCountsRequest, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
+    # Contagens de amigos em comum com vários usuários de uma vez (resultados de busca, sugestões)
+    counts = await friend_graph.graph.mutual_counts(db, current_user.id, request_data.user_ids)
+    return {"counts": counts}
+
+@router.get("/{user_id}/mutual", response_model=List[FriendCard])
+async def get_mutual_friends(user_id: str, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader)):
     # Verificar se o usuário existe
-    user = await db.users.find_one({"id": user_id})
+    user = await users.load(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Buscar amigos do usuário atual
-    current_user_friendships = await db.friend_requests.find({
-        "$or": [
-            {"requester_id": current_user.id, "status": "accepted"},
-            {"recipient_id": current_user.id, "status": "accepted"}
-        ]
-    }).to_list(1000)
-    
-    current_user_friend_ids = []
-    for friendship in current_user_friendships:
-        friend_id = friendship["recipient_id"] if friendship["requester_id"] == current_user.id else friendship["requester_id"]
-        current_user_friend_ids.append(friend_id)
-    
-    # Buscar amigos do outro usuário
-    other_user_friendships = await db.friend_requests.find({
-        "$or": [
-            {"requester_id": user_id, "status": "accepted"},
-            {"recipient_id": user_id, "status": "accepted"}
-        ]
-    }).to_list(1000)
-    
-    other_user_friend_ids = []
-    for friendship in other_user_friendships:
-        friend_id = friendship["recipient_id"] if friendship["requester_id"] == user_id else friendship["requester_id"]
-        other_user_friend_ids.append(friend_id)
-    
-    # Encontrar amigos em comum
-    mutual_friend_ids = [fid for fid in current_user_friend_ids if fid in other_user_friend_ids]
+    # Encontrar amigos em comum no grafo de amizades
+    mutual_friend_ids = await friend_graph.graph.mutual_friends(db, current_user.id, user_id)
     
-    # Buscar informações dos amigos em comum
-    mutual_friends = []
-    for friend_id in mutual_friend_ids:
-        friend = await db.users.find_one({"id": friend_id})
-        if friend:
-            mutual_friends.append({
-                "id": friend["id"],
-                "name": friend["name"],
-                "avatar": friend.get("avatar"),
-                "location": friend.get("location"),
-                "is_verified": friend.get("is_verified", False)
-            })
+    # Buscar informações dos amigos em comum em uma única consulta
+    mutual_profiles = await users.load_many(mutual_friend_ids)
     
-    return mutual_friends
\ No newline at end of file
+    return serializers.json_response([
+        serializers.friend_card(mutual_profiles[friend_id])
+        for friend_id in mutual_friend_ids
+        if mutual_profiles.get(friend_id)
+    ])
\ No newline at end of file
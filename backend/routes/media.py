@@ -0,0 +1,110 @@
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Response
+from motor.motor_asyncio import AsyncIOMotorClient
+from typing import List
+import asyncio
+import hmac
+import mimetypes
+import os
+import time
+import uuid
+
+from models import Principal, UploadTargetsRequest
+from auth import get_current_active_user
+from storage import media_storage, LocalStorage
+import media_blobs
+
+router = APIRouter(prefix="/media", tags=["media"])
+
+# Limites dos uploads diretos ao armazenamento
+MEDIA_MAX_UPLOAD_BYTES = int(os.environ.get("MEDIA_MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+
+# Pasta de cada finalidade de upload; as chaves ficam sob a pasta do usuário
+UPLOAD_FOLDERS = {
+    "post": "posts/{user_id}",
+    "avatar": "users/{user_id}/avatar",
+    "cover": "users/{user_id}/cover"
+}
+
+def upload_folder(purpose: str, user_id: str) -> str:
+    if purpose not in UPLOAD_FOLDERS:
+        raise HTTPException(status_code=400, detail="Invalid upload purpose")
+    return UPLOAD_FOLDERS[purpose].format(user_id=user_id)
+
+async def resolve_uploads(db: AsyncIOMotorClient, keys: List[str], purpose: str, user_id: str) -> List[str]:
+    """
+    Confere as chaves enviadas pelo cliente depois do upload direto (pasta do
+    usuário, arquivo existente, imagem e dentro do limite), registra as
+    referências e devolve as URLs públicas
+    """
+    folder = upload_folder(purpose, user_id) + "/"
+    for key in keys:
+        if not key.startswith(folder) or ".." in key:
+            raise HTTPException(status_code=403, detail="Not authorized to use this upload")
+    
+    # Conferir todos os arquivos em paralelo
+    uploads = await asyncio.gather(*(media_storage.exists(key) for key in keys))
+    for upload in uploads:
+        if upload is None:
+            raise HTTPException(status_code=400, detail="Upload not found")
+        if upload["size"] > MEDIA_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=400, detail="File too large")
+        if not (upload["content_type"] or "").startswith("image/"):
+            raise HTTPException(status_code=400, detail="File must be an image")
+    
+    await media_blobs.register_keys(db, keys, [upload["size"] for upload in uploads])
+    return [media_storage.url(key) for key in keys]
+
+async def resolve_upload_urls(db: AsyncIOMotorClient, urls: List[str], purpose: str, user_id: str) -> List[str]:
+    """Como `resolve_uploads`, para as URLs públicas de arquivos enviados direto ao armazenamento"""
+    keys = [media_storage.key_from_url(url) for url in urls]
+    if None in keys:
+        raise HTTPException(status_code=400, detail="Image must be uploaded through /media/uploads")
+    return await resolve_uploads(db, keys, purpose, user_id)
+
+@router.post("/uploads")
+async def create_upload_targets(request_data: UploadTargetsRequest, current_user: Principal = Depends(get_current_active_user)):
+    """
+    Gera destinos de upload direto ao armazenamento. O cliente envia cada
+    arquivo com um POST multipart para `url` com os `fields` devolvidos e
+    depois informa as chaves ao criar o post ou trocar o avatar/capa.
+    """
+    folder = upload_folder(request_data.purpose, current_user.id)
+    
+    targets = []
+    for spec in request_data.files:
+        # Validar tipo e tamanho; o armazenamento impõe os mesmos limites no upload
+        if not spec.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail="File must be an image")
+        if spec.size <= 0 or spec.size > MEDIA_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=400, detail="File too large")
+        
+        extension = mimetypes.guess_extension(spec.content_type) or ""
+        key = f"{folder}/{uuid.uuid4()}{extension}"
+        target = await media_storage.presign_upload(key, spec.content_type, spec.size)
+        targets.append({"key": key, "url": target["url"], "fields": target["fields"]})
+    
+    return {"uploads": targets}
+
+@router.post("/uploads/local", status_code=status.HTTP_204_NO_CONTENT)
+async def local_upload(key: str = Form(...), content_type: str = Form(..., alias="Content-Type"), max_size: int = Form(...), expires: int = Form(...), signature: str = Form(...), file: UploadFile = File(...)):
+    """Recebe os uploads diretos quando o armazenamento é local (mesmo contrato do POST do S3)"""
+    backend = media_storage.backend
+    if not isinstance(backend, LocalStorage):
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    # Validar a assinatura e a validade do destino
+    expected = backend.sign(key, content_type, max_size, expires)
+    if not hmac.compare_digest(expected, signature):
+        raise HTTPException(status_code=403, detail="Invalid upload signature")
+    if expires < time.time():
+        raise HTTPException(status_code=403, detail="Upload target expired")
+    
+    # Validar o tamanho do arquivo recebido
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+    if size == 0 or size > max_size:
+        raise HTTPException(status_code=400, detail="File size outside the allowed range")
+    
+    await media_storage.put(key, file.file, content_type)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -1,55 +1,56 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response
 from motor.motor_asyncio import AsyncIOMotorClient
-from typing import List
-import uuid
-from datetime import datetime
+from typing import List, Optional
 
-from models import Notification, NotificationType
+from models import NotificationOut
 from auth import get_current_active_user
+from loaders import UserLoader, get_user_loader
+import pagination
+import indexes
+import serializers
+import unread_counters
 
 router = APIRouter(prefix="/notifications", tags=["notifications"])
 
-@router.get("/", response_model=List[dict])
-async def get_notifications(skip: int = 0, limit: int = 20, db: AsyncIOMotorClient = Depends(), current_user = Depends(get_current_active_user)):
+# Índices usados pelas consultas de notificações
+indexes.declare("notifications", [("id", 1)], unique=True)
+indexes.declare("notifications", [("recipient_id", 1), ("created_at", -1), ("id", -1)])
+indexes.declare("notifications", [("recipient_id", 1), ("is_read", 1), ("created_at", -1)])
+
+@router.get("/", response_model=List[NotificationOut])
+async def get_notifications(response: Response, skip: int = 0, limit: int = 20, cursor: Optional[str] = None, db: AsyncIOMotorClient = Depends(), current_user = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader)):
     """
-    Retorna as notificações do usuário atual, ordenadas por data (mais recentes primeiro)
+    Retorna as notificações do usuário atual, ordenadas por data (mais recentes primeiro).
+    Aceita `cursor` (cabeçalho X-Next-Cursor da página anterior) no lugar de `skip`.
     """
-    notifications = await db.notifications.find({
+    notifications = db.notifications.find(pagination.paginate_query({
         "recipient_id": current_user.id
-    }).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
+    }, cursor)).sort(pagination.keyset_sort())
+    if not cursor:
+        notifications = notifications.skip(skip)
+    notifications = await notifications.limit(limit).to_list(limit)
+    pagination.set_next_cursor(response, pagination.next_cursor(notifications, limit))
     
-    # Adicionar informações do remetente para cada notificação
-    result = []
-    for notification in notifications:
-        # Buscar informações do remetente
-        sender = await db.users.find_one({"id": notification["sender_id"]})
-        
-        notification_dict = {
-            "id": notification["id"],
-            "type": notification["type"],
-            "message": notification["message"],
-            "reference_id": notification.get("reference_id"),
-            "is_read": notification.get("is_read", False),
-            "created_at": notification["created_at"],
-            "sender": {
-                "id": sender["id"],
-                "name": sender["name"],
-                "avatar": sender.get("avatar")
-            } if sender else None
-        }
-        result.append(notification_dict)
+    # Buscar todos os remetentes (inclusive os últimos de cada grupo) em uma única consulta
+    senders = await users.load_many(
+        actor_id
+        for notification in notifications
+        for actor_id in [notification["sender_id"], *notification.get("actor_ids", [])]
+    )
     
-    return result
+    # Adicionar informações do remetente para cada notificação
+    return serializers.json_response(
+        [serializers.notification(notification, senders) for notification in notifications],
+        response
+    )
 
 @router.get("/unread-count")
 async def get_unread_notifications_count(db: AsyncIOMotorClient = Depends(), current_user = Depends(get_current_active_user)):
     """
     Retorna o número de notificações não lidas do usuário atual
+    (uma notificação agrupada conta uma vez, como aparece na lista)
     """
-    count = await db.notifications.count_documents({
-        "recipient_id": current_user.id,
-        "is_read": False
-    })
+    count = await unread_counters.counters.get(db, current_user.id)
     
     return {"count": count}
 
@@ -67,11 +68,13 @@ async def mark_notification_as_read(notification_id: str, db: AsyncIOMotorClient
     if not notification:
         raise HTTPException(status_code=404, detail="Notification not found")
     
-    # Marcar como lida
-    await db.notifications.update_one(
-        {"id": notification_id},
+    # Marcar como lida (o contador só muda se ela ainda não estava lida)
+    result = await db.notifications.update_one(
+        {"id": notification_id, "is_read": False},
         {"$set": {"is_read": True}}
     )
+    if result.modified_count:
+        await unread_counters.counters.decrement(db, current_user.id)
     
     return {"message": "Notification marked as read"}
 
@@ -84,6 +87,7 @@ async def mark_all_notifications_as_read(db: AsyncIOMotorClient = Depends(), cur
         {"recipient_id": current_user.id, "is_read": False},
         {"$set": {"is_read": True}}
     )
+    await unread_counters.counters.reset(db, current_user.id)
     
     return {"message": "All notifications marked as read"}
 
@@ -102,7 +106,9 @@ async def delete_notification(notification_id: str, db: AsyncIOMotorClient = Dep
         raise HTTPException(status_code=404, detail="Notification not found")
     
     # Excluir notificação
-    await db.notifications.delete_one({"id": notification_id})
+    deleted = await db.notifications.find_one_and_delete({"id": notification_id}, {"_id": 0, "is_read": 1})
+    if deleted and not deleted.get("is_read", False):
+        await unread_counters.counters.decrement(db, current_user.id)
     
     return {"message": "Notification deleted"}
 
@@ -112,48 +118,6 @@ async def delete_all_notifications(db: AsyncIOMotorClient = Depends(), current_u
     Exclui todas as notificações do usuário atual
     """
     await db.notifications.delete_many({"recipient_id": current_user.id})
+    await unread_counters.counters.reset(db, current_user.id)
     
     return {"message": "All notifications deleted"}
-
-# Função auxiliar para criar notificações (pode ser usada por outros módulos)
-async def create_notification(db: AsyncIOMotorClient, recipient_id: str, sender_id: str, 
-                             notification_type: NotificationType, reference_id: str = None, 
-                             message: str = None):
-    """
-    Cria uma nova notificação
-    """
-    # Gerar mensagem padrão se não for fornecida
-    if not message:
-        # Buscar informações do remetente
-        sender = await db.users.find_one({"id": sender_id})
-        sender_name = sender["name"] if sender else "Someone"
-        
-        # Gerar mensagem com base no tipo de notificação
-        if notification_type == NotificationType.FRIEND_REQUEST:
-            message = f"{sender_name} sent you a friend request"
-        elif notification_type == NotificationType.FRIEND_ACCEPT:
-            message = f"{sender_name} accepted your friend request"
-        elif notification_type == NotificationType.POST_LIKE:
-            message = f"{sender_name} liked your post"
-        elif notification_type == NotificationType.POST_COMMENT:
-            message = f"{sender_name} commented on your post"
-        elif notification_type == NotificationType.COMMENT_LIKE:
-            message = f"{sender_name} liked your comment"
-        elif notification_type == NotificationType.POST_SHARE:
-            message = f"{sender_name} shared your post"
-        else:
-            message = f"You have a new notification from {sender_name}"
-    
-    # Criar notificação
-    notification = Notification(
-        recipient_id=recipient_id,
-        sender_id=sender_id,
-        type=notification_type,
-        reference_id=reference_id,
-        message=message
-    )
-    
-    # Salvar no banco de dados
-    await db.notifications.insert_one(notification.dict())
-    
-    return notification.dict()
\ No newline at end of file
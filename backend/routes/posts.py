@@ -1,67 +1,81 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form, Response, Header, Request, BackgroundTasks
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import List, Optional
-import boto3
-import os
-import uuid
 from datetime import datetime
-import json
+import itertools
 
-from models import Post, PostCreate, PostUpdate, Comment, CommentCreate, UserProfile, NotificationType, PrivacyLevel
+from models import (
+    Post, PostUpdate, Comment, CommentCreate, Principal, NotificationType, PrivacyLevel,
+    FeedPost, PostDetail, CommentOut, PostLiker
+)
 from auth import get_current_active_user
+import timelines
+import pagination
+import indexes
+import comments
+import reactions
+import derivatives
+import media_blobs
+import outbox
+import post_search
+import serializers
+from loaders import UserLoader, get_user_loader
+from visibility import PostVisibility
+from routes.media import resolve_uploads
 
 router = APIRouter(prefix="/posts", tags=["posts"])
 
-# Configuração do S3 para upload de imagens
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-    region_name=os.environ.get('AWS_REGION')
-)
-BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
+# Índices usados pelas consultas de posts
+indexes.declare("posts", [("id", 1)], unique=True)
+indexes.declare("posts", [("author_id", 1), ("created_at", -1), ("id", -1)])
+indexes.declare("posts", [("privacy", 1), ("created_at", -1), ("id", -1)])
 
-# Função para upload de imagem para o S3
-async def upload_image_to_s3(file: UploadFile, folder: str) -> str:
-    file_extension = file.filename.split('.')[-1]
-    file_name = f"{folder}/{uuid.uuid4()}.{file_extension}"
-    
-    s3_client.upload_fileobj(
-        file.file,
-        BUCKET_NAME,
-        file_name,
-        ExtraArgs={
-            "ContentType": file.content_type,
-            "ACL": "public-read"
-        }
-    )
-    
-    return f"https://{BUCKET_NAME}.s3.amazonaws.com/{file_name}"
+def get_post_visibility(request: Request, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)) -> PostVisibility:
+    """Dependência que devolve as regras de visibilidade do leitor da requisição"""
+    visibility = getattr(request.state, "post_visibility", None)
+    if visibility is None:
+        visibility = PostVisibility(db, current_user.id)
+        request.state.post_visibility = visibility
+    return visibility
 
 @router.post("/", status_code=status.HTTP_201_CREATED)
-async def create_post(content: str = Form(...), 
+async def create_post(background_tasks: BackgroundTasks,
+                     content: str = Form(...), 
                      privacy: PrivacyLevel = Form(PrivacyLevel.FRIENDS),
                      files: List[UploadFile] = File(None),
+                     media_keys: List[str] = Form(None),
                      db: AsyncIOMotorClient = Depends(), 
-                     current_user: UserProfile = Depends(get_current_active_user)):
-    # Upload de arquivos, se houver
+                     current_user: Principal = Depends(get_current_active_user)):
+    # Imagens já enviadas direto ao armazenamento (POST /media/uploads)
     media_urls = []
+    if media_keys:
+        media_urls = await resolve_uploads(db, media_keys, "post", current_user.id)
+    
+    # Upload das imagens enviadas pela API, se houver, todas em paralelo
+    # (conteúdo já armazenado é reaproveitado pelo registro de mídia)
     if files:
-        for file in files:
-            if file.content_type.startswith('image/'):
-                media_url = await upload_image_to_s3(file, f"posts/{current_user.id}")
-                media_urls.append(media_url)
+        images = [file for file in files if file.content_type.startswith('image/')]
+        media_urls += await media_blobs.store_uploads(db, images, f"posts/{current_user.id}")
     
     # Criar post
     post = Post(
         author_id=current_user.id,
         content=content,
         media_urls=media_urls,
+        media=[{"url": url, "variants": {}} for url in media_urls],
         privacy=privacy
     )
     
     await db.posts.insert_one(post.dict())
     
+    # Gerar as versões redimensionadas das imagens depois da resposta
+    if media_urls:
+        background_tasks.add_task(derivatives.processor.process_post, db, post.id, media_urls)
+    
+    # Distribuir o post nas timelines do autor e dos amigos
+    await timelines.fan_out_post(db, post.dict())
+    await post_search.publish_post(post.dict())
+    
     # Adicionar informações do autor para retorno
     post_dict = post.dict()
     post_dict["author"] = {
@@ -73,186 +87,169 @@ async def create_post(content: str = Form(...),
     
     return post_dict
 
-@router.get("/", response_model=List[dict])
-async def get_feed(skip: int = 0, limit: int = 10, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
-    # Buscar amigos do usuário
-    friendships = await db.friend_requests.find({
-        "$or": [
-            {"requester_id": current_user.id, "status": "accepted"},
-            {"recipient_id": current_user.id, "status": "accepted"}
-        ]
-    }).to_list(1000)
-    
-    friend_ids = []
-    for friendship in friendships:
-        friend_id = friendship["recipient_id"] if friendship["requester_id"] == current_user.id else friendship["requester_id"]
-        friend_ids.append(friend_id)
-    
-    # Buscar posts do usuário e de seus amigos
-    posts = await db.posts.find({
-        "$or": [
-            # Posts do próprio usuário
-            {"author_id": current_user.id},
-            # Posts públicos
-            {"privacy": "public"},
-            # Posts de amigos com privacidade para amigos
-            {"author_id": {"$in": friend_ids}, "privacy": "friends"}
-        ]
-    }).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    
-    # Adicionar informações do autor e contagem de comentários
-    result = []
-    for post in posts:
-        author = await db.users.find_one({"id": post["author_id"]})
-        if author:
-            post_dict = {
-                "id": post["id"],
-                "content": post["content"],
-                "media_urls": post.get("media_urls", []),
-                "created_at": post["created_at"],
-                "updated_at": post["updated_at"],
-                "likes": post.get("likes", []),
-                "like_count": len(post.get("likes", [])),
-                "comment_count": len(post.get("comments", [])),
-                "share_count": post.get("shares", 0),
-                "author": {
-                    "id": author["id"],
-                    "name": author["name"],
-                    "avatar": author.get("avatar"),
-                    "is_verified": author.get("is_verified", False)
-                },
-                "is_liked": current_user.id in post.get("likes", [])
-            }
-            result.append(post_dict)
+@router.get("/", response_model=List[FeedPost])
+async def get_feed(response: Response, skip: int = 0, limit: int = 10, cursor: Optional[str] = None, size: Optional[str] = "feed", db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader), visibility: PostVisibility = Depends(get_post_visibility)):
+    # Ler os ids do feed já ordenados a partir da timeline materializada
+    entries = await timelines.read_timeline(db, current_user.id, skip, limit, cursor, visibility)
+    post_ids = [entry["post_id"] for entry in entries]
+    
+    # Cursor da próxima página a partir da última entrada
+    if len(entries) == limit:
+        pagination.set_next_cursor(response, pagination.encode_cursor(entries[-1]["created_at"], entries[-1]["post_id"]))
+    
+    # Hidratar os posts mantendo a ordem da timeline
+    posts_by_id = {
+        post["id"]: post
+        for post in await db.posts.find({"id": {"$in": post_ids}}).to_list(None)
+    }
+    posts = [posts_by_id[post_id] for post_id in post_ids if post_id in posts_by_id]
     
-    return result
+    # Descartar posts cuja privacidade mudou depois de entrarem na timeline
+    posts = await visibility.filter_visible(posts)
+    
+    # Buscar todos os autores da página (posts e prévias de comentários) em uma única consulta
+    authors = await users.load_many(
+        [post["author_id"] for post in posts] +
+        [comment["author_id"] for post in posts for comment in comments.latest_comments(post)]
+    )
+    
+    # Curtidas do usuário na página inteira em uma única consulta
+    liked = await reactions.liked_ids(db, current_user.id, posts)
+    
+    return serializers.json_response(serializers.feed_posts(posts, authors, liked, size), response)
 
-@router.get("/user/{user_id}", response_model=List[dict])
-async def get_user_posts(user_id: str, skip: int = 0, limit: int = 10, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+@router.get("/user/{user_id}", response_model=List[FeedPost])
+async def get_user_posts(user_id: str, response: Response, skip: int = 0, limit: int = 10, cursor: Optional[str] = None, size: Optional[str] = "feed", db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader), visibility: PostVisibility = Depends(get_post_visibility)):
     # Verificar se o usuário existe
-    user = await db.users.find_one({"id": user_id})
+    user = await users.load(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Verificar relação de amizade para determinar quais posts podem ser vistos
-    is_friend = False
-    if user_id != current_user.id:
-        friendship = await db.friend_requests.find_one({
-            "$or": [
-                {"requester_id": current_user.id, "recipient_id": user_id, "status": "accepted"},
-                {"requester_id": user_id, "recipient_id": current_user.id, "status": "accepted"}
-            ]
-        })
-        is_friend = friendship is not None
-    
-    # Construir query baseada na relação
-    query = {"author_id": user_id}
-    if user_id != current_user.id:
-        if is_friend:
-            query["privacy"] = {"$in": ["public", "friends"]}
-        else:
-            query["privacy"] = "public"
-    
-    # Buscar posts
-    posts = await db.posts.find(query).sort("created_at", -1).skip(skip).limit(limit).to_list(limit)
-    
-    # Adicionar informações do autor e contagem de comentários
-    result = []
-    for post in posts:
-        post_dict = {
-            "id": post["id"],
-            "content": post["content"],
-            "media_urls": post.get("media_urls", []),
-            "created_at": post["created_at"],
-            "updated_at": post["updated_at"],
-            "likes": post.get("likes", []),
-            "like_count": len(post.get("likes", [])),
-            "comment_count": len(post.get("comments", [])),
-            "share_count": post.get("shares", 0),
-            "author": {
-                "id": user["id"],
-                "name": user["name"],
-                "avatar": user.get("avatar"),
-                "is_verified": user.get("is_verified", False)
-            },
-            "is_liked": current_user.id in post.get("likes", [])
-        }
-        result.append(post_dict)
+    # Query com os níveis de privacidade visíveis ao usuário atual
+    query = await visibility.mongo_filter([user_id])
     
-    return result
+    # Buscar posts (faixa sobre author_id + created_at quando há cursor)
+    posts = db.posts.find(pagination.paginate_query(query, cursor)).sort(pagination.keyset_sort())
+    if not cursor:
+        posts = posts.skip(skip)
+    posts = await posts.limit(limit).to_list(limit)
+    pagination.set_next_cursor(response, pagination.next_cursor(posts, limit))
+    
+    # Buscar os autores das prévias de comentários em uma única consulta
+    authors = await users.load_many(
+        comment["author_id"] for post in posts for comment in comments.latest_comments(post)
+    )
+    
+    # Curtidas do usuário na página inteira em uma única consulta
+    liked = await reactions.liked_ids(db, current_user.id, posts)
+    
+    return serializers.json_response(serializers.feed_posts(posts, {**authors, user_id: user}, liked, size), response)
+
+@router.get("/search", response_model=List[FeedPost])
+async def search_posts(q: str, response: Response, limit: int = 10, cursor: Optional[str] = None, size: Optional[str] = "feed", db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader), visibility: PostVisibility = Depends(get_post_visibility)):
+    """
+    Busca posts que contêm todas as palavras de `q`, dos mais recentes aos mais
+    antigos, entre os que o usuário atual pode ver. Aceita `cursor` (cabeçalho
+    X-Next-Cursor da página anterior).
+    """
+    if not post_search.index.ready:
+        raise HTTPException(status_code=503, detail="Search index is loading", headers={"Retry-After": "10"})
+    
+    before = None
+    if cursor:
+        created_at, post_id = pagination.decode_cursor(cursor)
+        before = (post_search.timestamp(created_at), post_id)
+    
+    # Aplicar a privacidade aos candidatos do índice, em lotes, até completar a página
+    candidates = post_search.index.search(q, before)
+    visible = []
+    while len(visible) < limit:
+        batch = list(itertools.islice(candidates, 4 * limit))
+        if not batch:
+            break
+        visible += await visibility.filter_visible(batch)
+    visible = visible[:limit]
+    
+    # Hidratar os posts mantendo a ordem da busca (e conferir a privacidade atual)
+    posts_by_id = {
+        post["id"]: post
+        for post in await db.posts.find({"id": {"$in": [post["id"] for post in visible]}}).to_list(None)
+    }
+    posts = await visibility.filter_visible([posts_by_id[post["id"]] for post in visible if post["id"] in posts_by_id])
+    if len(visible) == limit:
+        last = posts_by_id.get(visible[-1]["id"])
+        if last:
+            pagination.set_next_cursor(response, pagination.encode_cursor(last["created_at"], last["id"]))
+    
+    # Buscar todos os autores da página (posts e prévias de comentários) em uma única consulta
+    authors = await users.load_many(
+        [post["author_id"] for post in posts] +
+        [comment["author_id"] for post in posts for comment in comments.latest_comments(post)]
+    )
+    
+    # Curtidas do usuário na página inteira em uma única consulta
+    liked = await reactions.liked_ids(db, current_user.id, posts)
+    
+    return serializers.json_response(serializers.feed_posts(posts, authors, liked, size), response)
 
-@router.get("/{post_id}", response_model=dict)
-async def get_post(post_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+@router.get("/{post_id}", response_model=PostDetail)
+async def get_post(post_id: str, size: Optional[str] = None, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader), visibility: PostVisibility = Depends(get_post_visibility)):
     # Buscar post
     post = await db.posts.find_one({"id": post_id})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
     # Verificar permissão para ver o post
-    if post["author_id"] != current_user.id:
-        if post["privacy"] == "private":
-            raise HTTPException(status_code=403, detail="Not authorized to view this post")
-        elif post["privacy"] == "friends":
-            # Verificar se são amigos
-            friendship = await db.friend_requests.find_one({
-                "$or": [
-                    {"requester_id": current_user.id, "recipient_id": post["author_id"], "status": "accepted"},
-                    {"requester_id": post["author_id"], "recipient_id": current_user.id, "status": "accepted"}
-                ]
-            })
-            if not friendship:
-                raise HTTPException(status_code=403, detail="Not authorized to view this post")
-    
-    # Buscar informações do autor
-    author = await db.users.find_one({"id": post["author_id"]})
-    
-    # Montar resposta
-    post_dict = {
-        "id": post["id"],
-        "content": post["content"],
-        "media_urls": post.get("media_urls", []),
-        "created_at": post["created_at"],
-        "updated_at": post["updated_at"],
-        "likes": post.get("likes", []),
-        "like_count": len(post.get("likes", [])),
-        "comments": [],
-        "share_count": post.get("shares", 0),
-        "author": {
-            "id": author["id"],
-            "name": author["name"],
-            "avatar": author.get("avatar"),
-            "is_verified": author.get("is_verified", False)
-        },
-        "is_liked": current_user.id in post.get("likes", [])
-    }
+    await visibility.require(post)
     
-    # Adicionar comentários com informações do autor
-    for comment in post.get("comments", []):
-        comment_author = await db.users.find_one({"id": comment["author_id"]})
-        if comment_author:
-            comment_dict = {
-                "id": comment["id"],
-                "content": comment["content"],
-                "created_at": comment["created_at"],
-                "likes": comment.get("likes", []),
-                "like_count": len(comment.get("likes", [])),
-                "author": {
-                    "id": comment_author["id"],
-                    "name": comment_author["name"],
-                    "avatar": comment_author.get("avatar"),
-                    "is_verified": comment_author.get("is_verified", False)
-                },
-                "is_liked": current_user.id in comment.get("likes", [])
-            }
-            post_dict["comments"].append(comment_dict)
-    
-    # Ordenar comentários por data
-    post_dict["comments"].sort(key=lambda x: x["created_at"])
+    # Buscar os últimos comentários; os demais são paginados em /{post_id}/comments
+    recent_comments = await comments.recent_comments(db, post)
     
-    return post_dict
+    # Curtidas do usuário no post e nos comentários em uma única consulta
+    liked = await reactions.liked_ids(db, current_user.id, [post] + recent_comments)
+    
+    # Buscar o autor do post e os autores dos comentários em uma única consulta
+    authors = await users.load_many(
+        [post["author_id"]] + [comment["author_id"] for comment in recent_comments]
+    )
+    
+    return serializers.json_response(serializers.post_detail(post, recent_comments, authors, liked, size))
+
+@router.get("/{post_id}/comments", response_model=List[CommentOut])
+async def get_comments(post_id: str, response: Response, limit: int = 20, cursor: Optional[str] = None, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader), visibility: PostVisibility = Depends(get_post_visibility)):
+    """
+    Lista os comentários do post em ordem cronológica, paginados por cursor
+    (cabeçalho X-Next-Cursor)
+    """
+    # Buscar post
+    post = await db.posts.find_one({"id": post_id}, {"_id": 0, "id": 1, "author_id": 1, "privacy": 1, "comments": 1})
+    if not post:
+        raise HTTPException(status_code=404, detail="Post not found")
+    
+    # Verificar permissão para ver o post
+    await visibility.require(post)
+    
+    # Buscar a página de comentários (faixa sobre post_id + created_at)
+    page = await db.comments.find(
+        pagination.paginate_query({"post_id": post_id}, cursor, descending=False)
+    ).sort(pagination.keyset_sort(descending=False)).limit(limit).to_list(limit)
+    if post.get("comments"):
+        # Post ainda não migrado para a coleção de comentários
+        page = comments.merge_embedded(post, page, cursor, limit)
+    pagination.set_next_cursor(response, pagination.next_cursor(page, limit))
+    
+    # Buscar os autores e as curtidas do usuário na página
+    authors = await users.load_many(comment["author_id"] for comment in page)
+    liked = await reactions.liked_ids(db, current_user.id, page)
+    
+    return serializers.json_response([
+        serializers.comment(comment, authors[comment["author_id"]], comment["id"] in liked)
+        for comment in page
+        if authors.get(comment["author_id"])
+    ], response)
 
 @router.put("/{post_id}")
-async def update_post(post_id: str, post_update: PostUpdate, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def update_post(post_id: str, post_update: PostUpdate, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Buscar post
     post = await db.posts.find_one({"id": post_id})
     if not post:
@@ -272,8 +269,9 @@ async def update_post(post_id: str, post_update: PostUpdate, db: AsyncIOMotorCli
             {"$set": update_data}
         )
     
-    # Retornar post atualizado
+    # Retornar post atualizado (e reindexar o conteúdo e a privacidade)
     updated_post = await db.posts.find_one({"id": post_id})
+    await post_search.publish_post(updated_post)
     
     return {
         "id": updated_post["id"],
@@ -284,7 +282,7 @@ async def update_post(post_id: str, post_update: PostUpdate, db: AsyncIOMotorCli
     }
 
 @router.delete("/{post_id}")
-async def delete_post(post_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def delete_post(post_id: str, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Buscar post
     post = await db.posts.find_one({"id": post_id})
     if not post:
@@ -297,121 +295,106 @@ async def delete_post(post_id: str, db: AsyncIOMotorClient = Depends(), current_
     # Excluir post
     await db.posts.delete_one({"id": post_id})
     
+    # Retirar o post das timelines e da busca e excluir seus comentários
+    await timelines.retract_post(db, post_id)
+    await post_search.publish_delete(post_id)
+    comment_ids = await db.comments.distinct("id", {"post_id": post_id})
+    await db.comments.delete_many({"post_id": post_id})
+    await db.reactions.delete_many({"target_id": {"$in": [post_id] + comment_ids}})
+    
+    # Liberar as imagens do post (os arquivos sem referências são varridos depois)
+    await media_blobs.release(db, post.get("media_urls") or [])
+    
     return {"message": "Post deleted successfully"}
 
 @router.post("/{post_id}/like")
-async def like_post(post_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def like_post(post_id: str, idempotency_key: Optional[str] = Header(None), db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), visibility: PostVisibility = Depends(get_post_visibility)):
     # Buscar post
-    post = await db.posts.find_one({"id": post_id})
+    post = await db.posts.find_one({"id": post_id}, {"_id": 0, "id": 1, "author_id": 1, "privacy": 1})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
     # Verificar permissão para ver o post
-    if post["author_id"] != current_user.id:
-        if post["privacy"] == "private":
-            raise HTTPException(status_code=403, detail="Not authorized to view this post")
-        elif post["privacy"] == "friends":
-            # Verificar se são amigos
-            friendship = await db.friend_requests.find_one({
-                "$or": [
-                    {"requester_id": current_user.id, "recipient_id": post["author_id"], "status": "accepted"},
-                    {"requester_id": post["author_id"], "recipient_id": current_user.id, "status": "accepted"}
-                ]
-            })
-            if not friendship:
-                raise HTTPException(status_code=403, detail="Not authorized to view this post")
-    
-    # Verificar se já curtiu
-    likes = post.get("likes", [])
-    if current_user.id in likes:
-        # Remover curtida
-        await db.posts.update_one(
-            {"id": post_id},
-            {"$pull": {"likes": current_user.id}}
-        )
-        return {"liked": False, "like_count": len(likes) - 1}
-    else:
-        # Adicionar curtida
-        await db.posts.update_one(
-            {"id": post_id},
-            {"$push": {"likes": current_user.id}}
-        )
-        
+    await visibility.require(post)
+    
+    # Alternar a curtida atomicamente; o contador devolvido já é o atualizado
+    result, applied = await reactions.toggle(db, "posts", reactions.POST, post_id, current_user.id, idempotency_key)
+    
+    if applied and result["liked"]:
         # Criar notificação se não for o próprio autor
         if post["author_id"] != current_user.id:
-            notification = {
-                "id": str(uuid.uuid4()),
-                "recipient_id": post["author_id"],
-                "sender_id": current_user.id,
-                "type": NotificationType.POST_LIKE,
-                "reference_id": post_id,
-                "message": f"{current_user.name} liked your post",
-                "is_read": False,
-                "created_at": datetime.utcnow()
-            }
-            
-            await db.notifications.insert_one(notification)
-        
-        return {"liked": True, "like_count": len(likes) + 1}
+            outbox.notify(post["author_id"], current_user.id, current_user.name, NotificationType.POST_LIKE, post_id)
+    
+    return result
+
+@router.get("/{post_id}/likes", response_model=List[PostLiker])
+async def get_post_likes(post_id: str, response: Response, limit: int = 20, cursor: Optional[str] = None, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), users: UserLoader = Depends(get_user_loader), visibility: PostVisibility = Depends(get_post_visibility)):
+    """
+    Lista quem curtiu o post, das curtidas mais recentes para as mais antigas,
+    paginado por cursor (cabeçalho X-Next-Cursor)
+    """
+    # Buscar post
+    post = await db.posts.find_one({"id": post_id}, {"_id": 0, "id": 1, "author_id": 1, "privacy": 1})
+    if not post:
+        raise HTTPException(status_code=404, detail="Post not found")
+    
+    # Verificar permissão para ver o post
+    await visibility.require(post)
+    
+    # Buscar a página de curtidas (faixa sobre target_id + created_at)
+    page = await db.reactions.find(
+        pagination.paginate_query({"target_id": post_id}, cursor)
+    ).sort(pagination.keyset_sort()).limit(limit).to_list(limit)
+    pagination.set_next_cursor(response, pagination.next_cursor(page, limit))
+    
+    # Buscar quem curtiu em uma única consulta
+    likers = await users.load_many(reaction["user_id"] for reaction in page)
+    
+    return serializers.json_response([
+        {**serializers.user_card(likers[reaction["user_id"]]), "liked_at": reaction["created_at"]}
+        for reaction in page
+        if likers.get(reaction["user_id"])
+    ], response)
 
 @router.post("/{post_id}/comments")
-async def add_comment(post_id: str, comment_data: CommentCreate, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def add_comment(post_id: str, comment_data: CommentCreate, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), visibility: PostVisibility = Depends(get_post_visibility)):
     # Buscar post
     post = await db.posts.find_one({"id": post_id})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
     # Verificar permissão para ver o post
-    if post["author_id"] != current_user.id:
-        if post["privacy"] == "private":
-            raise HTTPException(status_code=403, detail="Not authorized to view this post")
-        elif post["privacy"] == "friends":
-            # Verificar se são amigos
-            friendship = await db.friend_requests.find_one({
-                "$or": [
-                    {"requester_id": current_user.id, "recipient_id": post["author_id"], "status": "accepted"},
-                    {"requester_id": post["author_id"], "recipient_id": current_user.id, "status": "accepted"}
-                ]
-            })
-            if not friendship:
-                raise HTTPException(status_code=403, detail="Not authorized to view this post")
-    
-    # Criar comentário
-    comment = {
-        "id": str(uuid.uuid4()),
-        "author_id": current_user.id,
-        "content": comment_data.content,
-        "created_at": datetime.utcnow(),
-        "likes": []
-    }
+    await visibility.require(post)
     
-    # Adicionar comentário ao post
+    # Criar comentário na coleção própria
+    comment = Comment(
+        post_id=post_id,
+        author_id=current_user.id,
+        content=comment_data.content
+    ).dict()
+    await db.comments.insert_one(comment)
+    
+    # Atualizar contador e prévia dos últimos comentários no post
     await db.posts.update_one(
         {"id": post_id},
-        {"$push": {"comments": comment}}
+        {
+            "$inc": {"comment_count": 1},
+            "$push": {"latest_comments": {
+                "$each": [comments.preview_entry(comment)],
+                "$slice": -comments.COMMENT_PREVIEW_SIZE
+            }}
+        }
     )
     
     # Criar notificação se não for o próprio autor
     if post["author_id"] != current_user.id:
-        notification = {
-            "id": str(uuid.uuid4()),
-            "recipient_id": post["author_id"],
-            "sender_id": current_user.id,
-            "type": NotificationType.POST_COMMENT,
-            "reference_id": post_id,
-            "message": f"{current_user.name} commented on your post",
-            "is_read": False,
-            "created_at": datetime.utcnow()
-        }
-        
-        await db.notifications.insert_one(notification)
+        outbox.notify(post["author_id"], current_user.id, current_user.name, NotificationType.POST_COMMENT, post_id)
     
     # Retornar comentário com informações do autor
     return {
         "id": comment["id"],
         "content": comment["content"],
         "created_at": comment["created_at"],
-        "likes": [],
         "like_count": 0,
         "author": {
             "id": current_user.id,
@@ -422,19 +405,21 @@ async def add_comment(post_id: str, comment_data: CommentCreate, db: AsyncIOMoto
         "is_liked": False
     }
 
+async def _find_comment(db: AsyncIOMotorClient, post: dict, comment_id: str):
+    for comment in post.get("comments", []):
+        if comment["id"] == comment_id:
+            return comment, True
+    return await db.comments.find_one({"id": comment_id, "post_id": post["id"]}), False
+
 @router.delete("/{post_id}/comments/{comment_id}")
-async def delete_comment(post_id: str, comment_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def delete_comment(post_id: str, comment_id: str, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Buscar post
     post = await db.posts.find_one({"id": post_id})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    # Buscar comentário
-    comment = None
-    for c in post.get("comments", []):
-        if c["id"] == comment_id:
-            comment = c
-            break
+    # Buscar comentário (na coleção ou, em posts não migrados, embutido)
+    comment, embedded = await _find_comment(db, post, comment_id)
     
     if not comment:
         raise HTTPException(status_code=404, detail="Comment not found")
@@ -444,90 +429,62 @@ async def delete_comment(post_id: str, comment_id: str, db: AsyncIOMotorClient =
         raise HTTPException(status_code=403, detail="Not authorized to delete this comment")
     
     # Remover comentário
-    await db.posts.update_one(
-        {"id": post_id},
-        {"$pull": {"comments": {"id": comment_id}}}
-    )
+    if embedded:
+        await db.posts.update_one(
+            {"id": post_id},
+            {"$pull": {"comments": {"id": comment_id}}}
+        )
+    else:
+        result = await db.comments.delete_one({"id": comment_id})
+        if result.deleted_count:
+            await db.posts.update_one({"id": post_id}, {"$inc": {"comment_count": -1}})
+            await db.reactions.delete_many({"target_id": comment_id})
+            
+            # Completar a prévia se o comentário removido fazia parte dela
+            if any(c["id"] == comment_id for c in post.get("latest_comments", [])):
+                await comments.refresh_preview(db, post_id)
     
     return {"message": "Comment deleted successfully"}
 
 @router.post("/{post_id}/comments/{comment_id}/like")
-async def like_comment(post_id: str, comment_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def like_comment(post_id: str, comment_id: str, idempotency_key: Optional[str] = Header(None), db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), visibility: PostVisibility = Depends(get_post_visibility)):
     # Buscar post
     post = await db.posts.find_one({"id": post_id})
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    # Buscar comentário
-    comment = None
-    comment_index = -1
-    for i, c in enumerate(post.get("comments", [])):
-        if c["id"] == comment_id:
-            comment = c
-            comment_index = i
-            break
+    # Verificar permissão para ver o post
+    await visibility.require(post)
+    
+    # Buscar comentário (na coleção ou, em posts não migrados, embutido)
+    comment, embedded = await _find_comment(db, post, comment_id)
     
     if not comment:
         raise HTTPException(status_code=404, detail="Comment not found")
     
-    # Verificar se já curtiu
-    likes = comment.get("likes", [])
-    if current_user.id in likes:
-        # Remover curtida
-        likes.remove(current_user.id)
-        liked = False
-    else:
-        # Adicionar curtida
-        likes.append(current_user.id)
-        liked = True
-        
-        # Criar notificação se não for o próprio autor
-        if comment["author_id"] != current_user.id:
-            notification = {
-                "id": str(uuid.uuid4()),
-                "recipient_id": comment["author_id"],
-                "sender_id": current_user.id,
-                "type": NotificationType.COMMENT_LIKE,
-                "reference_id": comment_id,
-                "message": f"{current_user.name} liked your comment",
-                "is_read": False,
-                "created_at": datetime.utcnow()
-            }
-            
-            await db.notifications.insert_one(notification)
+    # Em posts não migrados, mover os comentários para a coleção antes de curtir
+    if embedded:
+        await comments.migrate_post_comments(db, post)
     
-    # Atualizar comentário
-    comment["likes"] = likes
-    post["comments"][comment_index] = comment
+    # Alternar a curtida atomicamente; o contador devolvido já é o atualizado
+    result, applied = await reactions.toggle(db, "comments", reactions.COMMENT, comment_id, current_user.id, idempotency_key)
     
-    await db.posts.update_one(
-        {"id": post_id},
-        {"$set": {"comments": post["comments"]}}
-    )
+    if applied and result["liked"]:
+        # Criar notificação se não for o próprio autor
+        if comment["author_id"] != current_user.id:
+            outbox.notify(comment["author_id"], current_user.id, current_user.name, NotificationType.COMMENT_LIKE, comment_id)
     
-    return {"liked": liked, "like_count": len(likes)}
+    return result
 
 @router.post("/{post_id}/share")
-async def share_post(post_id: str, content: str = Form(""), db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def share_post(post_id: str, content: str = Form(""), db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user), visibility: PostVisibility = Depends(get_post_visibility)):
     # Buscar post original
     original_post = await db.posts.find_one({"id": post_id})
     if not original_post:
         raise HTTPException(status_code=404, detail="Post not found")
     
     # Verificar permissão para ver o post
-    if original_post["author_id"] != current_user.id:
-        if original_post["privacy"] == "private":
-            raise HTTPException(status_code=403, detail="Not authorized to share this post")
-        elif original_post["privacy"] == "friends":
-            # Verificar se são amigos
-            friendship = await db.friend_requests.find_one({
-                "$or": [
-                    {"requester_id": current_user.id, "recipient_id": original_post["author_id"], "status": "accepted"},
-                    {"requester_id": original_post["author_id"], "recipient_id": current_user.id, "status": "accepted"}
-                ]
-            })
-            if not friendship:
-                raise HTTPException(status_code=403, detail="Not authorized to share this post")
+    await visibility.require(original_post, "Not authorized to share this post")
     
     # Criar novo post como compartilhamento
     shared_post = Post(
@@ -538,6 +495,8 @@ async def share_post(post_id: str, content: str = Form(""), db: AsyncIOMotorClie
     )
     
     await db.posts.insert_one(shared_post.dict())
+    await timelines.fan_out_post(db, shared_post.dict())
+    await post_search.publish_post(shared_post.dict())
     
     # Incrementar contador de compartilhamentos no post original
     await db.posts.update_one(
@@ -547,17 +506,6 @@ async def share_post(post_id: str, content: str = Form(""), db: AsyncIOMotorClie
     
     # Criar notificação se não for o próprio autor
     if original_post["author_id"] != current_user.id:
-        notification = {
-            "id": str(uuid.uuid4()),
-            "recipient_id": original_post["author_id"],
-            "sender_id": current_user.id,
-            "type": NotificationType.POST_SHARE,
-            "reference_id": post_id,
-            "message": f"{current_user.name} shared your post",
-            "is_read": False,
-            "created_at": datetime.utcnow()
-        }
-        
-        await db.notifications.insert_one(notification)
+        outbox.notify(original_post["author_id"], current_user.id, current_user.name, NotificationType.POST_SHARE, post_id)
     
     return {"message": "Post shared successfully", "post_id": shared_post.id}
\ No newline at end of file
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from fastapi.security import OAuth2PasswordBearer
+from motor.motor_asyncio import AsyncIOMotorClient
+from typing import Optional
+
+from models import Principal
+from auth import get_current_user
+import realtime
+
+router = APIRouter(prefix="/realtime", tags=["realtime"])
+
+# EventSource não envia cabeçalhos: o token também é aceito em `access_token`
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login", auto_error=False)
+
+async def get_stream_user(access_token: Optional[str] = None, token: Optional[str] = Depends(optional_oauth2_scheme), db: AsyncIOMotorClient = Depends()) -> Principal:
+    return await get_current_user(token or access_token or "", db)
+
+@router.get("/stream")
+async def stream_events(request: Request, current_user: Principal = Depends(get_stream_user)):
+    """
+    Canal de eventos (server-sent events) do usuário atual: notificações novas
+    e posts novos no feed. Ver `realtime.py` para o formato dos eventos.
+    """
+    if realtime.registry.full:
+        raise HTTPException(status_code=503, detail="Too many realtime connections", headers={"Retry-After": "30"})
+
+    return StreamingResponse(
+        realtime.stream(current_user.id, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,66 +1,67 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Response, BackgroundTasks
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import List, Optional
-import boto3
-import os
 import uuid
 from datetime import datetime
 
-from models import UserProfile, UserProfileUpdate, PrivacyLevel
+from models import Principal, UserProfile, UserProfileUpdate, PrivacyLevel, MediaKeyCommit, FriendCard
 from auth import get_current_active_user
+import pagination
+import indexes
+import friend_graph
+import derivatives
+import media_blobs
+import user_search
+import serializers
+from loaders import invalidate_user_card
+from routes.media import resolve_uploads, resolve_upload_urls
 
 router = APIRouter(prefix="/users", tags=["users"])
 
-# Configuração do S3 para upload de imagens
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
-    aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
-    region_name=os.environ.get('AWS_REGION')
-)
-BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
-
-# Função para upload de imagem para o S3
-async def upload_image_to_s3(file: UploadFile, folder: str) -> str:
-    file_extension = file.filename.split('.')[-1]
-    file_name = f"{folder}/{uuid.uuid4()}.{file_extension}"
-    
-    s3_client.upload_fileobj(
-        file.file,
-        BUCKET_NAME,
-        file_name,
-        ExtraArgs={
-            "ContentType": file.content_type,
-            "ACL": "public-read"
-        }
-    )
-    
-    return f"https://{BUCKET_NAME}.s3.amazonaws.com/{file_name}"
+# Índices usados pelas consultas de usuários (os únicos também evitam cadastros duplicados)
+indexes.declare("users", [("id", 1)], unique=True)
+indexes.declare("users", [("email", 1)], unique=True)
+indexes.declare("users", [("joined_date", 1), ("id", 1)])
 
 @router.get("/", response_model=List[UserProfile])
-async def get_users(skip: int = 0, limit: int = 10, db: AsyncIOMotorClient = Depends()):
-    users = await db.users.find().skip(skip).limit(limit).to_list(limit)
+async def get_users(response: Response, skip: int = 0, limit: int = 10, cursor: Optional[str] = None, db: AsyncIOMotorClient = Depends()):
+    # Ordenar por data de cadastro (mais antigos primeiro) para paginar por cursor
+    users = db.users.find(
+        pagination.paginate_query({}, cursor, "joined_date", descending=False)
+    ).sort(pagination.keyset_sort("joined_date", descending=False))
+    if not cursor:
+        users = users.skip(skip)
+    users = await users.limit(limit).to_list(limit)
+    pagination.set_next_cursor(response, pagination.next_cursor(users, limit, "joined_date"))
     return [UserProfile(**user) for user in users]
 
+@router.get("/search", response_model=List[FriendCard])
+async def search_users(query: str, limit: int = 20, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
+    """
+    Busca usuários pelo nome (prefixo de cada palavra, sem diferenciar acentos
+    e maiúsculas) ou pelo email exato. Amigos e amigos de amigos vêm primeiro.
+    """
+    users = await user_search.search(db, query, current_user.id, min(limit, 50))
+    
+    # Retornar resultados com informações básicas
+    return serializers.json_response([serializers.friend_card(user) for user in users])
+
 @router.get("/{user_id}", response_model=UserProfile)
-async def get_user(user_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def get_user(user_id: str, size: Optional[str] = None, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     user = await db.users.find_one({"id": user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
+    # Avatar e capa no tamanho pedido, se as versões já existem
+    user["avatar"] = derivatives.pick(user.get("avatar"), user.get("avatar_variants"), size)
+    user["cover_photo"] = derivatives.pick(user.get("cover_photo"), user.get("cover_photo_variants"), size)
+    
     # Verificar configurações de privacidade
     if user_id != current_user.id:
         # Se o perfil for privado, verificar se são amigos
         if user["privacy_settings"]["profile"] == PrivacyLevel.PRIVATE:
             # Verificar se são amigos
-            friendship = await db.friendships.find_one({
-                "$or": [
-                    {"requester_id": current_user.id, "recipient_id": user_id, "status": "accepted"},
-                    {"requester_id": user_id, "recipient_id": current_user.id, "status": "accepted"}
-                ]
-            })
-            
-            if not friendship:
+            if not await friend_graph.graph.are_friends(db, current_user.id, user_id):
                 # Retornar versão limitada do perfil
                 return UserProfile(
                     id=user["id"],
@@ -71,57 +72,109 @@ async def get_user(user_id: str, db: AsyncIOMotorClient = Depends(), current_use
     
     return UserProfile(**user)
 
+# Campo de imagem do perfil -> finalidade do upload
+PROFILE_IMAGES = {"avatar": "avatar", "cover_photo": "cover"}
+
 @router.put("/me", response_model=UserProfile)
-async def update_user_profile(profile_update: UserProfileUpdate, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def update_user_profile(profile_update: UserProfileUpdate, background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Filtrar campos não nulos para atualização
     update_data = {k: v for k, v in profile_update.dict().items() if v is not None}
     
+    # Imagens alteradas passam pela mesma validação e registro do commit de upload
+    images = {field: update_data.pop(field) for field in PROFILE_IMAGES if field in update_data}
+    if images:
+        current = await db.users.find_one({"id": current_user.id}, {"_id": 0, **{field: 1 for field in images}})
+        changed = {field: url for field, url in images.items() if url != (current or {}).get(field)}
+        images = {}
+        try:
+            for field, url in changed.items():
+                images[field], = await resolve_upload_urls(db, [url], PROFILE_IMAGES[field], current_user.id)
+        except HTTPException:
+            await media_blobs.release(db, images.values())
+            raise
+    
+    # Manter o índice de busca em dia com o nome
+    if "name" in update_data:
+        update_data.update(user_search.search_fields(update_data["name"]))
+    
     if update_data:
         await db.users.update_one(
             {"id": current_user.id},
             {"$set": update_data}
         )
+        await invalidate_user_card(current_user.id)
+    for field, url in images.items():
+        await _set_profile_image(db, background_tasks, current_user.id, field, url)
     
     # Retornar perfil atualizado
     updated_user = await db.users.find_one({"id": current_user.id})
     return UserProfile(**updated_user)
 
+async def _set_profile_image(db: AsyncIOMotorClient, background_tasks: BackgroundTasks, user_id: str, field: str, url: str):
+    # Trocar a imagem e descartar as versões redimensionadas da anterior
+    previous = await db.users.find_one_and_update(
+        {"id": user_id},
+        {"$set": {field: url}, "$unset": {f"{field}_variants": ""}},
+        projection={"_id": 0, field: 1}
+    )
+    await invalidate_user_card(user_id)
+    
+    # Liberar a imagem anterior no registro de mídia, mesmo se for a mesma URL:
+    # o envio (ou resolve_uploads) já tomou uma referência nova
+    if previous and previous.get(field):
+        await media_blobs.release(db, [previous[field]])
+    
+    # Gerar as versões redimensionadas depois da resposta
+    background_tasks.add_task(derivatives.processor.process_user_image, db, user_id, field, url)
+
 @router.post("/me/avatar")
-async def upload_avatar(file: UploadFile = File(...), db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def upload_avatar(background_tasks: BackgroundTasks, file: UploadFile = File(...), db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Validar tipo de arquivo
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    # Upload para S3
-    avatar_url = await upload_image_to_s3(file, f"users/{current_user.id}/avatar")
+    # Upload da imagem
+    avatar_url = await media_blobs.store_upload(db, file, f"users/{current_user.id}/avatar")
     
     # Atualizar perfil do usuário
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": {"avatar": avatar_url}}
-    )
+    await _set_profile_image(db, background_tasks, current_user.id, "avatar", avatar_url)
+    
+    return {"avatar_url": avatar_url}
+
+@router.put("/me/avatar")
+async def commit_avatar(commit: MediaKeyCommit, background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
+    # Avatar já enviado direto ao armazenamento (POST /media/uploads)
+    avatar_url, = await resolve_uploads(db, [commit.key], "avatar", current_user.id)
+    
+    await _set_profile_image(db, background_tasks, current_user.id, "avatar", avatar_url)
     
     return {"avatar_url": avatar_url}
 
 @router.post("/me/cover")
-async def upload_cover_photo(file: UploadFile = File(...), db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def upload_cover_photo(background_tasks: BackgroundTasks, file: UploadFile = File(...), db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Validar tipo de arquivo
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="File must be an image")
     
-    # Upload para S3
-    cover_url = await upload_image_to_s3(file, f"users/{current_user.id}/cover")
+    # Upload da imagem
+    cover_url = await media_blobs.store_upload(db, file, f"users/{current_user.id}/cover")
     
     # Atualizar perfil do usuário
-    await db.users.update_one(
-        {"id": current_user.id},
-        {"$set": {"cover_photo": cover_url}}
-    )
+    await _set_profile_image(db, background_tasks, current_user.id, "cover_photo", cover_url)
+    
+    return {"cover_url": cover_url}
+
+@router.put("/me/cover")
+async def commit_cover_photo(commit: MediaKeyCommit, background_tasks: BackgroundTasks, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
+    # Capa já enviada direto ao armazenamento (POST /media/uploads)
+    cover_url, = await resolve_uploads(db, [commit.key], "cover", current_user.id)
+    
+    await _set_profile_image(db, background_tasks, current_user.id, "cover_photo", cover_url)
     
     return {"cover_url": cover_url}
 
 @router.put("/me/privacy")
-async def update_privacy_settings(privacy_settings: dict, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def update_privacy_settings(privacy_settings: dict, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Validar configurações de privacidade
     valid_settings = {}
     for key, value in privacy_settings.items():
@@ -139,7 +192,7 @@ async def update_privacy_settings(privacy_settings: dict, db: AsyncIOMotorClient
     return {"privacy_settings": updated_user["privacy_settings"]}
 
 @router.post("/me/life-events")
-async def add_life_event(event_data: dict, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def add_life_event(event_data: dict, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Validar dados do evento
     required_fields = ["event", "date"]
     for field in required_fields:
@@ -159,7 +212,7 @@ async def add_life_event(event_data: dict, db: AsyncIOMotorClient = Depends(), c
     return event_data
 
 @router.delete("/me/life-events/{event_id}")
-async def delete_life_event(event_id: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def delete_life_event(event_id: str, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Remover evento da lista de eventos do usuário
     result = await db.users.update_one(
         {"id": current_user.id},
@@ -172,7 +225,7 @@ async def delete_life_event(event_id: str, db: AsyncIOMotorClient = Depends(), c
     return {"message": "Event deleted successfully"}
 
 @router.post("/me/achievements")
-async def add_achievement(achievement_data: dict, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
+async def add_achievement(achievement_data: dict, db: AsyncIOMotorClient = Depends(), current_user: Principal = Depends(get_current_active_user)):
     # Validar dados da conquista
     required_fields = ["icon", "label", "description"]
     for field in required_fields:
@@ -190,23 +243,3 @@ async def add_achievement(achievement_data: dict, db: AsyncIOMotorClient = Depen
     )
     
     return achievement_data
-
-@router.get("/search")
-async def search_users(query: str, db: AsyncIOMotorClient = Depends(), current_user: UserProfile = Depends(get_current_active_user)):
-    # Buscar usuários pelo nome ou email
-    users = await db.users.find({
-        "$or": [
-            {"name": {"$regex": query, "$options": "i"}},
-            {"email": {"$regex": query, "$options": "i"}}
-        ],
-        "id": {"$ne": current_user.id}  # Excluir o usuário atual
-    }).limit(20).to_list(20)
-    
-    # Retornar resultados com informações básicas
-    return [{
-        "id": user["id"],
-        "name": user["name"],
-        "avatar": user.get("avatar"),
-        "location": user.get("location"),
-        "is_verified": user.get("is_verified", False)
-    } for user in users]
\ No newline at end of file
@@ -0,0 +1,130 @@
+"""
+Montagem das respostas das listagens (feed, comentários, notificações, amigos).
+
+As funções recebem os documentos do banco (e os usuários já carregados pelo
+`UserLoader`) e devolvem dicts no formato dos modelos de resposta de
+`models.py` (`FeedPost`, `CommentOut`, `NotificationOut`, `Friend`...), que
+as rotas declaram em `response_model` para a documentação.
+
+As rotas devolvem o resultado com `json_response`, que serializa com orjson
+direto para bytes: os dicts já estão no formato final, então a validação e a
+conversão genérica do FastAPI (`jsonable_encoder`) seriam só custo.
+"""
+from typing import Any, Collection, Dict, List, Optional
+
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+
+import comments
+import derivatives
+import outbox
+import reactions
+
+
+def json_response(content: Any, response: Optional[Response] = None) -> ORJSONResponse:
+    """Resposta serializada com orjson, com os cabeçalhos definidos em `response`"""
+    result = ORJSONResponse(content)
+    if response is not None:
+        # Cabeçalhos definidos pela rota na resposta injetada (ex.: X-Next-Cursor)
+        for name, value in response.headers.items():
+            if name != "content-length":
+                result.headers[name] = value
+    return result
+
+
+def user_card(user: dict) -> dict:
+    return {
+        "id": user["id"],
+        "name": user["name"],
+        "avatar": derivatives.avatar_thumb(user),
+        "is_verified": user.get("is_verified", False)
+    }
+
+
+def friend_card(user: dict, **extra) -> dict:
+    """Cartão de amigo (busca, amigos em comum, sugestões), com campos extras"""
+    return {**user_card(user), "location": user.get("location"), **extra}
+
+
+def comment_preview(comment: dict, author: dict) -> dict:
+    return {
+        "id": comment["id"],
+        "content": comment["content"],
+        "created_at": comment["created_at"],
+        "author": user_card(author)
+    }
+
+
+def comment(comment: dict, author: dict, is_liked: bool) -> dict:
+    return {
+        **comment_preview(comment, author),
+        "like_count": reactions.like_count(comment),
+        "is_liked": is_liked
+    }
+
+
+def _post_summary(post: dict, author: dict, liked: Collection[str], size: Optional[str]) -> dict:
+    return {
+        "id": post["id"],
+        "content": post["content"],
+        "media_urls": derivatives.media_urls(post, size),
+        "created_at": post["created_at"],
+        "updated_at": post["updated_at"],
+        "like_count": reactions.like_count(post),
+        "comment_count": comments.comment_count(post),
+        "share_count": post.get("shares", 0),
+        "author": user_card(author),
+        "is_liked": post["id"] in liked
+    }
+
+
+def feed_post(post: dict, authors: Dict[str, dict], liked: Collection[str], size: Optional[str]) -> dict:
+    """Post das listagens, com a prévia desnormalizada dos últimos comentários"""
+    result = _post_summary(post, authors[post["author_id"]], liked, size)
+    result["latest_comments"] = [
+        comment_preview(preview, authors[preview["author_id"]])
+        for preview in comments.latest_comments(post)
+        if authors.get(preview["author_id"])
+    ]
+    return result
+
+
+def feed_posts(posts: List[dict], authors: Dict[str, dict], liked: Collection[str], size: Optional[str]) -> List[dict]:
+    # Posts cujo autor não existe mais ficam de fora
+    return [feed_post(post, authors, liked, size) for post in posts if authors.get(post["author_id"])]
+
+
+def post_detail(post: dict, recent_comments: List[dict], authors: Dict[str, dict], liked: Collection[str], size: Optional[str]) -> dict:
+    """Post completo, com os últimos comentários (em ordem cronológica)"""
+    result = _post_summary(post, authors[post["author_id"]], liked, size)
+    result["comments"] = [
+        comment(item, authors[item["author_id"]], item["id"] in liked)
+        for item in recent_comments
+        if authors.get(item["author_id"])
+    ]
+    return result
+
+
+def notification(notification: dict, senders: Dict[str, dict]) -> dict:
+    """Notificação (simples ou agrupada) com remetente e últimos remetentes"""
+    sender = senders.get(notification["sender_id"])
+    actor_count = notification.get("actor_count", 1)
+
+    # Remetentes mais recentes primeiro, sem repetições
+    actor_ids = dict.fromkeys(reversed(notification.get("actor_ids") or [notification["sender_id"]]))
+
+    message = notification["message"]
+    if actor_count > 1 and sender:
+        message = outbox.group_message(notification["type"], sender["name"], actor_count)
+
+    return {
+        "id": notification["id"],
+        "type": notification["type"],
+        "message": message,
+        "reference_id": notification.get("reference_id"),
+        "is_read": notification.get("is_read", False),
+        "created_at": notification["created_at"],
+        "actor_count": actor_count,
+        "sender": user_card(sender) if sender else None,
+        "actors": [user_card(senders[actor_id]) for actor_id in actor_ids if senders.get(actor_id)]
+    }
@@ -1,6 +1,8 @@
-from fastapi import FastAPI, APIRouter, Depends
+from fastapi import FastAPI, APIRouter
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.staticfiles import StaticFiles
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
@@ -11,7 +13,19 @@ import uuid
 from datetime import datetime
 
 # Importar rotas
-from routes import auth, users, friends, posts, notifications
+from routes import auth, users, friends, posts, notifications, media, realtime as realtime_routes
+import auth as authentication
+import indexes
+import friend_graph
+import storage
+import derivatives
+import media_blobs
+import outbox
+import unread_counters
+import realtime
+import post_search
+import loaders
+import pagination
 
 
 ROOT_DIR = Path(__file__).parent
@@ -23,7 +37,7 @@ client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -47,6 +61,22 @@ class StatusCheckCreate(BaseModel):
 async def root():
     return {"message": "Hello World"}
 
+@api_router.get("/metrics")
+async def get_metrics():
+    # Métricas dos caches em processo deste worker
+    return {
+        "friend_graph": friend_graph.graph.stats(),
+        "password_hasher": authentication.password_hasher.stats(),
+        "storage": storage.media_storage.stats(),
+        "derivatives": derivatives.processor.stats(),
+        "media_dedup": media_blobs.stats.as_dict(),
+        "notification_outbox": outbox.outbox.stats(),
+        "unread_counters": unread_counters.counters.stats(),
+        "realtime": realtime.stats(),
+        "post_search": post_search.index.stats(),
+        "user_cards": loaders.cards.stats()
+    }
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
@@ -65,18 +95,30 @@ api_router.include_router(users.router)
 api_router.include_router(friends.router)
 api_router.include_router(posts.router)
 api_router.include_router(notifications.router)
+api_router.include_router(media.router)
+api_router.include_router(realtime_routes.router)
 
 # Include the router in the main app
 app.include_router(api_router)
 
+# Com o armazenamento local, a própria aplicação serve os arquivos enviados
+if isinstance(storage.media_storage.backend, storage.LocalStorage):
+    storage.LOCAL_STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+    app.mount(storage.LOCAL_STORAGE_URL, StaticFiles(directory=storage.LOCAL_STORAGE_DIR), name="media")
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # O front-end (outra origem) precisa ler o cursor da próxima página
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
 
+# Expor quantas buscas de usuário foram agrupadas pelo loader da requisição
+app.add_middleware(loaders.UserLoaderStatsMiddleware)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -84,6 +126,36 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def reconcile_indexes():
+    # Criar os índices declarados em segundo plano, sem atrasar a inicialização
+    indexes.start_background_reconcile(db)
+
+@app.on_event("startup")
+async def start_media_sweeper():
+    # Remover periodicamente as mídias sem referências
+    media_blobs.start_background_sweeper(db)
+
+@app.on_event("startup")
+async def start_realtime():
+    # Assinar o pub/sub antes que o outbox comece a publicar
+    await realtime.start()
+
+@app.on_event("startup")
+async def start_post_search():
+    # Montar o índice de busca de posts em segundo plano
+    post_search.start(db)
+
+@app.on_event("startup")
+async def start_notification_outbox():
+    # Regravar notificações pendentes de execuções anteriores e iniciar os flushes em lote
+    outbox.outbox.start(db)
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Gravar as notificações ainda no outbox antes de fechar a conexão
+    await outbox.outbox.stop()
+    await realtime.stop()
     client.close()
+    authentication.password_hasher.shutdown()
+    derivatives.processor.shutdown()
@@ -0,0 +1,250 @@
+"""
+Armazenamento de mídia (imagens de posts, avatares e capas).
+
+Os uploads rodam em threads (`asyncio.to_thread`), fora do event loop, com no
+máximo `STORAGE_MAX_CONCURRENCY` simultâneos por worker; os arquivos de um
+mesmo post são enviados em paralelo com `upload_many`. O corpo é lido do
+arquivo temporário do upload em partes, sem carregá-lo inteiro na memória
+(multipart no S3 acima de `STORAGE_MULTIPART_THRESHOLD`).
+
+`STORAGE_BACKEND=local` grava os arquivos em `LOCAL_STORAGE_DIR`, servidos
+pela própria aplicação em `LOCAL_STORAGE_URL`, para desenvolvimento e testes
+sem AWS.
+
+Uploads diretos: `presign_upload` devolve um destino de POST (url + campos
+do formulário) válido por `PRESIGNED_UPLOAD_EXPIRES` segundos e restrito a
+uma chave, um tipo e um tamanho máximo; o cliente envia o arquivo direto ao
+armazenamento e depois informa a chave à API, que confere com `exists`. No
+armazenamento local, os campos são assinados com HMAC e o POST é recebido
+por `routes/media.py`, com o mesmo contrato do S3.
+"""
+import asyncio
+import hashlib
+import hmac
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from fastapi import UploadFile
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "s3")
+STORAGE_MAX_CONCURRENCY = int(os.environ.get("STORAGE_MAX_CONCURRENCY", 8))
+STORAGE_MULTIPART_THRESHOLD = int(os.environ.get("STORAGE_MULTIPART_THRESHOLD", 8 * 1024 * 1024))
+STORAGE_CHUNK_SIZE = int(os.environ.get("STORAGE_CHUNK_SIZE", 8 * 1024 * 1024))
+LOCAL_STORAGE_DIR = Path(os.environ.get("LOCAL_STORAGE_DIR", Path(__file__).parent / "media"))
+LOCAL_STORAGE_URL = os.environ.get("LOCAL_STORAGE_URL", "/api/media")
+LOCAL_UPLOAD_URL = os.environ.get("LOCAL_UPLOAD_URL", "/api/media/uploads/local")
+PRESIGNED_UPLOAD_EXPIRES = int(os.environ.get("PRESIGNED_UPLOAD_EXPIRES", 15 * 60))
+
+# Latências guardadas para as métricas
+LATENCY_SAMPLES = 1000
+
+
+class S3Storage:
+    def __init__(self, bucket: Optional[str] = None):
+        self.bucket = bucket or os.environ.get('S3_BUCKET_NAME')
+        self.client = boto3.client(
+            's3',
+            aws_access_key_id=os.environ.get('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.environ.get('AWS_SECRET_ACCESS_KEY'),
+            region_name=os.environ.get('AWS_REGION')
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=STORAGE_MULTIPART_THRESHOLD,
+            multipart_chunksize=STORAGE_CHUNK_SIZE
+        )
+
+    def put(self, key: str, body: BinaryIO, content_type: Optional[str]):
+        self.client.upload_fileobj(
+            body,
+            self.bucket,
+            key,
+            ExtraArgs={
+                "ContentType": content_type or "application/octet-stream",
+                "ACL": "public-read"
+            },
+            Config=self.transfer_config
+        )
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def presign_upload(self, key: str, content_type: str, max_size: int, expires: int) -> Dict:
+        return self.client.generate_presigned_post(
+            self.bucket,
+            key,
+            Fields={"Content-Type": content_type, "acl": "public-read"},
+            Conditions=[
+                {"Content-Type": content_type},
+                {"acl": "public-read"},
+                ["content-length-range", 1, max_size]
+            ],
+            ExpiresIn=expires
+        )
+
+    def exists(self, key: str) -> Optional[Dict]:
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return {"size": head["ContentLength"], "content_type": head.get("ContentType")}
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(self, key: str) -> str:
+        return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+
+
+class LocalStorage:
+    def __init__(self, root: Path = LOCAL_STORAGE_DIR, base_url: str = LOCAL_STORAGE_URL, upload_url: str = LOCAL_UPLOAD_URL, secret: Optional[str] = None):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip("/")
+        self.upload_url = upload_url
+        self.secret = (secret or os.environ.get("STORAGE_SIGNING_KEY") or os.environ.get("SECRET_KEY", "your-secret-key-for-development")).encode()
+
+    def path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"Invalid storage key: {key}")
+        return path
+
+    def put(self, key: str, body: BinaryIO, content_type: Optional[str]):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Escrever em arquivo temporário e renomear, para nunca servir um arquivo pela metade
+        with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as tmp:
+            shutil.copyfileobj(body, tmp, STORAGE_CHUNK_SIZE)
+        os.replace(tmp.name, path)
+
+    def get(self, key: str) -> bytes:
+        return self.path(key).read_bytes()
+
+    def sign(self, key: str, content_type: str, max_size: int, expires_at: int) -> str:
+        message = f"{key}|{content_type}|{max_size}|{expires_at}".encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def presign_upload(self, key: str, content_type: str, max_size: int, expires: int) -> Dict:
+        expires_at = int(time.time()) + expires
+        return {
+            "url": self.upload_url,
+            "fields": {
+                "key": key,
+                "Content-Type": content_type,
+                "max_size": str(max_size),
+                "expires": str(expires_at),
+                "signature": self.sign(key, content_type, max_size, expires_at)
+            }
+        }
+
+    def exists(self, key: str) -> Optional[Dict]:
+        path = self.path(key)
+        if not path.is_file():
+            return None
+        # O tipo não é guardado: vem da extensão, a mesma usada para servir o
+        # arquivo (as chaves dos uploads diretos levam a extensão do tipo assinado)
+        return {"size": path.stat().st_size, "content_type": mimetypes.guess_type(key)[0]}
+
+    def delete(self, key: str):
+        self.path(key).unlink(missing_ok=True)
+
+    def url(self, key: str) -> str:
+        return f"{self.base_url}/{key}"
+
+
+class MediaStorage:
+    def __init__(self, backend, max_concurrency: int = STORAGE_MAX_CONCURRENCY):
+        self.backend = backend
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.uploads = 0
+        self.failures = 0
+        self.bytes = 0
+        self.in_flight = 0
+        self._busy_seconds = 0.0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def put(self, key: str, body: BinaryIO, content_type: Optional[str]) -> str:
+        """Envia o conteúdo para a chave informada e devolve a URL pública"""
+        async with self._semaphore:
+            self.in_flight += 1
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self.backend.put, key, body, content_type)
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.in_flight -= 1
+            elapsed = time.monotonic() - started
+
+        self.uploads += 1
+        self.bytes += body.tell() if body.seekable() else 0
+        self._busy_seconds += elapsed
+        self._latencies.append(elapsed)
+        return self.backend.url(key)
+
+    async def upload(self, file: UploadFile, folder: str) -> str:
+        """Envia um arquivo recebido para `folder` com nome único"""
+        file_extension = file.filename.split('.')[-1]
+        key = f"{folder}/{uuid.uuid4()}.{file_extension}"
+        return await self.put(key, file.file, file.content_type)
+
+    async def upload_many(self, files: List[UploadFile], folder: str) -> List[str]:
+        """Envia vários arquivos em paralelo, devolvendo as URLs na mesma ordem"""
+        return list(await asyncio.gather(*(self.upload(file, folder) for file in files)))
+
+    async def get(self, key: str) -> bytes:
+        return await asyncio.to_thread(self.backend.get, key)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.backend.delete, key)
+
+    async def presign_upload(self, key: str, content_type: str, max_size: int, expires: int = PRESIGNED_UPLOAD_EXPIRES) -> Dict:
+        """Destino de upload direto (url e campos do formulário) para a chave"""
+        return await asyncio.to_thread(self.backend.presign_upload, key, content_type, max_size, expires)
+
+    async def exists(self, key: str) -> Optional[Dict]:
+        """Tamanho e tipo do arquivo, ou None se ele não foi enviado"""
+        return await asyncio.to_thread(self.backend.exists, key)
+
+    def url(self, key: str) -> str:
+        return self.backend.url(key)
+
+    def key_from_url(self, url: str) -> Optional[str]:
+        """Chave de um arquivo a partir da URL pública, se for deste armazenamento"""
+        prefix = self.backend.url("")
+        return url[len(prefix):] if url and url.startswith(prefix) else None
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            "backend": type(self.backend).__name__,
+            "uploads": self.uploads,
+            "failures": self.failures,
+            "in_flight": self.in_flight,
+            "bytes": self.bytes,
+            "bytes_per_second": round(self.bytes / self._busy_seconds) if self._busy_seconds else None,
+            "latency_avg_ms": round(1000 * sum(latencies) / len(latencies), 1) if latencies else None,
+            "latency_p95_ms": round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1) if latencies else None
+        }
+
+
+def _backend_from_env():
+    if STORAGE_BACKEND == "local":
+        return LocalStorage()
+    return S3Storage()
+
+
+# Armazenamento compartilhado pelas rotas do worker
+media_storage = MediaStorage(_backend_from_env())
@@ -0,0 +1,180 @@
+"""
+Sugestões de amizade (amigos de amigos) pré-calculadas.
+
+O job completo (`python cli.py refresh-suggestions --full`) carrega todas as
+amizades aceitas, monta a matriz de adjacência esparsa A e calcula as
+contagens de amigos em comum de todos os usuários com o produto A·A, em
+blocos de linhas. Os `SUGGESTIONS_TOP_K` melhores candidatos de cada usuário
+(excluindo amigos e pares com solicitação existente) são gravados em
+`friend_suggestions`, e a rota só precisa ler um documento.
+
+Quando amizades mudam, os usuários afetados são marcados como `stale` e
+recalculados individualmente (`refresh_user`) pelo grafo de amizades.
+"""
+import logging
+import os
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne
+from scipy import sparse
+
+import friend_graph
+import indexes
+
+logger = logging.getLogger(__name__)
+
+SUGGESTIONS_TOP_K = int(os.environ.get("SUGGESTIONS_TOP_K", 50))
+# Linhas da matriz processadas por vez no produto A·A
+SUGGESTIONS_BLOCK_ROWS = int(os.environ.get("SUGGESTIONS_BLOCK_ROWS", 5000))
+
+indexes.declare("friend_suggestions", [("user_id", 1)], unique=True)
+indexes.declare("friend_suggestions", [("stale", 1)])
+
+
+def _document(user_id: str, candidates: List[Tuple[str, int]]) -> dict:
+    return {
+        "user_id": user_id,
+        "candidates": [{"id": candidate_id, "mutual_friends": count} for candidate_id, count in candidates],
+        "stale": False,
+        "updated_at": datetime.utcnow()
+    }
+
+
+def _top_k(candidates: Iterable[Tuple[str, int]], top_k: int) -> List[Tuple[str, int]]:
+    return sorted(candidates, key=lambda candidate: (-candidate[1], candidate[0]))[:top_k]
+
+
+def _pair_matrix(pairs: np.ndarray, size: int) -> sparse.csr_matrix:
+    # Matriz simétrica 0/1 com um elemento por par (i, j)
+    if len(pairs) == 0:
+        return sparse.csr_matrix((size, size), dtype=np.int32)
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(size, size))
+    matrix.data[:] = 1
+    return matrix
+
+
+def score_mutual_friends(size: int, friend_pairs: np.ndarray, excluded_pairs: np.ndarray, top_k: int) -> Dict[int, List[Tuple[int, int]]]:
+    """
+    Calcula, para cada usuário (índice 0..size-1), os `top_k` candidatos com
+    mais amigos em comum. `friend_pairs` e `excluded_pairs` são arrays (n, 2)
+    de índices; pares excluídos e amigos atuais não são sugeridos.
+    """
+    adjacency = _pair_matrix(friend_pairs, size)
+    excluded = (adjacency + _pair_matrix(excluded_pairs, size)).tocsr()
+
+    result = {}
+    for start in range(0, size, SUGGESTIONS_BLOCK_ROWS):
+        stop = min(start + SUGGESTIONS_BLOCK_ROWS, size)
+        # Contagem de amigos em comum do bloco de usuários com todos os demais
+        mutual = (adjacency[start:stop] @ adjacency).tolil()
+        mutual.setdiag(0, k=start)
+        mutual = mutual.tocsr()
+        mutual = (mutual - mutual.multiply(excluded[start:stop] > 0)).tocsr()
+        mutual.eliminate_zeros()
+
+        for offset in range(stop - start):
+            row_start, row_stop = mutual.indptr[offset], mutual.indptr[offset + 1]
+            if row_start == row_stop:
+                continue
+            candidates = mutual.indices[row_start:row_stop]
+            counts = mutual.data[row_start:row_stop]
+            # Empates desfeitos pelo índice (a ordem dos ids), como em `_top_k`
+            order = np.lexsort((candidates, -counts))[:top_k]
+            result[start + offset] = [(int(candidates[i]), int(counts[i])) for i in order]
+    return result
+
+
+async def build_all(db: AsyncIOMotorClient, top_k: int = SUGGESTIONS_TOP_K, batch_size: int = 1000) -> int:
+    """Recalcula as sugestões de todos os usuários com amizades ou solicitações"""
+    requests = await db.friend_requests.find(
+        {}, {"_id": 0, "requester_id": 1, "recipient_id": 1, "status": 1}
+    ).to_list(None)
+
+    user_ids = sorted({r["requester_id"] for r in requests} | {r["recipient_id"] for r in requests})
+    index = {user_id: i for i, user_id in enumerate(user_ids)}
+
+    def pairs(accepted: bool) -> np.ndarray:
+        return np.array([
+            (index[r["requester_id"]], index[r["recipient_id"]])
+            for r in requests if (r["status"] == "accepted") == accepted
+        ], dtype=np.int64).reshape(-1, 2)
+
+    scores = score_mutual_friends(len(user_ids), pairs(True), pairs(False), top_k)
+
+    operations = []
+    written = 0
+    for i, user_id in enumerate(user_ids):
+        candidates = [(user_ids[j], count) for j, count in scores.get(i, [])]
+        operations.append(ReplaceOne({"user_id": user_id}, _document(user_id, candidates), upsert=True))
+        if len(operations) >= batch_size:
+            await db.friend_suggestions.bulk_write(operations, ordered=False)
+            written += len(operations)
+            operations = []
+    if operations:
+        await db.friend_suggestions.bulk_write(operations, ordered=False)
+        written += len(operations)
+
+    logger.info("Sugestões recalculadas para %d usuários", written)
+    return written
+
+
+async def refresh_user(db: AsyncIOMotorClient, user_id: str, top_k: int = SUGGESTIONS_TOP_K) -> List[dict]:
+    """Recalcula as sugestões de um único usuário a partir do grafo de amizades"""
+    friend_ids = await friend_graph.graph.friends_of(db, user_id)
+    friends_of_friends = await friend_graph.graph.friends_of_many(db, friend_ids)
+
+    mutual_counts = Counter()
+    for friend_id in friend_ids:
+        mutual_counts.update(friends_of_friends[friend_id].keys())
+
+    # Excluir o próprio usuário, os amigos e quem já tem solicitação com ele
+    requests = await db.friend_requests.find(
+        {"$or": [{"requester_id": user_id}, {"recipient_id": user_id}]},
+        {"_id": 0, "requester_id": 1, "recipient_id": 1}
+    ).to_list(None)
+    excluded = {user_id} | {r["requester_id"] for r in requests} | {r["recipient_id"] for r in requests}
+
+    candidates = _top_k(
+        ((candidate_id, count) for candidate_id, count in mutual_counts.items() if candidate_id not in excluded),
+        top_k
+    )
+    document = _document(user_id, candidates)
+    await db.friend_suggestions.replace_one({"user_id": user_id}, document, upsert=True)
+    return document["candidates"]
+
+
+async def mark_stale(db: AsyncIOMotorClient, *user_ids: str):
+    """
+    Marca para recálculo os usuários de uma amizade alterada e os amigos
+    deles, cujos amigos de amigos também mudaram.
+    """
+    affected = set(user_ids)
+    for friends in (await friend_graph.graph.friends_of_many(db, user_ids)).values():
+        affected.update(friends)
+    await db.friend_suggestions.update_many(
+        {"user_id": {"$in": list(affected)}},
+        {"$set": {"stale": True}}
+    )
+
+
+async def discard_candidate(db: AsyncIOMotorClient, user_id: str, candidate_id: str):
+    """Remove um candidato já sugerido (por exemplo, após uma solicitação de amizade)"""
+    await db.friend_suggestions.update_many(
+        {"user_id": {"$in": [user_id, candidate_id]}},
+        {"$pull": {"candidates": {"id": {"$in": [user_id, candidate_id]}}}}
+    )
+
+
+async def refresh_stale(db: AsyncIOMotorClient, top_k: int = SUGGESTIONS_TOP_K) -> int:
+    """Recalcula individualmente todos os usuários marcados como `stale`"""
+    refreshed = 0
+    async for document in db.friend_suggestions.find({"stale": True}, {"_id": 0, "user_id": 1}):
+        await refresh_user(db, document["user_id"], top_k)
+        refreshed += 1
+    return refreshed
@@ -0,0 +1,284 @@
+"""
+Timelines materializadas do feed de notícias (fan-out na escrita).
+
+Cada usuário tem um documento em `timelines` com a lista de entradas
+(post_id, author_id, created_at) já ordenada da mais recente para a mais
+antiga. `create_post`, `share_post` e `delete_post` empurram ou retiram
+entradas nas timelines do autor e dos amigos; `get_feed` só precisa ler a
+lista e hidratar os posts. Os amigos conectados recebem um evento `feed`
+(`realtime.py`) a cada post distribuído.
+
+Autores com muitos amigos não recebem fan-out na escrita: seus posts ficam
+marcados com `fanned_out: False` e são mesclados na leitura (modelo híbrido).
+Posts públicos de quem não é amigo também são mesclados na leitura, como o
+feed sempre fez.
+
+A timeline guarda no máximo `TIMELINE_MAX_ENTRIES` entradas. Quando alguma
+entrada antiga já saiu da janela, o documento fica com `truncated: True` e
+as páginas além do fim da lista vêm da consulta original do feed; sem essa
+marca, o fim da lista é o fim do feed (mesmo que `retract_post` a encurte).
+
+`rebuild_timeline` (aceite ou remoção de amizade) nunca substitui a lista:
+retira as entradas de ex-amigos e acrescenta as que faltam, para não
+desfazer um fan-out ou um `retract_post` que rode ao mesmo tempo.
+"""
+import heapq
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import friend_graph
+import indexes
+import pagination
+import realtime
+from visibility import PostVisibility
+
+logger = logging.getLogger(__name__)
+
+# Número máximo de entradas guardadas por timeline
+TIMELINE_MAX_ENTRIES = int(os.environ.get("TIMELINE_MAX_ENTRIES", 800))
+# Acima deste número de amigos o autor passa a usar fan-out na leitura
+FANOUT_MAX_FRIENDS = int(os.environ.get("TIMELINE_FANOUT_MAX_FRIENDS", 5000))
+
+ENTRY_PROJECTION = {"_id": 0, "id": 1, "author_id": 1, "created_at": 1}
+
+indexes.declare("timelines", [("user_id", 1)], unique=True)
+indexes.declare("timelines", [("entries.post_id", 1)])
+
+
+def _entry(post: dict) -> dict:
+    return {
+        "post_id": post["id"],
+        "author_id": post["author_id"],
+        "created_at": post["created_at"]
+    }
+
+
+def _sort_key(entry: dict):
+    return (entry["created_at"], entry["post_id"])
+
+
+async def get_friend_ids(db: AsyncIOMotorClient, user_id: str) -> List[str]:
+    return list(await friend_graph.graph.friends_of(db, user_id))
+
+
+async def fan_out_post(db: AsyncIOMotorClient, post: dict) -> bool:
+    """
+    Insere o post nas timelines do autor e dos amigos.
+    Retorna False quando o autor ultrapassa o limite e o post fica para a leitura.
+    """
+    recipients = [post["author_id"]]
+    fanned_out = True
+
+    if post["privacy"] != "private":
+        friend_ids = await get_friend_ids(db, post["author_id"])
+        if len(friend_ids) > FANOUT_MAX_FRIENDS:
+            fanned_out = False
+        else:
+            recipients.extend(friend_ids)
+
+    # Timelines já cheias perdem a entrada mais antiga no $slice abaixo
+    await db.timelines.update_many(
+        {
+            "user_id": {"$in": recipients},
+            f"entries.{TIMELINE_MAX_ENTRIES - 1}": {"$exists": True},
+            "truncated": {"$ne": True}
+        },
+        {"$set": {"truncated": True}}
+    )
+    await db.timelines.update_many(
+        {"user_id": {"$in": recipients}},
+        {"$push": {"entries": {
+            "$each": [_entry(post)],
+            "$sort": {"created_at": -1, "post_id": -1},
+            "$slice": TIMELINE_MAX_ENTRIES
+        }}}
+    )
+
+    if not fanned_out:
+        await db.posts.update_one({"id": post["id"]}, {"$set": {"fanned_out": False}})
+
+    # Avisar os amigos conectados que há um post novo no feed
+    await realtime.publish(recipients[1:], {"type": "feed", "post_id": post["id"], "author_id": post["author_id"]})
+
+    return fanned_out
+
+
+async def retract_post(db: AsyncIOMotorClient, post_id: str):
+    """Remove o post de todas as timelines em que ele aparece"""
+    await db.timelines.update_many(
+        {"entries.post_id": post_id},
+        {"$pull": {"entries": {"post_id": post_id}}}
+    )
+
+
+async def rebuild_timeline(db: AsyncIOMotorClient, user_id: str, friend_ids: Optional[List[str]] = None, attempts: int = 3) -> List[dict]:
+    """
+    Recalcula a timeline de um usuário a partir da coleção de posts.
+
+    Em vez de substituir a lista (e perder um fan-out ou trazer de volta um
+    post retirado durante o cálculo), retira as entradas de quem deixou de ser
+    amigo e acrescenta, uma a uma, as que faltam.
+    """
+    if friend_ids is None:
+        friend_ids = await get_friend_ids(db, user_id)
+
+    posts = await db.posts.find({
+        "$or": [
+            {"author_id": user_id},
+            {"author_id": {"$in": friend_ids}, "privacy": {"$in": ["public", "friends"]}}
+        ]
+    }, ENTRY_PROJECTION).sort(pagination.keyset_sort()).limit(TIMELINE_MAX_ENTRIES).to_list(TIMELINE_MAX_ENTRIES)
+    entries = [_entry(p) for p in posts]
+
+    await db.timelines.update_one(
+        {"user_id": user_id},
+        {
+            "$pull": {"entries": {"author_id": {"$nin": [user_id, *friend_ids]}}},
+            "$set": {"truncated": len(posts) >= TIMELINE_MAX_ENTRIES, "updated_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+
+    added = []
+    for _ in range(attempts):
+        timeline = await db.timelines.find_one({"user_id": user_id}, {"_id": 0, "entries.post_id": 1})
+        present = {entry["post_id"] for entry in timeline.get("entries", [])}
+        missing = [entry for entry in entries if entry["post_id"] not in present]
+        if not missing:
+            break
+        # Só grava se nenhuma delas entrou por um fan-out concorrente desde a leitura
+        result = await db.timelines.update_one(
+            {"user_id": user_id, "entries.post_id": {"$nin": [entry["post_id"] for entry in missing]}},
+            {"$push": {"entries": {
+                "$each": missing,
+                "$sort": {"created_at": -1, "post_id": -1},
+                "$slice": TIMELINE_MAX_ENTRIES
+            }}}
+        )
+        if result.modified_count:
+            added = [entry["post_id"] for entry in missing]
+            break
+
+    if added:
+        # Posts excluídos entre a consulta e a gravação (retract_post já passou por aqui)
+        alive = set(await db.posts.distinct("id", {"id": {"$in": added}}))
+        removed = [post_id for post_id in added if post_id not in alive]
+        if removed:
+            await db.timelines.update_one({"user_id": user_id}, {"$pull": {"entries": {"post_id": {"$in": removed}}}})
+    return entries
+
+
+async def _legacy_feed_entries(db: AsyncIOMotorClient, visibility: PostVisibility, skip: int, limit: int, cursor: Optional[str]) -> List[dict]:
+    # Consulta original do feed, usada para páginas além da timeline materializada
+    query = pagination.paginate_query(await visibility.mongo_filter(), cursor)
+    posts = db.posts.find(query, ENTRY_PROJECTION).sort(pagination.keyset_sort())
+    if not cursor:
+        posts = posts.skip(skip)
+    return [_entry(p) for p in await posts.limit(limit).to_list(limit)]
+
+
+async def _load_entries(db: AsyncIOMotorClient, user_id: str, wanted: int, cursor: Optional[str]):
+    """
+    Lê as primeiras `wanted` entradas da timeline (após o cursor, se houver)
+    e se a timeline já perdeu entradas antigas (`truncated`).
+    """
+    entries = "$entries"
+    if cursor:
+        created_at, post_id = pagination.decode_cursor(cursor)
+        entries = {"$filter": {"input": "$entries", "as": "entry", "cond": {"$or": [
+            {"$lt": ["$$entry.created_at", created_at]},
+            {"$and": [
+                {"$eq": ["$$entry.created_at", created_at]},
+                {"$lt": ["$$entry.post_id", post_id]}
+            ]}
+        ]}}}
+    timelines = await db.timelines.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$project": {
+            "_id": 0,
+            # Timelines anteriores à marca: cheias são tratadas como truncadas
+            "truncated": {"$ifNull": ["$truncated", {"$gte": [{"$size": "$entries"}, TIMELINE_MAX_ENTRIES]}]},
+            "entries": {"$slice": [entries, wanted]}
+        }}
+    ]).to_list(1)
+    if not timelines:
+        return None, False
+    return timelines[0]["entries"], timelines[0]["truncated"]
+
+
+async def read_timeline(db: AsyncIOMotorClient, user_id: str, skip: int = 0, limit: int = 10, cursor: Optional[str] = None, visibility: Optional[PostVisibility] = None) -> List[dict]:
+    """
+    Retorna as entradas (post_id, author_id, created_at) de uma página do feed,
+    já ordenadas. Com `cursor`, a página começa logo após o cursor e `skip` é ignorado.
+    `visibility` é a do leitor da requisição, quando a rota já a tem.
+    """
+    wanted = limit if cursor else skip + limit
+    friend_ids = await get_friend_ids(db, user_id)
+    if visibility is None:
+        visibility = PostVisibility(db, user_id)
+
+    if wanted > TIMELINE_MAX_ENTRIES:
+        return await _legacy_feed_entries(db, visibility, skip, limit, cursor)
+
+    entries, truncated = await _load_entries(db, user_id, wanted, cursor)
+    if entries is None:
+        # Usuário ainda sem timeline (não passou pelo backfill)
+        entries = await rebuild_timeline(db, user_id, friend_ids)
+        truncated = len(entries) >= TIMELINE_MAX_ENTRIES
+        if cursor:
+            created_at, post_id = pagination.decode_cursor(cursor)
+            entries = [e for e in entries if _sort_key(e) < (created_at, post_id)]
+        entries = entries[:wanted]
+
+    if truncated and len(entries) < wanted:
+        # A página passou do fim da janela materializada
+        return await _legacy_feed_entries(db, visibility, skip, limit, cursor)
+
+    # Fan-out na leitura: posts públicos e posts de amigos com muitos amigos
+    public_posts = await db.posts.find(
+        pagination.paginate_query({"privacy": "public"}, cursor), ENTRY_PROJECTION
+    ).sort(pagination.keyset_sort()).limit(wanted).to_list(wanted)
+
+    unfanned_posts = []
+    if friend_ids:
+        unfanned_posts = await db.posts.find(
+            pagination.paginate_query(
+                {"author_id": {"$in": friend_ids}, "privacy": "friends", "fanned_out": False},
+                cursor
+            ),
+            ENTRY_PROJECTION
+        ).sort(pagination.keyset_sort()).limit(wanted).to_list(wanted)
+
+    sources = [
+        entries,
+        [_entry(p) for p in public_posts],
+        [_entry(p) for p in unfanned_posts]
+    ]
+
+    page = []
+    seen = set()
+    for entry in heapq.merge(*sources, key=_sort_key, reverse=True):
+        if entry["post_id"] in seen:
+            continue
+        seen.add(entry["post_id"])
+        page.append(entry)
+        if len(page) >= wanted:
+            break
+
+    return page if cursor else page[skip:wanted]
+
+
+async def backfill_timelines(db: AsyncIOMotorClient, batch_size: int = 200) -> int:
+    """Reconstrói a timeline de todos os usuários existentes"""
+    total = 0
+    cursor = db.users.find({}, {"_id": 0, "id": 1}).batch_size(batch_size)
+    async for user in cursor:
+        await rebuild_timeline(db, user["id"])
+        total += 1
+        if total % batch_size == 0:
+            logger.info("Timelines reconstruídas: %d", total)
+    return total
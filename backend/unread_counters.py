@@ -0,0 +1,196 @@
+"""
+Contadores de notificações não lidas.
+
+Cada usuário tem um documento em `notification_counters` ({user_id, unread}),
+mantido junto com as notificações: o outbox incrementa quando um grupo é
+criado ou volta a ficar não lido, e as rotas de marcar como lida/excluir
+decrementam ou zeram. `GET /notifications/unread-count` lê o contador, com
+cache em processo de `UNREAD_COUNTER_TTL_SECONDS` (o TTL limita o atraso em
+relação aos incrementos feitos por outros workers).
+
+Usuários sem contador são contados uma vez com `count_documents`. Corridas
+entre flush e leitura podem deixar o contador alguns itens fora; a
+reconciliação (`python cli.py reconcile-unread`, agendada fora dos workers)
+recalcula os contadores dos usuários com atividade recente a partir das
+notificações, sem sobrescrever incrementos feitos durante a conferência.
+"""
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+import indexes
+
+UNREAD_COUNTER_TTL_SECONDS = float(os.environ.get("UNREAD_COUNTER_TTL_SECONDS", 5))
+UNREAD_COUNTER_MAX_USERS = int(os.environ.get("UNREAD_COUNTER_MAX_USERS", 100000))
+
+indexes.declare("notification_counters", [("user_id", 1)], unique=True)
+# Reconciliação incremental: contadores alterados e notificações criadas desde o corte
+indexes.declare("notification_counters", [("updated_at", 1)])
+indexes.declare("notifications", [("created_at", 1)])
+
+
+class UnreadCounters:
+    def __init__(self, max_users: int = UNREAD_COUNTER_MAX_USERS, ttl: float = UNREAD_COUNTER_TTL_SECONDS):
+        self.max_users = max_users
+        self.ttl = ttl
+        # user_id -> (momento da carga, não lidas)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.repaired = 0
+
+    def _put(self, user_id: str, unread: int):
+        self._cache[user_id] = (time.monotonic(), unread)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+
+    def _adjust(self, user_id: str, delta: int):
+        # Aplicar a alteração local sem renovar o TTL da entrada
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            self._cache[user_id] = (entry[0], max(entry[1] + delta, 0))
+
+    async def get(self, db: AsyncIOMotorClient, user_id: str) -> int:
+        """Número de notificações não lidas do usuário"""
+        entry = self._cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+            self.hits += 1
+            self._cache.move_to_end(user_id)
+            return entry[1]
+
+        self.misses += 1
+        counter = await db.notification_counters.find_one({"user_id": user_id}, {"_id": 0, "unread": 1})
+        if counter is None:
+            # Primeiro acesso: contar uma vez e criar o contador
+            unread = await db.notifications.count_documents({"recipient_id": user_id, "is_read": False})
+            await db.notification_counters.update_one(
+                {"user_id": user_id},
+                {"$setOnInsert": {"unread": unread, "updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+        else:
+            unread = max(counter["unread"], 0)
+        self._put(user_id, unread)
+        return unread
+
+    async def increment(self, db: AsyncIOMotorClient, deltas: Dict[str, int]):
+        """Soma `deltas` (user_id -> quantidade) aos contadores, em uma única escrita"""
+        deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        await db.notification_counters.bulk_write([
+            UpdateOne(
+                {"user_id": user_id},
+                {"$inc": {"unread": delta}, "$set": {"updated_at": datetime.utcnow()}},
+                upsert=True
+            )
+            for user_id, delta in deltas.items()
+        ], ordered=False)
+        for user_id, delta in deltas.items():
+            self._adjust(user_id, delta)
+
+    async def decrement(self, db: AsyncIOMotorClient, user_id: str):
+        await db.notification_counters.update_one(
+            {"user_id": user_id, "unread": {"$gt": 0}},
+            {"$inc": {"unread": -1}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+        self._adjust(user_id, -1)
+
+    async def reset(self, db: AsyncIOMotorClient, user_id: str):
+        await db.notification_counters.update_one(
+            {"user_id": user_id},
+            {"$set": {"unread": 0, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        self._put(user_id, 0)
+
+    async def _changed_user_ids(self, db: AsyncIOMotorClient, since: Optional[datetime], batch_size: int) -> AsyncIterator[str]:
+        if since is None:
+            # Todos os usuários com contador ou com notificações não lidas
+            async for counter in db.notification_counters.find({}, {"_id": 0, "user_id": 1}).batch_size(batch_size):
+                yield counter["user_id"]
+            for user_id in await db.notifications.distinct("recipient_id", {"is_read": False}):
+                yield user_id
+            return
+        # Contadores alterados e notificações novas sem incremento (falha entre as escritas)
+        changed = await db.notification_counters.distinct("user_id", {"updated_at": {"$gte": since}})
+        created = await db.notifications.distinct("recipient_id", {"created_at": {"$gte": since}})
+        for user_id in dict.fromkeys([*changed, *created]):
+            yield user_id
+
+    async def _repair(self, db: AsyncIOMotorClient, user_ids: List[str]) -> int:
+        # Ler o contador antes de contar: a escrita só vale se ele não mudou desde a leitura
+        stored = {
+            counter["user_id"]: counter["unread"]
+            async for counter in db.notification_counters.find(
+                {"user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "unread": 1}
+            )
+        }
+        actual = {
+            row["_id"]: row["unread"]
+            async for row in db.notifications.aggregate([
+                {"$match": {"recipient_id": {"$in": user_ids}, "is_read": False}},
+                {"$group": {"_id": "$recipient_id", "unread": {"$sum": 1}}}
+            ])
+        }
+
+        operations = []
+        for user_id in user_ids:
+            unread = actual.get(user_id, 0)
+            if user_id not in stored:
+                if unread:
+                    operations.append(UpdateOne(
+                        {"user_id": user_id},
+                        {"$setOnInsert": {"unread": unread, "updated_at": datetime.utcnow()}},
+                        upsert=True
+                    ))
+            elif stored[user_id] != unread:
+                # Um $inc concorrente muda o valor e faz esta correção ser ignorada
+                operations.append(UpdateOne(
+                    {"user_id": user_id, "unread": stored[user_id]},
+                    {"$set": {"unread": unread, "updated_at": datetime.utcnow()}}
+                ))
+        if not operations:
+            return 0
+        result = await db.notification_counters.bulk_write(operations, ordered=False)
+        for user_id in user_ids:
+            self._cache.pop(user_id, None)
+        return result.modified_count
+
+    async def reconcile(self, db: AsyncIOMotorClient, since: Optional[datetime] = None, batch_size: int = 500) -> int:
+        """
+        Recalcula os contadores a partir das notificações para os usuários com
+        atividade desde `since` (todos, sem `since`). Retorna quantos foram corrigidos.
+        """
+        repaired = 0
+        batch: List[str] = []
+        async for user_id in self._changed_user_ids(db, since, batch_size):
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                repaired += await self._repair(db, list(dict.fromkeys(batch)))
+                batch = []
+        if batch:
+            repaired += await self._repair(db, list(dict.fromkeys(batch)))
+        self.repaired += repaired
+        return repaired
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "users_cached": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "repaired": self.repaired
+        }
+
+
+# Contadores compartilhados pelas rotas do worker
+counters = UnreadCounters()
+
@@ -0,0 +1,139 @@
+"""
+Índice de busca de usuários por nome.
+
+Cada documento de `users` guarda o nome normalizado (sem acentos, em
+minúsculas) em `search_tokens` e os trigramas desses tokens em
+`search_trigrams`, ambos indexados. A busca usa regex ancorada (`^prefixo`)
+nos tokens, que o Mongo resolve com uma faixa do índice, e completa com os
+trigramas para trechos no meio do nome ("silva" encontra "Dasilva"). Os
+amigos que combinam são buscados antes dos demais candidatos, para o limite
+`SEARCH_CANDIDATES` não deixá-los de fora em nomes comuns. Os candidatos são
+ordenados com amigos primeiro, depois amigos de amigos (por número de amigos
+em comum) e depois os demais.
+
+Busca por email só encontra o endereço exato. Os campos são gravados no
+cadastro e quando o nome muda; `python cli.py reindex-users` preenche os
+usuários antigos.
+"""
+import re
+import unicodedata
+from typing import List
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+import friend_graph
+import indexes
+
+# Candidatos lidos do banco antes da ordenação
+SEARCH_CANDIDATES = 200
+
+SEARCH_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "avatar": 1, "avatar_variants": 1,
+    "location": 1, "is_verified": 1, "search_tokens": 1
+}
+
+indexes.declare("users", [("search_tokens", 1)])
+indexes.declare("users", [("search_trigrams", 1)])
+
+
+def normalize(text: str) -> List[str]:
+    """Tokens do texto sem acentos e em minúsculas, na ordem, sem repetições"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return list(dict.fromkeys(re.findall(r"\w+", stripped.casefold())))
+
+
+def trigrams(token: str) -> List[str]:
+    return [token[i:i + 3] for i in range(len(token) - 2)]
+
+
+def search_fields(name: str) -> dict:
+    """Campos de busca a gravar no documento do usuário"""
+    tokens = normalize(name)
+    return {
+        "search_tokens": tokens,
+        "search_trigrams": sorted({trigram for token in tokens for trigram in trigrams(token)})
+    }
+
+
+async def _candidates(db: AsyncIOMotorClient, conditions: List[dict], exclude: List[str], limit: int, friend_ids: List[str]) -> List[dict]:
+    # Amigos primeiro, depois os demais até completar o limite
+    users = []
+    if friend_ids:
+        users = await db.users.find(
+            {"$and": conditions, "id": {"$in": friend_ids, "$nin": exclude}},
+            SEARCH_PROJECTION
+        ).limit(limit).to_list(limit)
+    if len(users) < limit:
+        remaining = limit - len(users)
+        users += await db.users.find(
+            {"$and": conditions, "id": {"$nin": [*exclude, *(user["id"] for user in users)]}},
+            SEARCH_PROJECTION
+        ).limit(remaining).to_list(remaining)
+    return users
+
+
+async def search(db: AsyncIOMotorClient, query: str, viewer_id: str, limit: int = 20) -> List[dict]:
+    """Usuários cujo nome combina com `query` (ou com o email exato), já ordenados"""
+    query = query.strip()
+    if "@" in query:
+        return await db.users.find(
+            {"email": {"$in": list({query, query.lower()})}, "id": {"$ne": viewer_id}},
+            SEARCH_PROJECTION
+        ).to_list(limit)
+
+    tokens = normalize(query)
+    if not tokens:
+        return []
+
+    friends = await friend_graph.graph.friends_of(db, viewer_id)
+    friend_ids = list(friends)
+
+    # Todos os termos como prefixo de algum token do nome
+    prefix_conditions = [{"search_tokens": {"$regex": f"^{re.escape(token)}"}} for token in tokens]
+    users = await _candidates(db, prefix_conditions, [viewer_id], SEARCH_CANDIDATES, friend_ids)
+    prefix_ids = {user["id"] for user in users}
+
+    # Poucos resultados: procurar os termos também no meio dos tokens
+    if len(users) < limit and any(len(token) >= 3 for token in tokens):
+        trigram_conditions = [
+            {"search_trigrams": {"$all": trigrams(token)}} for token in tokens if len(token) >= 3
+        ]
+        extra = await _candidates(db, trigram_conditions, [viewer_id, *prefix_ids], SEARCH_CANDIDATES - len(users), friend_ids)
+        users.extend(
+            user for user in extra
+            if all(any(token in name_token for name_token in user.get("search_tokens", [])) for token in tokens)
+        )
+
+    if not users:
+        return []
+
+    mutual = await friend_graph.graph.mutual_counts(
+        db, viewer_id, [user["id"] for user in users if user["id"] not in friends]
+    )
+
+    def rank(user: dict):
+        common = mutual.get(user["id"], 0)
+        tier = 0 if user["id"] in friends else 1 if common else 2
+        return (tier, user["id"] not in prefix_ids, -common, normalize(user["name"]))
+
+    users.sort(key=rank)
+    return users[:limit]
+
+
+async def reindex(db: AsyncIOMotorClient, full: bool = False, batch_size: int = 1000) -> int:
+    """Grava os campos de busca dos usuários (só os que não têm, ou todos com `full`)"""
+    query = {} if full else {"search_tokens": {"$exists": False}}
+    total = 0
+    operations: List[UpdateOne] = []
+    async for user in db.users.find(query, {"_id": 0, "id": 1, "name": 1}):
+        operations.append(UpdateOne({"id": user["id"]}, {"$set": search_fields(user.get("name", ""))}))
+        if len(operations) >= batch_size:
+            await db.users.bulk_write(operations, ordered=False)
+            total += len(operations)
+            operations = []
+    if operations:
+        await db.users.bulk_write(operations, ordered=False)
+        total += len(operations)
+    return total
@@ -0,0 +1,87 @@
+"""
+Visibilidade dos posts por privacidade e amizade.
+
+`PostVisibility` é usada pelas rotas de posts (dependência `get_post_visibility`) e pela
+consulta original do feed em `timelines.py`, para que listagens e acesso a
+um post isolado apliquem a mesma regra.
+"""
+from typing import Dict, Iterable, List, Optional
+
+from fastapi import HTTPException
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import friend_graph
+from models import PrivacyLevel
+
+
+class PostVisibility:
+    """
+    Regras de visibilidade dos posts para um leitor.
+
+    O autor vê todos os seus posts, amigos veem posts públicos e de amigos, os
+    demais só os públicos. As amizades de todos os autores de um lote são
+    resolvidas juntas (uma consulta ao grafo de amizades) e memorizadas
+    durante a requisição; `mongo_filter` emite a mesma regra como filtro de
+    consulta para as listagens.
+    """
+    ALL_LEVELS = [level.value for level in PrivacyLevel]
+    FRIEND_LEVELS = [PrivacyLevel.PUBLIC.value, PrivacyLevel.FRIENDS.value]
+    PUBLIC_LEVELS = [PrivacyLevel.PUBLIC.value]
+
+    def __init__(self, db: AsyncIOMotorClient, viewer_id: str):
+        self.db = db
+        self.viewer_id = viewer_id
+        # author_id -> é amigo do leitor
+        self._is_friend: Dict[str, bool] = {}
+
+    async def _resolve(self, author_ids: Iterable[str]):
+        missing = {a for a in author_ids if a != self.viewer_id and a not in self._is_friend}
+        if missing:
+            friends = await friend_graph.graph.friends_of(self.db, self.viewer_id)
+            for author_id in missing:
+                self._is_friend[author_id] = author_id in friends
+
+    def _levels(self, author_id: str) -> List[str]:
+        if author_id == self.viewer_id:
+            return self.ALL_LEVELS
+        return self.FRIEND_LEVELS if self._is_friend[author_id] else self.PUBLIC_LEVELS
+
+    async def filter_visible(self, posts: List[dict]) -> List[dict]:
+        """Posts do lote que o leitor pode ver, na mesma ordem"""
+        await self._resolve(post["author_id"] for post in posts)
+        return [post for post in posts if post["privacy"] in self._levels(post["author_id"])]
+
+    async def can_view(self, post: dict) -> bool:
+        return bool(await self.filter_visible([post]))
+
+    async def require(self, post: dict, detail: str = "Not authorized to view this post"):
+        if not await self.can_view(post):
+            raise HTTPException(status_code=403, detail=detail)
+
+    async def mongo_filter(self, author_ids: Optional[List[str]] = None) -> dict:
+        """
+        Filtro de posts visíveis ao leitor, restrito aos autores informados
+        (ou a qualquer autor, quando `author_ids` é None)
+        """
+        if author_ids is None:
+            friend_ids = list(await friend_graph.graph.friends_of(self.db, self.viewer_id))
+            return {"$or": [
+                {"author_id": self.viewer_id},
+                {"privacy": PrivacyLevel.PUBLIC.value},
+                {"author_id": {"$in": friend_ids}, "privacy": PrivacyLevel.FRIENDS.value}
+            ]}
+
+        # Agrupar os autores pelos níveis de privacidade visíveis
+        await self._resolve(author_ids)
+        groups: Dict[tuple, List[str]] = {}
+        for author_id in dict.fromkeys(author_ids):
+            groups.setdefault(tuple(self._levels(author_id)), []).append(author_id)
+        clauses = []
+        for levels, ids in groups.items():
+            clause = {"author_id": ids[0] if len(ids) == 1 else {"$in": ids}}
+            if list(levels) != self.ALL_LEVELS:
+                clause["privacy"] = {"$in": list(levels)}
+            clauses.append(clause)
+        if not clauses:
+            return {"author_id": {"$in": []}}
+        return clauses[0] if len(clauses) == 1 else {"$or": clauses}
@@ -0,0 +1,105 @@
+"""
+Configuração comum dos testes do backend.
+
+Os módulos do backend são importados pelo nome (`import timelines`), como o
+servidor faz; o banco é o `mongomock_motor`, em memória, um por teste.
+
+Testes marcados com `benchmark` medem tempo e só rodam com
+`pytest --benchmark`; os que precisam de um Mongo de verdade usam a fixture
+`real_db` (`BENCHMARK_MONGO_URL`) e são pulados sem ela.
+"""
+import os
+import sys
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="rodar também os testes de desempenho")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: teste de desempenho (só com --benchmark)")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="teste de desempenho: rodar com --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["test_database"]
+
+
+@pytest.fixture
+async def real_db():
+    url = os.environ.get("BENCHMARK_MONGO_URL")
+    if not url:
+        pytest.skip("BENCHMARK_MONGO_URL não definido")
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(url)
+    database = client["benchmark_" + os.urandom(4).hex()]
+    yield database
+    await client.drop_database(database.name)
+    client.close()
+
+
+@pytest.fixture(autouse=True)
+def friend_graph_cache(monkeypatch):
+    # O grafo de amizades é um cache do processo: cada teste começa vazio
+    import friend_graph
+
+    graph = friend_graph.FriendGraph()
+    monkeypatch.setattr(friend_graph, "graph", graph)
+    return graph
+
+
+@pytest.fixture(autouse=True)
+def user_card_cache():
+    import loaders
+
+    loaders.cards.clear()
+    yield loaders.cards
+    loaders.cards.clear()
+
+
+@pytest.fixture
+def make_client(db):
+    """Cliente HTTP das rotas da API sobre `db`, autenticado como `user_id`"""
+    from fastapi import FastAPI
+    from fastapi.responses import ORJSONResponse
+    from fastapi.testclient import TestClient
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from auth import get_current_active_user, get_current_user
+    from models import Principal
+    from routes import friends, notifications, posts, users
+
+    def make(user_id: str = "me") -> TestClient:
+        app = FastAPI(default_response_class=ORJSONResponse)
+        for module in (users, friends, posts, notifications):
+            app.include_router(module.router, prefix="/api")
+        principal = Principal(id=user_id, name=user_id)
+        app.dependency_overrides[AsyncIOMotorClient] = lambda: db
+        app.dependency_overrides[get_current_user] = lambda: principal
+        app.dependency_overrides[get_current_active_user] = lambda: principal
+        return TestClient(app)
+
+    return make
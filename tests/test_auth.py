@@ -0,0 +1,126 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import auth
+from routes import auth as auth_routes
+
+# `token_version` presente: o mongomock ignora find_one_and_update com projeção de campo ausente
+USER = {"id": "ana", "email": "ana@example.com", "name": "Ana", "password": "x", "token_version": 0}
+
+
+@pytest.fixture(autouse=True)
+def revocations(monkeypatch):
+    revocations = auth.TokenRevocations()
+    monkeypatch.setattr(auth, "revocations", revocations)
+    monkeypatch.setattr(auth_routes, "revocations", revocations)
+    return revocations
+
+
+@pytest.fixture
+def client(db):
+    app = FastAPI()
+    app.include_router(auth_routes.router, prefix="/api")
+    app.dependency_overrides[AsyncIOMotorClient] = lambda: db
+    return TestClient(app)
+
+
+@pytest.fixture
+def login(db):
+    asyncio.run(db.users.insert_one(dict(USER)))
+
+    def login():
+        user = asyncio.run(db.users.find_one({"id": "ana"}))
+        return asyncio.run(auth.issue_tokens(db, user))
+
+    return login
+
+
+def _me(client, access_token: str) -> int:
+    return client.get("/api/auth/me", headers={"Authorization": f"Bearer {access_token}"}).status_code
+
+
+def _refresh(client, refresh_token: str):
+    return client.post("/api/auth/refresh", json={"refresh_token": refresh_token})
+
+
+def test_refresh_rotates_the_pair_and_consumes_the_old_token(client, login):
+    tokens = login()
+
+    response = _refresh(client, tokens.refresh_token)
+    assert response.status_code == 200
+    rotated = response.json()
+    assert rotated["refresh_token"] != tokens.refresh_token
+    assert _me(client, rotated["access_token"]) == 200
+
+    # Cada token de atualização vale uma única vez
+    assert _refresh(client, tokens.refresh_token).status_code == 401
+    assert _refresh(client, rotated["refresh_token"]).status_code == 200
+
+
+def test_token_types_are_not_interchangeable(client, login):
+    tokens = login()
+
+    assert _me(client, tokens.refresh_token) == 401
+    assert _refresh(client, tokens.access_token).status_code == 401
+
+
+def test_logout_revokes_only_this_session(client, login):
+    tokens, other = login(), login()
+    headers = {"Authorization": f"Bearer {tokens.access_token}"}
+
+    response = client.post("/api/auth/logout", json={"refresh_token": tokens.refresh_token}, headers=headers)
+    assert response.status_code == 200
+
+    assert _me(client, tokens.access_token) == 401
+    assert _refresh(client, tokens.refresh_token).status_code == 401
+    assert _me(client, other.access_token) == 200
+    assert _refresh(client, other.refresh_token).status_code == 200
+
+
+def test_logout_of_all_sessions_bumps_the_token_version(client, login, db):
+    tokens, other = login(), login()
+    headers = {"Authorization": f"Bearer {tokens.access_token}"}
+
+    assert client.post("/api/auth/logout", json={"all_sessions": True}, headers=headers).status_code == 200
+
+    assert _me(client, other.access_token) == 401
+    assert _refresh(client, other.refresh_token).status_code == 401
+    # Tokens emitidos depois trazem a versão nova
+    assert _me(client, login().access_token) == 200
+
+
+def test_revoked_token_version_is_rejected_at_refresh_in_other_workers(client, login, db):
+    tokens = login()
+    # Outro worker encerrou as sessões: este não conhece a versão mínima
+    asyncio.run(db.users.update_one({"id": "ana"}, {"$inc": {"token_version": 1}}))
+
+    assert _refresh(client, tokens.refresh_token).status_code == 401
+
+
+def test_legacy_token_is_accepted_during_the_transition(client, login, monkeypatch):
+    login()
+    legacy = auth.create_access_token({"sub": "ana"}, expires_delta=timedelta(days=7))
+
+    response = client.get("/api/auth/me", headers={"Authorization": f"Bearer {legacy}"})
+    assert response.status_code == 200
+    assert response.json()["name"] == "Ana"
+    # Não serve como token de atualização
+    assert _refresh(client, legacy).status_code == 401
+
+    monkeypatch.setattr(auth, "ACCEPT_LEGACY_TOKENS", 0)
+    assert _me(client, legacy) == 401
+
+
+def test_legacy_token_is_rejected_after_sessions_are_revoked(client, login):
+    login()
+    legacy = auth.create_access_token({"sub": "ana"}, expires_delta=timedelta(days=7))
+    headers = {"Authorization": f"Bearer {legacy}"}
+
+    # Logout com um token antigo encerra todas as sessões
+    assert client.post("/api/auth/logout", json={}, headers=headers).status_code == 200
+    assert _me(client, legacy) == 401
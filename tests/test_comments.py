@@ -0,0 +1,73 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import comments
+import indexes
+import reactions
+
+AT = datetime(2026, 1, 1)
+
+
+def _comment(index: int, **fields) -> dict:
+    return {"id": f"c{index}", "author_id": "author", "content": f"comment {index}", "created_at": AT + timedelta(minutes=index), **fields}
+
+
+async def _legacy_post(db, *embedded: dict):
+    await indexes.ensure_indexes(db)
+    await db.posts.insert_one({"id": "post", "author_id": "author", "privacy": "public", "created_at": AT, "comments": list(embedded)})
+
+
+@pytest.mark.anyio
+async def test_migration_converts_embedded_likes(db):
+    await _legacy_post(db, _comment(1, likes=["ana", "bia", "ana"]), _comment(2))
+
+    assert await comments.migrate_embedded_comments(db) == 1
+
+    stored = {comment["id"]: comment for comment in await db.comments.find({"post_id": "post"}).to_list(None)}
+    assert "likes" not in stored["c1"]
+    assert stored["c1"]["like_count"] == 2
+    assert stored["c2"]["like_count"] == 0
+    assert sorted(await db.reactions.distinct("user_id", {"target_id": "c1"})) == ["ana", "bia"]
+    # Nada sobra para a reconciliação corrigir
+    assert await reactions.reconcile_like_counts(db, "comments", reactions.COMMENT) == 0
+
+
+@pytest.mark.anyio
+async def test_migration_converts_likes_of_comments_copied_earlier(db):
+    await _legacy_post(db, _comment(1, likes=["ana"]))
+    # Cópia feita por uma versão anterior da migração, com o array ainda presente
+    await db.comments.insert_one({**_comment(1, likes=["ana"]), "post_id": "post"})
+
+    assert await comments.migrate_embedded_comments(db) == 1
+
+    stored = await db.comments.find_one({"id": "c1"})
+    assert "likes" not in stored
+    assert stored["like_count"] == 1
+    assert await db.reactions.count_documents({"target_id": "c1"}) == 1
+
+
+@pytest.mark.anyio
+async def test_retry_keeps_likes_counted_after_the_first_copy(db):
+    await _legacy_post(db, _comment(1, likes=["ana"]))
+    post = await db.posts.find_one({"id": "post"})
+    # O array mudou depois da leitura: a primeira tentativa copia, mas não remove o array
+    await db.posts.update_one({"id": "post"}, {"$push": {"comments": _comment(2)}})
+    assert not await comments.migrate_post_comments(db, post)
+    await reactions.toggle(db, "comments", reactions.COMMENT, "c1", "bia")
+
+    assert await comments.migrate_embedded_comments(db) == 1
+    assert (await db.comments.find_one({"id": "c1"}))["like_count"] == 2
+
+
+def test_liking_an_embedded_comment_already_liked_unlikes_it(db, make_client):
+    asyncio.run(_legacy_post(db, _comment(1, likes=["me", "ana"])))
+    client = make_client("me")
+
+    response = client.post("/api/posts/post/comments/c1/like")
+    assert response.status_code == 200
+    assert response.json() == {"liked": False, "like_count": 1}
+
+    response = client.post("/api/posts/post/comments/c1/like")
+    assert response.json() == {"liked": True, "like_count": 2}
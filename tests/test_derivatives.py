@@ -0,0 +1,90 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from PIL import Image
+
+import derivatives
+import indexes
+import media_blobs
+from storage import LocalStorage, MediaStorage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    backend = LocalStorage(root=tmp_path, base_url="https://cdn", secret="test")
+    storage = MediaStorage(backend)
+    monkeypatch.setattr(derivatives, "media_storage", storage)
+    monkeypatch.setattr(media_blobs, "media_storage", storage)
+    return backend
+
+
+@pytest.fixture
+def processor():
+    processor = derivatives.DerivativeProcessor()
+    # Threads em vez de processos: o teste observa o que acontece entre as etapas
+    processor._executor = ThreadPoolExecutor(max_workers=1)
+    yield processor
+    processor._executor.shutdown()
+
+
+def _png() -> bytes:
+    output = io.BytesIO()
+    Image.new("RGB", (400, 300), "red").save(output, "PNG")
+    return output.getvalue()
+
+
+async def _original(db, local, key: str = "users/me/avatar/a.png", register: bool = True):
+    await indexes.ensure_indexes(db)
+    local.put(key, io.BytesIO(_png()), "image/png")
+    if register:
+        await media_blobs.register_keys(db, [key])
+    return f"https://cdn/{key}"
+
+
+def _variant_files(local, key: str = "users/me/avatar/a.png"):
+    return sorted(name for name in derivatives.VARIANTS if local.exists(derivatives.variant_key(key, name)))
+
+
+async def test_variants_are_removed_with_the_original(db, local, processor):
+    url = await _original(db, local)
+
+    variants = await processor.generate(db, url)
+    assert variants["thumb"] == "https://cdn/users/me/avatar/a_thumb.webp"
+    assert _variant_files(local) == sorted(derivatives.VARIANTS)
+
+    # Imagem trocada: o original perde a referência e a varredura leva as versões junto
+    await media_blobs.release(db, [url])
+    await db.media_blobs.update_one({}, {"$set": {"unreferenced_at": datetime.utcnow() - timedelta(days=2)}})
+    assert await media_blobs.sweep(db) == 1
+    assert local.exists("users/me/avatar/a.png") is None
+    assert _variant_files(local) == []
+
+
+async def test_untracked_original_gets_no_variants(db, local, processor):
+    url = await _original(db, local, register=False)
+
+    assert await processor.generate(db, url) is None
+    assert _variant_files(local) == []
+
+
+async def test_variants_written_after_the_sweep_started_are_discarded(db, local, processor, monkeypatch):
+    url = await _original(db, local)
+    render = derivatives.render_variants
+
+    def render_while_swept(data):
+        # A varredura marca o registro enquanto as versões são geradas
+        asyncio.run_coroutine_threadsafe(
+            db.media_blobs.update_one({}, {"$set": {"state": "deleting"}}), loop
+        ).result()
+        return render(data)
+
+    loop = asyncio.get_running_loop()
+    monkeypatch.setattr(derivatives, "render_variants", render_while_swept)
+
+    assert await processor.generate(db, url) is None
+    assert _variant_files(local) == []
@@ -0,0 +1,97 @@
+import random
+import time
+
+import pytest
+
+import friend_graph
+
+pytestmark = pytest.mark.anyio
+
+
+def _friendships(pairs):
+    return [
+        {"id": f"{a}-{b}", "requester_id": a, "recipient_id": b, "status": "accepted"}
+        for a, b in pairs
+    ]
+
+
+def _random_pairs(users, edges, seed=3):
+    rng = random.Random(seed)
+    pairs = set()
+    while len(pairs) < edges:
+        a, b = rng.sample(users, 2)
+        pairs.add(tuple(sorted((a, b))))
+    return sorted(pairs)
+
+
+def _friend_sets(pairs):
+    friends = {}
+    for a, b in pairs:
+        friends.setdefault(a, set()).add(b)
+        friends.setdefault(b, set()).add(a)
+    return friends
+
+
+async def test_mutual_counts_match_set_intersections(db):
+    users = [f"user-{index}" for index in range(60)]
+    pairs = _random_pairs(users, 400)
+    await db.friend_requests.insert_many(_friendships(pairs))
+    friends = _friend_sets(pairs)
+    graph = friend_graph.FriendGraph()
+
+    counts = await graph.mutual_counts(db, "user-0", users[1:])
+    assert counts == {other: len(friends["user-0"] & friends.get(other, set())) for other in users[1:]}
+    assert set(await graph.mutual_friends(db, "user-0", "user-1")) == friends["user-0"] & friends["user-1"]
+
+
+async def test_intern_table_follows_the_lru(db):
+    # Cada usuário tem amigos próprios: sem renumeração a tabela cresceria sem limite
+    pairs = [(f"user-{index}", f"friend-{index}-{k}") for index in range(200) for k in range(5)]
+    pairs += [("user-0", "user-1"), ("user-1", "shared"), ("user-0", "shared")]
+    await db.friend_requests.insert_many(_friendships(pairs))
+    graph = friend_graph.FriendGraph(max_users=10, max_interned=60)
+
+    for index in range(200):
+        await graph.friends_of(db, f"user-{index}")
+        assert len(graph._user_ids) <= 2 * 60
+
+    assert graph.reinterns > 0
+    assert await graph.mutual_counts(db, "user-0", ["user-1", "user-2"]) == {"user-1": 1, "user-2": 0}
+    assert await graph.mutual_friends(db, "user-0", "user-1") == ["shared"]
+
+
+async def test_clear_drops_entries_and_interned_ids(db):
+    await db.friend_requests.insert_many(_friendships([("a", "b")]))
+    graph = friend_graph.FriendGraph()
+    await graph.friends_of(db, "a")
+    graph.clear()
+    assert graph.stats()["users_cached"] == 0
+    assert graph.stats()["interned"] == 0
+
+
+def _list_mutual_count(own, other):
+    # Implementação anterior: listas de UUIDs e `in` em lista
+    return len([friend_id for friend_id in own if friend_id in other])
+
+
+@pytest.mark.benchmark
+async def test_batch_counts_vs_list_intersection(db):
+    users = [f"{index:08d}-uuid" for index in range(5000)]
+    pairs = _random_pairs(users, 150_000)
+    await db.friend_requests.insert_many(_friendships(pairs))
+    friends = {user: sorted(ids) for user, ids in _friend_sets(pairs).items()}
+    graph = friend_graph.FriendGraph()
+    others = users[1:301]
+    await graph.friend_arrays_of_many(db, [users[0], *others])
+
+    started = time.perf_counter()
+    expected = {other: _list_mutual_count(friends[users[0]], friends[other]) for other in others}
+    list_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    counts = await graph.mutual_counts(db, users[0], others)
+    array_seconds = time.perf_counter() - started
+
+    print(f"\n300 contagens: listas {list_seconds * 1000:.1f} ms, arrays {array_seconds * 1000:.1f} ms")
+    assert counts == expected
+    assert array_seconds < list_seconds
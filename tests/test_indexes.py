@@ -0,0 +1,52 @@
+import pytest
+from pymongo.errors import AutoReconnect, OperationFailure, ServerSelectionTimeoutError
+
+import indexes
+
+pytestmark = pytest.mark.anyio
+
+
+class FlakyCollection:
+    def __init__(self, failures):
+        self.failures = list(failures)
+        self.calls = 0
+
+    async def create_indexes(self, models):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return [model.document["name"] for model in models]
+
+
+class FlakyDb:
+    def __init__(self, failures):
+        self.collection = FlakyCollection(failures)
+
+    def __getitem__(self, name):
+        return self.collection
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(indexes, "_registry", {})
+    monkeypatch.setattr(indexes, "INDEX_RECONCILE_INITIAL_DELAY_SECONDS", 0.001)
+    indexes.declare("things", [("id", 1)], unique=True)
+
+
+async def test_background_reconcile_retries_connection_errors():
+    db = FlakyDb([ServerSelectionTimeoutError("no servers"), AutoReconnect("reconnect")])
+    await indexes.start_background_reconcile(db)
+    assert db.collection.calls == 3
+
+
+async def test_operation_failure_is_logged_and_not_retried(caplog):
+    db = FlakyDb([OperationFailure("duplicate key")])
+    await indexes.start_background_reconcile(db)
+    assert db.collection.calls == 1
+    assert "Falha ao criar índices em things" in caplog.text
+
+
+async def test_ensure_indexes_creates_declared_indexes(db):
+    created = await indexes.ensure_indexes(db)
+    assert created == {"things": ["id_1"]}
+    assert "id_1" in await db.things.index_information()
@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+import pytest
+
+import loaders
+import realtime
+
+pytestmark = pytest.mark.anyio
+
+
+def _card(user_id: str, **fields) -> dict:
+    return {"id": user_id, "name": user_id.title(), **fields}
+
+
+def _count_finds(db, monkeypatch) -> list:
+    queries = []
+    collection_class = type(db.users)
+    find = collection_class.find
+
+    def counting_find(self, *args, **kwargs):
+        queries.append(args[0])
+        return find(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, "find", counting_find)
+    return queries
+
+
+async def test_loads_in_the_same_tick_share_one_in_query(db, monkeypatch):
+    await db.users.insert_many([_card(f"u{index}", password="x") for index in range(5)])
+    queries = _count_finds(db, monkeypatch)
+    loader = loaders.UserLoader(db)
+
+    users = await asyncio.gather(*[loader.load(f"u{index}") for index in (0, 1, 2, 1, 0, 9)])
+
+    assert [user and user["id"] for user in users] == ["u0", "u1", "u2", "u1", "u0", None]
+    assert "password" not in users[0]
+    assert queries == [{"id": {"$in": ["u0", "u1", "u2", "u9"]}}]
+    assert loader.stats() == {"requested": 6, "unique": 4, "deduplicated": 2, "cache_hits": 0, "queries": 1}
+
+
+async def test_repeated_ids_are_resolved_once_per_request(db, monkeypatch):
+    await db.users.insert_many([_card("ana"), _card("bia")])
+    queries = _count_finds(db, monkeypatch)
+    loader = loaders.UserLoader(db)
+
+    await loader.load_many(["ana", "bia"])
+    loaders.cards.clear()
+    users = await loader.load_many(["bia", "ana", "bia"])
+
+    assert users["ana"]["name"] == "Ana"
+    assert len(queries) == 1
+    assert loader.stats()["deduplicated"] == 3
+
+
+async def test_cache_hits_are_counted_and_skip_the_query(db, monkeypatch):
+    loaders.cards.put(_card("ana"))
+    await db.users.insert_one(_card("bia"))
+    queries = _count_finds(db, monkeypatch)
+    loader = loaders.UserLoader(db)
+
+    users = await loader.load_many(["ana", "bia"])
+
+    assert users["ana"]["name"] == "Ana"
+    assert queries == [{"id": {"$in": ["bia"]}}]
+    assert loader.stats() == {"requested": 2, "unique": 2, "deduplicated": 0, "cache_hits": 1, "queries": 1}
+
+
+async def test_failed_query_does_not_fail_cached_ids(db, monkeypatch):
+    loaders.cards.put(_card("ana"))
+
+    def failing_find(self, *args, **kwargs):
+        raise RuntimeError("mongo fora do ar")
+
+    monkeypatch.setattr(type(db.users), "find", failing_find)
+    loader = loaders.UserLoader(db)
+
+    cached, missing = loader.load("ana"), loader.load("bia")
+    await asyncio.sleep(0)
+
+    assert cached.result()["name"] == "Ana"
+    with pytest.raises(RuntimeError):
+        await missing
+    # O id que falhou pode ser buscado de novo na mesma requisição
+    assert "bia" not in loader._futures
+
+
+def test_card_cache_hit_rate():
+    cards = loaders.UserCardCache(max_users=10, ttl=60)
+    cards.put(_card("ana"))
+
+    assert cards.get_many(["ana", "bia"]) == ({"ana": _card("ana")}, ["bia"])
+    cards.get_many(["ana"])
+
+    assert cards.stats() == {"size": 1, "hits": 2, "misses": 1, "hit_rate": 0.6667, "invalidations": 0, "stale_puts": 0}
+    assert loaders.UserCardCache().stats()["hit_rate"] is None
+
+
+def test_card_cache_expires_after_ttl(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cards = loaders.UserCardCache(max_users=10, ttl=60)
+    cards.put(_card("ana"))
+
+    now += 60
+    assert cards.get_many(["ana"])[1] == []
+    now += 1
+    assert cards.get_many(["ana"]) == ({}, ["ana"])
+
+
+def test_card_cache_evicts_least_recently_used():
+    cards = loaders.UserCardCache(max_users=2, ttl=60)
+    cards.put(_card("ana"))
+    cards.put(_card("bia"))
+    # A leitura renova "ana"; "bia" passa a ser a menos usada
+    cards.get_many(["ana"])
+    cards.put(_card("caio"))
+
+    assert cards.get_many(["ana", "bia", "caio"])[1] == ["bia"]
+    assert cards.stats()["size"] == 2
+
+
+async def test_invalidation_reaches_every_worker(monkeypatch):
+    other_worker = loaders.UserCardCache()
+
+    class SharedPubSub(realtime.InProcessPubSub):
+        # Entrega cada mensagem a este worker e a um segundo worker
+        async def publish(self, message: dict):
+            await super().publish(message)
+            if message.get("topic") == loaders.TOPIC:
+                other_worker.invalidate(message["payload"]["user_id"])
+
+    monkeypatch.setattr(realtime, "pubsub", SharedPubSub())
+    await realtime.start()
+    try:
+        for cards in (loaders.cards, other_worker):
+            cards.put(_card("ana"))
+            cards.put(_card("bia"))
+
+        await loaders.invalidate_user_card("ana")
+    finally:
+        await realtime.stop()
+
+    for cards in (loaders.cards, other_worker):
+        assert cards.get_many(["ana", "bia"]) == ({"bia": _card("bia")}, ["ana"])
+        assert cards.stats()["invalidations"] == 1
+
+
+async def test_message_from_another_worker_invalidates_the_card():
+    loaders.cards.put(_card("ana"))
+
+    # Sem pubsub iniciado, a mensagem é entregue só a este processo
+    await realtime.broadcast(loaders.TOPIC, {"user_id": "ana"})
+
+    assert loaders.cards.get_many(["ana"]) == ({}, ["ana"])
+
+
+async def test_query_started_before_invalidation_does_not_refill_stale_card(db, monkeypatch):
+    await db.users.insert_one(_card("ana", location="Recife"))
+    collection_class = type(db.users)
+    find = collection_class.find
+
+    class RacingCursor:
+        def __init__(self, cursor):
+            self.cursor = cursor
+
+        async def to_list(self, length):
+            users = await self.cursor.to_list(length)
+            # A alteração e a invalidação chegam enquanto a consulta está em andamento
+            await db.users.update_one({"id": "ana"}, {"$set": {"location": "Olinda"}})
+            await loaders.invalidate_user_card("ana")
+            return users
+
+    monkeypatch.setattr(collection_class, "find", lambda self, *args, **kwargs: RacingCursor(find(self, *args, **kwargs)))
+    user = await loaders.UserLoader(db).load("ana")
+    assert user["location"] == "Recife"
+    assert loaders.cards.get_many(["ana"]) == ({}, ["ana"])
+    assert loaders.cards.stats()["stale_puts"] == 1
+
+    # A próxima requisição lê o valor novo e volta a preencher o cache
+    monkeypatch.setattr(collection_class, "find", find)
+    assert (await loaders.UserLoader(db).load("ana"))["location"] == "Olinda"
+    assert loaders.cards.get_many(["ana"])[0]["ana"]["location"] == "Olinda"
+
+
+def test_forgotten_invalidations_reject_older_refills():
+    cards = loaders.UserCardCache(max_users=2, ttl=60)
+    generation = cards.generation()
+    for user_id in ("ana", "bia", "caio"):
+        cards.invalidate(user_id)
+
+    # A invalidação de "ana" já saiu do registro, mas a consulta é anterior a ela
+    cards.put(_card("ana"), generation)
+    cards.put(_card("ana"), cards.generation())
+
+    assert cards.stats()["stale_puts"] == 1
+    assert cards.get_many(["ana"])[0] == {"ana": _card("ana")}
@@ -0,0 +1,83 @@
+import asyncio
+import io
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import derivatives
+import indexes
+from auth import get_current_active_user
+from models import Principal
+from routes import media, users
+from storage import LocalStorage, MediaStorage
+
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    backend = LocalStorage(root=tmp_path, base_url="/api/media", upload_url="/api/media/uploads/local", secret="test")
+    monkeypatch.setattr(media, "media_storage", MediaStorage(backend))
+
+    async def skip_derivatives(*args):
+        pass
+
+    monkeypatch.setattr(derivatives.processor, "process_user_image", skip_derivatives)
+    return backend
+
+
+@pytest.fixture
+def client(db, local):
+    asyncio.run(indexes.ensure_indexes(db))
+    # `avatar` presente: o mongomock ignora find_one_and_update com projeção de campo ausente
+    asyncio.run(db.users.insert_one({"id": "me", "name": "Me", "email": "me@example.com", "avatar": None}))
+    app = FastAPI()
+    app.include_router(media.router, prefix="/api")
+    app.include_router(users.router, prefix="/api")
+    app.dependency_overrides[AsyncIOMotorClient] = lambda: db
+    app.dependency_overrides[get_current_active_user] = lambda: Principal(id="me", name="Me")
+    return TestClient(app)
+
+
+def _presign(client, content_type: str = "image/png", size: int = 5, purpose: str = "avatar") -> dict:
+    response = client.post("/api/media/uploads", json={"purpose": purpose, "files": [{"content_type": content_type, "size": size}]})
+    assert response.status_code == 200
+    return response.json()["uploads"][0]
+
+
+def _send(client, target: dict, content: bytes = b"image"):
+    return client.post(target["url"], data=target["fields"], files={"file": ("photo.png", content, "image/png")})
+
+
+def test_presign_upload_and_commit_avatar(client, local, db):
+    target = _presign(client)
+    assert target["key"].startswith("users/me/avatar/") and target["key"].endswith(".png")
+
+    assert _send(client, target).status_code == 204
+    assert local.get(target["key"]) == b"image"
+
+    response = client.put("/api/users/me/avatar", json={"key": target["key"]})
+    assert response.status_code == 200
+    assert response.json() == {"avatar_url": f"/api/media/{target['key']}"}
+    assert asyncio.run(db.users.find_one({"id": "me"}))["avatar"] == f"/api/media/{target['key']}"
+    assert asyncio.run(db.media_blobs.find_one({"key": target["key"]}))["ref_count"] == 1
+
+
+def test_tampered_or_oversized_upload_is_rejected(client, local):
+    target = _presign(client, size=3)
+
+    assert _send(client, target).status_code == 400
+    tampered = {**target, "fields": {**target["fields"], "max_size": "1000"}}
+    assert _send(client, tampered).status_code == 403
+    assert local.exists(target["key"]) is None
+
+
+def test_commit_rejects_missing_foreign_and_non_image_objects(client, local):
+    assert client.put("/api/users/me/avatar", json={"key": "users/me/avatar/missing.png"}).status_code == 400
+    assert client.put("/api/users/me/avatar", json={"key": "users/other/avatar/a.png"}).status_code == 403
+
+    # Objeto na pasta do usuário que não é imagem
+    local.put("users/me/avatar/page.html", io.BytesIO(b"<script>"), "text/html")
+    response = client.put("/api/users/me/avatar", json={"key": "users/me/avatar/page.html"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "File must be an image"
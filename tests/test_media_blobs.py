@@ -0,0 +1,103 @@
+import io
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import BackgroundTasks
+from starlette.datastructures import Headers, UploadFile
+
+import indexes
+import media_blobs
+from routes import users
+from storage import MediaStorage
+
+pytestmark = pytest.mark.anyio
+
+
+class MemoryBackend:
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, key, body, content_type):
+        self.objects[key] = body.read()
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+    def url(self, key):
+        return f"https://cdn/{key}"
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    backend = MemoryBackend()
+    monkeypatch.setattr(media_blobs, "media_storage", MediaStorage(backend))
+    return backend
+
+
+def _upload(content: bytes) -> UploadFile:
+    return UploadFile(io.BytesIO(content), filename="photo.png", headers=Headers({"content-type": "image/png"}))
+
+
+async def test_sweep_expires_stuck_uploads_and_dedup_resumes(db, storage):
+    await indexes.ensure_indexes(db)
+    digest, size = media_blobs._digest(io.BytesIO(b"image"))
+    key = media_blobs.blob_key(digest, "image/png")
+    # Worker encerrado entre o insert e o envio
+    await db.media_blobs.insert_one({
+        "hash": digest, "key": key, "size": size, "ref_count": 1, "dedup_hits": 0,
+        "state": "uploading", "created_at": datetime.utcnow() - timedelta(hours=2)
+    })
+    storage.objects[key] = b"ima"
+
+    assert await media_blobs.sweep(db, stale_seconds=3600) == 1
+    assert await db.media_blobs.count_documents({}) == 0
+    assert key not in storage.objects
+
+    first = await media_blobs.store_upload(db, _upload(b"image"), "posts/me")
+    second = await media_blobs.store_upload(db, _upload(b"image"), "posts/me")
+    assert first == second == f"https://cdn/{key}"
+    blob = await db.media_blobs.find_one({"key": key})
+    assert blob["state"] == "active"
+    assert blob["ref_count"] == 2
+
+
+async def test_sweep_keeps_recent_uploads(db, storage):
+    await db.media_blobs.insert_one({
+        "hash": "abc", "key": "blobs/ab/abc.png", "ref_count": 1,
+        "state": "uploading", "created_at": datetime.utcnow()
+    })
+
+    assert await media_blobs.sweep(db, stale_seconds=3600) == 0
+    assert (await db.media_blobs.find_one({"key": "blobs/ab/abc.png"}))["state"] == "uploading"
+
+
+async def test_upload_expired_while_sending_falls_back_to_own_key(db, storage, monkeypatch):
+    await indexes.ensure_indexes(db)
+    put = MediaStorage.put
+
+    async def slow_put(self, key, body, content_type):
+        url = await put(self, key, body, content_type)
+        # A varredura expirou o registro enquanto o envio estava em andamento
+        await db.media_blobs.delete_one({"key": key})
+        return url
+
+    monkeypatch.setattr(MediaStorage, "put", slow_put)
+    url = await media_blobs.store_upload(db, _upload(b"slow"), "posts/me")
+
+    assert url.startswith("https://cdn/posts/me/")
+    blob = await db.media_blobs.find_one({"key": url[len("https://cdn/"):]})
+    assert blob["ref_count"] == 1
+    assert storage.objects[blob["key"]] == b"slow"
+
+
+async def test_setting_the_same_image_again_keeps_one_reference(db, storage):
+    await indexes.ensure_indexes(db)
+    await db.users.insert_one({"id": "me", "name": "Me", "avatar": "https://legacy/avatar.jpg"})
+
+    for _ in range(3):
+        url = await media_blobs.store_upload(db, _upload(b"avatar"), "users/me/avatar")
+        await users._set_profile_image(db, BackgroundTasks(), "me", "avatar", url)
+
+    blob = await db.media_blobs.find_one({"key": url[len("https://cdn/"):]})
+    assert blob["ref_count"] == 1
+    assert (await db.users.find_one({"id": "me"}))["avatar"] == url
@@ -0,0 +1,206 @@
+import asyncio
+import calendar
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import indexes
+import outbox
+import unread_counters
+from models import Notification, NotificationType
+
+pytestmark = pytest.mark.anyio
+
+# Início da janela de agrupamento atual (recente, para o TTL de notification_actors)
+_now = datetime.utcnow().replace(microsecond=0)
+POST_AT = _now - timedelta(seconds=calendar.timegm(_now.utctimetuple()) % outbox.NOTIFICATION_GROUP_WINDOW_SECONDS)
+
+
+@pytest.fixture(autouse=True)
+def counters(monkeypatch):
+    counters = unread_counters.UnreadCounters()
+    monkeypatch.setattr(unread_counters, "counters", counters)
+    return counters
+
+
+@pytest.fixture
+async def box(db, tmp_path):
+    await indexes.ensure_indexes(db)
+    box = outbox.NotificationOutbox(tmp_path, batch_size=10_000, interval=60)
+    box.db = db
+    return box
+
+
+def _like(sender: int, seconds: int = 0) -> dict:
+    return Notification(
+        recipient_id="author",
+        sender_id=f"user-{sender}",
+        type=NotificationType.POST_LIKE,
+        reference_id="post-1",
+        message=f"user-{sender} liked your post",
+        created_at=POST_AT + timedelta(seconds=seconds)
+    ).dict()
+
+
+async def test_hot_post_becomes_one_grouped_notification(db, box, counters):
+    # 2000 curtidas de 500 usuários (curtir, descurtir, curtir de novo), em lotes
+    events = [_like(index % 500, index) for index in range(2000)]
+    for start in range(0, len(events), 100):
+        for event in events[start:start + 100]:
+            box.emit(event)
+        await box.flush()
+
+    groups = await db.notifications.find({"recipient_id": "author"}).to_list(None)
+    assert len(groups) == 1
+    assert groups[0]["actor_count"] == 500
+    assert groups[0]["actor_ids"] == ["user-497", "user-498", "user-499"]
+    assert groups[0]["sender_id"] == "user-499"
+    assert await counters.get(db, "author") == 1
+    assert box.stats()["flushed"] == 2000
+
+
+async def test_replaying_a_written_batch_does_not_double_count(db, box, counters):
+    batch = [_like(index, index) for index in range(40)]
+    for event in batch:
+        box.emit(event)
+    await box.flush()
+
+    # Journal recuperado depois que o lote já tinha sido gravado
+    for event in batch:
+        box.emit(event)
+    await box.flush()
+
+    group = await db.notifications.find_one({"recipient_id": "author"})
+    assert group["actor_count"] == 40
+    assert await counters.get(db, "author") == 1
+
+
+async def test_concurrent_flushes_count_each_actor_once(db, tmp_path, counters):
+    await indexes.ensure_indexes(db)
+    workers = [outbox.NotificationOutbox(tmp_path / str(index), batch_size=10_000) for index in range(4)]
+    for index, worker in enumerate(workers):
+        worker.db = db
+        # Cada worker recebe metade dos usuários; metade deles também aparece em outro worker
+        for sender in range(index * 50, index * 50 + 100):
+            worker.emit(_like(sender, sender))
+
+    await asyncio.gather(*(worker.flush() for worker in workers))
+
+    group = await db.notifications.find_one({"recipient_id": "author"})
+    assert group["actor_count"] == 250
+    assert await db.notifications.count_documents({}) == 1
+
+
+async def test_new_time_window_starts_a_new_group(db, box):
+    box.emit(_like(1))
+    box.emit(_like(2, outbox.NOTIFICATION_GROUP_WINDOW_SECONDS))
+    await box.flush()
+
+    assert await db.notifications.count_documents({"recipient_id": "author"}) == 2
+    assert await db.notification_actors.count_documents({}) == 2
+
+
+def _crash(box: outbox.NotificationOutbox):
+    # Processo encerrado sem stop(): arquivos ficam no disco e o lock é solto
+    box._io.submit(lambda: None).result()
+    if box._journal is not None:
+        box._journal.close()
+    os.close(box._lock_fd)
+
+
+def _dead_pid() -> int:
+    pid = 4_000_000
+    while outbox._pid_alive(pid):
+        pid += 1
+    return pid
+
+
+async def _senders(db) -> set:
+    return set((await db.notification_actors.distinct("actor_id")))
+
+
+async def test_journal_and_flushing_segment_of_a_crashed_worker_are_replayed(db, tmp_path):
+    await indexes.ensure_indexes(db)
+    crashed = outbox.NotificationOutbox(tmp_path)
+    for sender in range(3):
+        crashed.emit(_like(sender, sender))
+    await crashed.sync_journal()
+    # Flush interrompido depois de virar segmento, antes de gravar no banco
+    await crashed._run_io(crashed._rotate, [])
+    for sender in range(3, 5):
+        crashed.emit(_like(sender, sender))
+    await crashed.sync_journal()
+    _crash(crashed)
+    assert sorted(path.suffix for path in tmp_path.iterdir()) == [".flushing", ".jsonl", ".lock"]
+
+    worker = outbox.NotificationOutbox(tmp_path, interval=60)
+    worker.start(db)
+    assert worker.stats()["pending"] == 5
+    await worker.stop()
+
+    assert await _senders(db) == {f"user-{sender}" for sender in range(5)}
+    assert list(tmp_path.iterdir()) == []
+
+
+async def test_journal_of_a_live_worker_with_the_same_pid_is_left_alone(db, tmp_path):
+    # Mesmo pid (aqui, o mesmo processo), outra inicialização ainda viva
+    alive = outbox.NotificationOutbox(tmp_path)
+    alive.emit(_like(1))
+    await alive.sync_journal()
+
+    worker = outbox.NotificationOutbox(tmp_path, interval=60)
+    worker.start(db)
+    assert worker.stats()["pending"] == 0
+    await worker.stop()
+    assert alive.journal_path.exists()
+
+    # Reinício do container: o pid se repete, mas o lock do dono anterior está livre
+    _crash(alive)
+    worker = outbox.NotificationOutbox(tmp_path, interval=60)
+    worker.start(db)
+    assert worker.stats()["pending"] == 1
+    await worker.stop()
+
+
+async def test_legacy_journals_of_dead_pids_are_replayed(db, tmp_path):
+    await indexes.ensure_indexes(db)
+    pid = _dead_pid()
+    (tmp_path / f"outbox-{pid}.jsonl").write_text(json.dumps(_like(1), default=str) + "\n")
+    (tmp_path / f"outbox-{pid}.3.flushing").write_text(json.dumps(_like(2), default=str) + "\n")
+    (tmp_path / f"outbox-{os.getppid()}.jsonl").write_text(json.dumps(_like(3), default=str) + "\n")
+
+    worker = outbox.NotificationOutbox(tmp_path, interval=60)
+    worker.start(db)
+    await worker.stop()
+
+    assert await _senders(db) == {"user-1", "user-2"}
+    assert [path.name for path in tmp_path.iterdir()] == [f"outbox-{os.getppid()}.jsonl"]
+
+
+async def test_emit_writes_the_journal_off_the_event_loop_in_batches(tmp_path, monkeypatch):
+    box = outbox.NotificationOutbox(tmp_path)
+    writes = []
+    append = box._append
+
+    def recording_append(notifications):
+        writes.append((threading.current_thread().name, len(notifications)))
+        append(notifications)
+
+    monkeypatch.setattr(box, "_append", recording_append)
+    for sender in range(100):
+        box.emit(_like(sender))
+    # Nada escrito durante os emits
+    assert writes == []
+
+    await box.sync_journal()
+    assert [(name.startswith("outbox-journal"), count) for name, count in writes] == [(True, 100)]
+    assert len(box.journal_path.read_text().splitlines()) == 100
+
+
+def test_grouped_message():
+    assert outbox.group_message(NotificationType.POST_LIKE, "Ana") == "Ana liked your post"
+    assert outbox.group_message(NotificationType.POST_LIKE, "Ana", 2) == "Ana and 1 other liked your post"
+    assert outbox.group_message(NotificationType.POST_LIKE, "Ana", 38) == "Ana and 37 others liked your post"
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import indexes
+import pagination
+
+BASE = datetime(2026, 1, 1)
+
+
+def _notifications(count: int, recipient_id: str = "me"):
+    # Várias notificações com a mesma data: o id desempata a ordem
+    return [
+        {
+            "id": f"n{index:05d}",
+            "recipient_id": recipient_id,
+            "sender_id": "other",
+            "type": "post_like",
+            "message": "liked your post",
+            "is_read": False,
+            "created_at": BASE + timedelta(minutes=index // 3),
+        }
+        for index in range(count)
+    ]
+
+
+def _walk(client, path: str, limit: int):
+    items, cursor = [], None
+    while True:
+        params = {"limit": limit}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get(path, params=params)
+        assert response.status_code == 200
+        items += response.json()
+        cursor = response.headers.get(pagination.NEXT_CURSOR_HEADER)
+        if not cursor:
+            return items
+
+
+def test_cursor_round_trip():
+    cursor = pagination.encode_cursor(BASE, "abc")
+    assert pagination.decode_cursor(cursor) == (BASE, "abc")
+
+
+def test_invalid_cursor_is_rejected():
+    with pytest.raises(HTTPException) as error:
+        pagination.decode_cursor("not-a-cursor")
+    assert error.value.status_code == 400
+
+
+def test_keyset_filter_is_a_range_on_the_sort_keys():
+    cursor = pagination.encode_cursor(BASE, "n1")
+    assert pagination.keyset_filter(cursor) == {
+        "$or": [{"created_at": {"$lt": BASE}}, {"created_at": BASE, "id": {"$lt": "n1"}}]
+    }
+    assert pagination.keyset_sort() == [("created_at", -1), ("id", -1)]
+
+
+def test_next_cursor_only_for_full_pages():
+    items = [{"id": "a", "created_at": BASE}, {"id": "b", "created_at": BASE}]
+    assert pagination.next_cursor(items, 3) is None
+    assert pagination.decode_cursor(pagination.next_cursor(items, 2)) == (BASE, "b")
+
+
+def test_cursor_pages_match_skip_pages(db, make_client):
+    asyncio.run(db.notifications.insert_many(_notifications(25)))
+    client = make_client("me")
+
+    by_cursor = _walk(client, "/api/notifications/", limit=4)
+    by_skip = []
+    for skip in range(0, 28, 4):
+        by_skip += client.get("/api/notifications/", params={"skip": skip, "limit": 4}).json()
+
+    assert len(by_cursor) == 25
+    assert [item["id"] for item in by_cursor] == [item["id"] for item in by_skip]
+    assert [item["id"] for item in by_cursor] == sorted((item["id"] for item in by_cursor), reverse=True)
+
+
+def test_users_paginate_oldest_first(db, make_client):
+    asyncio.run(db.users.insert_many([
+        {
+            "id": f"u{index:02d}",
+            "name": f"User {index}",
+            "email": f"u{index}@example.com",
+            "joined_date": BASE + timedelta(days=index // 2),
+            "privacy_settings": {"profile": "public"},
+        }
+        for index in range(9)
+    ]))
+    users = _walk(make_client("me"), "/api/users/", limit=2)
+    assert [user["id"] for user in users] == [f"u{index:02d}" for index in range(9)]
+
+
+def test_cursor_queries_have_matching_indexes():
+    import routes.notifications  # noqa: F401 (declara os índices)
+    import routes.posts  # noqa: F401
+    import routes.users  # noqa: F401
+
+    declared = {
+        (collection, tuple(model.document["key"].items()))
+        for collection, models in indexes.declared().items()
+        for model in models
+    }
+    assert ("notifications", (("recipient_id", 1), ("created_at", -1), ("id", -1))) in declared
+    assert ("posts", (("author_id", 1), ("created_at", -1), ("id", -1))) in declared
+    assert ("users", (("joined_date", 1), ("id", 1))) in declared
+
+
+@pytest.mark.benchmark
+@pytest.mark.anyio
+async def test_deep_page_latency_skip_vs_cursor(real_db):
+    await real_db.notifications.insert_many(_notifications(100_000))
+    await real_db.notifications.create_index([("recipient_id", 1), ("created_at", -1), ("id", -1)])
+    query = {"recipient_id": "me"}
+    depth, limit = 90_000, 20
+
+    last = (await real_db.notifications.find(query).sort(pagination.keyset_sort())
+            .skip(depth - 1).limit(1).to_list(1))[0]
+    cursor = pagination.encode_cursor(last["created_at"], last["id"])
+
+    started = time.perf_counter()
+    by_skip = await real_db.notifications.find(query).sort(pagination.keyset_sort()).skip(depth).limit(limit).to_list(limit)
+    skip_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    by_cursor = await real_db.notifications.find(pagination.paginate_query(query, cursor)).sort(
+        pagination.keyset_sort()).limit(limit).to_list(limit)
+    cursor_seconds = time.perf_counter() - started
+
+    print(f"\nskip={depth}: {skip_seconds * 1000:.1f} ms, cursor: {cursor_seconds * 1000:.1f} ms")
+    assert [item["id"] for item in by_cursor] == [item["id"] for item in by_skip]
+    assert cursor_seconds < skip_seconds
+
+
+def test_cursor_header_is_exposed_to_cross_origin_clients():
+    import server
+
+    response = TestClient(server.app).get("/api/", headers={"Origin": "https://app.example.com"})
+
+    assert pagination.NEXT_CURSOR_HEADER in response.headers["access-control-expose-headers"].split(",")
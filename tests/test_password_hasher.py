@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import HTTPException
+from passlib.hash import bcrypt
+
+import auth
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def hasher():
+    hasher = auth.PasswordHasher(workers=2, max_pending=2)
+    yield hasher
+    hasher.shutdown()
+
+
+def _rounds(hashed: str) -> int:
+    return int(hashed.split("$")[2])
+
+
+async def test_hash_runs_in_the_pool_with_configured_cost(hasher):
+    hashed = await hasher.hash("secret-password")
+    assert _rounds(hashed) == auth.BCRYPT_ROUNDS
+    assert await hasher.verify_and_update("secret-password", hashed) == (True, None)
+    assert (await hasher.verify_and_update("wrong-password", hashed))[0] is False
+
+
+async def test_saturated_pool_fails_fast_with_503(hasher):
+    results = await asyncio.gather(*(hasher.hash("secret-password") for _ in range(5)), return_exceptions=True)
+
+    rejected = [result for result in results if isinstance(result, HTTPException)]
+    assert len(rejected) == 3
+    assert all(error.status_code == 503 and error.headers["Retry-After"] for error in rejected)
+    assert hasher.stats()["rejected"] == 3
+    assert hasher.pending == 0
+
+
+async def test_login_upgrades_hashes_with_a_lower_cost(db, hasher, monkeypatch):
+    monkeypatch.setattr(auth, "password_hasher", hasher)
+    old_hash = bcrypt.using(rounds=4).hash("secret-password")
+    await db.users.insert_one({"id": "u1", "email": "u1@example.com", "password": old_hash})
+
+    assert await auth.authenticate_user(db, "u1@example.com", "wrong-password") is False
+    assert (await db.users.find_one({"id": "u1"}))["password"] == old_hash
+
+    assert (await auth.authenticate_user(db, "u1@example.com", "secret-password"))["id"] == "u1"
+    new_hash = (await db.users.find_one({"id": "u1"}))["password"]
+    assert _rounds(new_hash) == auth.BCRYPT_ROUNDS
+    assert auth.verify_password("secret-password", new_hash)
+
+
+async def _max_loop_lag(work, interval: float = 0.005) -> float:
+    lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal lag
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(lag, time.perf_counter() - started - interval)
+
+    task = asyncio.get_running_loop().create_task(ticker())
+    await asyncio.sleep(interval)
+    await work()
+    done = True
+    await task
+    return lag
+
+
+@pytest.mark.benchmark
+async def test_event_loop_lag_during_concurrent_logins():
+    hasher = auth.PasswordHasher(max_pending=64)
+    hashed = auth.get_password_hash("secret-password")
+
+    async def inline_logins():
+        # Comportamento anterior: bcrypt direto na corrotina
+        for _ in range(8):
+            auth.verify_and_update_password("secret-password", hashed)
+
+    async def pooled_logins():
+        await asyncio.gather(*(hasher.verify_and_update("secret-password", hashed) for _ in range(8)))
+
+    try:
+        await pooled_logins()  # aquecer o pool
+        inline_lag = await _max_loop_lag(inline_logins)
+        pooled_lag = await _max_loop_lag(pooled_logins)
+    finally:
+        hasher.shutdown()
+
+    print(f"\natraso máximo do event loop em 8 logins: inline {inline_lag * 1000:.0f} ms, pool {pooled_lag * 1000:.0f} ms")
+    assert pooled_lag < inline_lag / 4
@@ -0,0 +1,179 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import post_search
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2026, 1, 1)
+
+
+def _change(index: int, content: str, op: str = "upsert") -> dict:
+    if op == "delete":
+        return {"op": "delete", "id": f"p{index}"}
+    return {
+        "op": "upsert",
+        "id": f"p{index}",
+        "content": content,
+        "author_id": f"u{index % 7}",
+        "privacy": "public",
+        "created_at": post_search.timestamp(START + timedelta(minutes=index))
+    }
+
+
+def _ids(index: post_search.PostSearchIndex, query: str, before=None):
+    return [hit["id"] for hit in index.search(query, before)]
+
+
+async def _settle(index: post_search.PostSearchIndex):
+    if index._compact_task is not None:
+        await index._compact_task
+
+
+def test_posting_list_round_trip(monkeypatch):
+    monkeypatch.setattr(post_search, "POST_SEARCH_BLOCK_SIZE", 4)
+    docnos = np.array([0, 3, 300, 70_000, 70_001, 5_000_000_000, 5_000_000_002, 5_000_000_010, 5_000_000_011, 5_000_000_020])
+
+    appended = post_search.PostingList()
+    for docno in docnos.tolist():
+        appended.append(docno)
+    converted = post_search.PostingList.from_array(docnos)
+
+    assert appended.to_array().tolist() == converted.to_array().tolist() == docnos.tolist()
+    assert len(converted) == len(docnos)
+    assert [deltas.dtype for _, deltas in converted._blocks] == [np.uint32, np.uint64]
+
+
+async def test_search_matches_all_terms_newest_first_with_paging():
+    index = post_search.PostSearchIndex()
+    for i in range(10):
+        index.apply(_change(i, "café da manhã" if i % 2 else "café"))
+
+    assert _ids(index, "Cafe manha") == ["p9", "p7", "p5", "p3", "p1"]
+    assert _ids(index, "manhã", before=(post_search.timestamp(START + timedelta(minutes=5)), "p5")) == ["p3", "p1"]
+    assert _ids(index, "chá") == []
+
+
+async def test_compaction_renumbers_and_runs_off_the_apply_call():
+    index = post_search.PostSearchIndex()
+    for i in range(100):
+        index.apply(_change(i, f"word{i % 3} common"))
+    for i in range(0, 100, 2):
+        index.apply(_change(i, "", op="delete"))
+
+    # O apply só agenda a compactação
+    assert index.compactions == 0
+    await _settle(index)
+
+    assert index.compactions >= 1
+    assert len(index._post_ids) == index.stats()["posts"] == 50
+    assert index.dead == 0
+    assert _ids(index, "common") == [f"p{i}" for i in range(99, 0, -2)]
+    assert _ids(index, "word1 common") == [f"p{i}" for i in range(99, 0, -1) if i % 2 and i % 3 == 1]
+
+
+async def test_repeated_edits_keep_the_document_table_bounded():
+    index = post_search.PostSearchIndex()
+    for i in range(20):
+        index.apply(_change(i, "post"))
+    for edit in range(2000):
+        index.apply(_change(edit % 20, f"post edit{edit}"))
+        await asyncio.sleep(0)
+    await _settle(index)
+
+    assert len(index._post_ids) <= 20 / (1 - post_search.POST_SEARCH_COMPACT_RATIO) + 1
+    assert _ids(index, "edit1999") == ["p19"]
+    assert _ids(index, "edit0") == []
+    assert len(_ids(index, "post")) == 20
+
+
+async def test_changes_during_compaction_are_replayed():
+    index = post_search.PostSearchIndex()
+    for i in range(50):
+        index.apply(_change(i, f"alpha term{i}"))
+    for i in range(10):
+        index.remove(f"p{i}")
+
+    task = asyncio.create_task(index.compact(batch_size=1))
+    await asyncio.sleep(0)
+    assert index._pending is not None
+    index.apply(_change(20, "", op="delete"))
+    index.apply(_change(21, "beta"))
+    index.apply(_change(60, "alpha new"))
+    # Durante a compactação, a busca usa o índice atual
+    assert _ids(index, "alpha")[0] == "p60"
+    await task
+
+    assert index._pending is None
+    assert _ids(index, "alpha") == ["p60", *(f"p{i}" for i in range(49, 9, -1) if i not in (20, 21))]
+    assert _ids(index, "beta") == ["p21"]
+    assert _ids(index, "term20") == []
+
+
+async def test_search_started_before_a_compaction_stays_consistent():
+    index = post_search.PostSearchIndex()
+    for i in range(40):
+        index.apply(_change(i, "shared"))
+    for i in range(0, 40, 3):
+        index.remove(f"p{i}")
+
+    hits = index.search("shared")
+    first = next(hits)
+    await index.compact()
+    rest = [hit["id"] for hit in hits]
+
+    assert [first["id"], *rest] == [f"p{i}" for i in range(39, -1, -1) if i % 3]
+
+
+async def test_delete_published_during_build_is_not_resurrected(db):
+    await db.posts.insert_many([
+        {"id": f"p{i}", "content": "hello world", "author_id": "u", "privacy": "public", "created_at": START + timedelta(minutes=i)}
+        for i in range(30)
+    ])
+    index = post_search.PostSearchIndex()
+
+    build = asyncio.create_task(index.build(db, batch_size=1))
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert index._pending is not None
+    # Exclusão e edição publicadas antes de o post ser lido do banco
+    index.apply(_change(25, "", op="delete"))
+    index.apply(_change(26, "hello edited"))
+    index.apply(_change(40, "hello new"))
+    assert await build == 30
+
+    assert index.ready
+    hits = _ids(index, "hello")
+    assert "p25" not in hits
+    assert hits[0] == "p40"
+    assert _ids(index, "edited") == ["p26"]
+    assert _ids(index, "world")[:2] == ["p29", "p28"]
+    assert "p26" not in _ids(index, "world")
+
+
+@pytest.mark.benchmark
+async def test_search_and_compaction_benchmark():
+    rng = random.Random(7)
+    vocabulary = [f"w{i}" for i in range(5000)]
+    index = post_search.PostSearchIndex()
+    for i in range(200_000):
+        index.upsert(f"p{i}", " ".join(rng.choices(vocabulary, k=20)), "u", "public", i)
+
+    started = time.perf_counter()
+    for _ in range(100):
+        list(index.search("w1 w2"))
+    search_ms = 10 * (time.perf_counter() - started)
+
+    for i in range(0, 200_000, 3):
+        index.remove(f"p{i}")
+    started = time.perf_counter()
+    await index.compact()
+    compact_s = time.perf_counter() - started
+    print(f"\nbusca: {search_ms:.2f} ms; compactação de 200k posts: {compact_s:.2f} s, "
+          f"{index.stats()['postings_bytes'] / 1e6:.1f} MB em listas")
+    assert len(index._post_ids) == index.stats()["posts"]
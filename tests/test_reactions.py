@@ -0,0 +1,157 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import indexes
+import reactions
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def post(db):
+    await indexes.ensure_indexes(db)
+    await db.posts.insert_one({"id": "post", "author_id": "author", "like_count": 0})
+    return "post"
+
+
+async def _toggle(db, user_id: str, key=None):
+    return await reactions.toggle(db, "posts", reactions.POST, "post", user_id, key)
+
+
+async def _state(db):
+    stored = await db.posts.find_one({"id": "post"})
+    return stored["like_count"], await db.reactions.count_documents({"target_id": "post"})
+
+
+async def test_1000_concurrent_likes_on_one_post(db, post):
+    results = await asyncio.gather(*(_toggle(db, f"user{index}") for index in range(1000)))
+
+    assert all(result["liked"] and applied for result, applied in results)
+    # Cada chamada recebe o contador depois do próprio $inc
+    assert sorted(result["like_count"] for result, _ in results) == list(range(1, 1001))
+    assert await _state(db) == (1000, 1000)
+
+    await asyncio.gather(*(_toggle(db, f"user{index}") for index in range(1000)))
+    assert await _state(db) == (0, 0)
+
+
+async def test_concurrent_toggles_by_one_user_keep_count_consistent(db, post):
+    await asyncio.gather(*(_toggle(db, "user") for _ in range(101)))
+    like_count, stored_reactions = await _state(db)
+    assert like_count == stored_reactions
+    assert like_count in (0, 1)
+
+
+async def test_retries_with_same_idempotency_key_apply_once(db, post):
+    results = await asyncio.gather(*(_toggle(db, "user", "retry-key") for _ in range(20)))
+
+    assert sum(applied for _, applied in results) == 1
+    assert all(result == {"liked": True, "like_count": 1} for result, _ in results)
+    assert await _state(db) == (1, 1)
+
+
+async def _stale_request(db, liked: bool, key: str = "crashed"):
+    # Registro de uma chamada que caiu antes de gravar o resultado
+    now = datetime.utcnow()
+    await db.reaction_requests.insert_one({
+        "user_id": "user", "key": key, "target_id": "post", "liked": liked, "result": None,
+        "lease_until": now - timedelta(seconds=1), "created_at": now - timedelta(seconds=30)
+    })
+
+
+async def test_retry_takes_over_a_key_left_by_a_crashed_request(db, post):
+    await _stale_request(db, liked=True)
+
+    assert await _toggle(db, "user", "crashed") == ({"liked": True, "like_count": 1}, True)
+    assert await _toggle(db, "user", "crashed") == ({"liked": True, "like_count": 1}, False)
+    assert await _state(db) == (1, 1)
+
+
+async def test_takeover_does_not_toggle_again_after_the_reaction_was_written(db, post):
+    await _toggle(db, "user")
+    # A chamada caiu depois de descurtir, antes do $inc e do resultado
+    await reactions.remove(db, "post", "user")
+    await _stale_request(db, liked=False)
+
+    result, applied = await _toggle(db, "user", "crashed")
+
+    assert result["liked"] is False and not applied
+    assert await db.reactions.count_documents({"target_id": "post"}) == 0
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST) == 1
+    assert await _state(db) == (0, 0)
+
+
+async def test_key_held_by_a_live_request_is_not_taken_over(db, post):
+    await _stale_request(db, liked=True)
+    await db.reaction_requests.update_one({"key": "crashed"}, {"$set": {"lease_until": datetime.utcnow() + timedelta(minutes=1)}})
+
+    with pytest.raises(HTTPException) as error:
+        await _toggle(db, "user", "crashed")
+    assert error.value.status_code == 409
+    assert await _state(db) == (0, 0)
+
+
+async def test_failed_request_releases_its_key(db, post, monkeypatch):
+    bump = reactions._bump
+
+    async def failing_bump(*args):
+        monkeypatch.setattr(reactions, "_bump", bump)
+        raise RuntimeError("mongo fora do ar")
+
+    monkeypatch.setattr(reactions, "_bump", failing_bump)
+    with pytest.raises(RuntimeError):
+        await _toggle(db, "user", "key")
+
+    result, _ = await _toggle(db, "user", "key")
+    assert result["liked"] is True
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST) == 1
+    assert await _state(db) == (1, 1)
+
+
+async def test_reconcile_repairs_like_written_without_counter(db, post):
+    started = datetime.utcnow() - timedelta(seconds=1)
+    await _toggle(db, "a")
+    # Queda entre a reação e o $inc
+    await reactions.add(db, reactions.POST, "post", "b")
+
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST, since=started) == 1
+    assert await _state(db) == (2, 2)
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST, since=started) == 0
+
+
+async def test_full_reconcile_repairs_unlike_written_without_counter(db, post):
+    await _toggle(db, "a")
+    await reactions.remove(db, "post", "a")
+    assert await reactions.reconcile_like_counts(
+        db, "posts", reactions.POST, since=datetime.utcnow() + timedelta(seconds=1)
+    ) == 0
+
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST) == 1
+    assert await _state(db) == (0, 0)
+
+
+async def test_reconcile_skips_counter_changed_after_read(db, post, monkeypatch):
+    await reactions.add(db, reactions.POST, "post", "a")
+    collection_class = type(db.reactions)
+    aggregate = collection_class.aggregate
+
+    async def aggregate_then_like(self, *args, **kwargs):
+        # Um $inc chega entre a leitura do contador e a gravação da correção
+        await db.posts.update_one({"id": "post"}, {"$inc": {"like_count": 1}})
+        async for row in aggregate(self, *args, **kwargs):
+            yield row
+
+    monkeypatch.setattr(collection_class, "aggregate", aggregate_then_like)
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST) == 0
+    assert await _state(db) == (1, 1)
+
+
+async def test_legacy_likes_are_left_to_the_migration(db, post):
+    await db.posts.update_one({"id": "post"}, {"$set": {"likes": ["old"]}})
+    assert await reactions.reconcile_like_counts(db, "posts", reactions.POST) == 0
+
+    assert await reactions.migrate_likes(db, "posts", reactions.POST) == 1
+    assert await _state(db) == (1, 1)
@@ -0,0 +1,128 @@
+import asyncio
+import time
+import tracemalloc
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import loaders
+import realtime
+from models import Principal
+from routes import realtime as realtime_routes
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    registry = realtime.ConnectionRegistry(max_connections=20_000)
+    monkeypatch.setattr(realtime, "registry", registry)
+    return registry
+
+
+async def test_stream_registers_only_when_the_body_starts(registry):
+    body = realtime.stream("ana", lambda: False)
+    # Cliente saiu antes do início do corpo: nenhuma vaga ocupada
+    assert registry.count == 0
+    await body.aclose()
+    assert registry.count == 0
+
+    body = realtime.stream("ana", lambda: False)
+    assert await body.__anext__() == "retry: 5000\n\n"
+    assert registry.count == 1
+    await body.aclose()
+    assert registry.count == 0
+
+
+async def test_stream_ends_when_registry_filled_meanwhile(registry):
+    registry.max_connections = 0
+    body = realtime.stream("ana", lambda: False)
+
+    assert [chunk async for chunk in body] == ["retry: 30000\n\n"]
+    assert registry.count == 0
+
+
+def test_route_rejects_when_full(registry):
+    registry.max_connections = 0
+    app = FastAPI()
+    app.include_router(realtime_routes.router, prefix="/api")
+    app.dependency_overrides[realtime_routes.get_stream_user] = lambda: Principal(id="ana", name="Ana")
+
+    response = TestClient(app).get("/api/realtime/stream")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "30"
+
+
+async def test_loader_stats_middleware_passes_stream_through():
+    sent = []
+    release = asyncio.Event()
+
+    async def app(scope, receive, send):
+        scope["state"]["user_loader"] = loaders.UserLoader(None)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"retry: 5000\n\n", "more_body": True})
+        await release.wait()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def send(message):
+        sent.append(message)
+
+    middleware = loaders.UserLoaderStatsMiddleware(app)
+    task = asyncio.create_task(middleware({"type": "http", "state": {}}, None, send))
+    await asyncio.sleep(0)
+
+    # O primeiro pedaço chega ao servidor antes de o corpo terminar
+    assert [message["type"] for message in sent] == ["http.response.start", "http.response.body"]
+    assert dict(sent[0]["headers"])[b"x-user-loader-stats"].startswith(b"requested=0;")
+    release.set()
+    await task
+
+
+def test_server_has_no_buffering_http_middleware():
+    import server
+
+    assert not [middleware for middleware in server.app.user_middleware if middleware.cls is BaseHTTPMiddleware]
+
+
+async def test_ten_thousand_idle_connections(registry, monkeypatch):
+    monkeypatch.setattr(realtime, "REALTIME_HEARTBEAT_SECONDS", 0.2)
+    disconnected = False
+    received = {}
+
+    async def is_disconnected():
+        return disconnected
+
+    async def client(index: int):
+        chunks = received.setdefault(index, [])
+        async for chunk in realtime.stream(f"user-{index}", is_disconnected):
+            chunks.append(chunk)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    clients = [asyncio.create_task(client(index)) for index in range(10_000)]
+    while registry.count < 10_000:
+        await asyncio.sleep(0.01)
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / 10_000
+    tracemalloc.stop()
+
+    async def until(condition):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    try:
+        registry.deliver(["user-42"], {"type": "notifications"})
+        await asyncio.wait_for(until(lambda: any(chunk.startswith("event: notifications") for chunk in received[42])), 10)
+        assert not any(chunk.startswith("event:") for chunk in received[43])
+        # Conexões ociosas recebem o heartbeat
+        await asyncio.wait_for(until(lambda: ": ping\n\n" in received[9_999]), 10)
+    finally:
+        started = time.perf_counter()
+        disconnected = True
+        await asyncio.gather(*clients)
+    assert registry.count == 0
+    assert registry.stats()["users"] == 0
+    print(f"\n10k conexões ociosas: {per_connection / 1024:.1f} KiB por conexão, "
+          f"encerradas em {time.perf_counter() - started:.2f} s")
+    assert per_connection < 16 * 1024
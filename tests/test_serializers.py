@@ -0,0 +1,158 @@
+import time
+from datetime import datetime, timedelta
+
+import orjson
+import pytest
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import serializers
+from models import CommentOut, FeedPost, FriendCard, NotificationOut, NotificationType, PostDetail
+
+AT = datetime(2026, 3, 1, 12, 30, 15, 123000)
+
+
+def _author(user_id: str, **fields) -> dict:
+    return {
+        "id": user_id,
+        "name": user_id.title(),
+        "avatar": f"https://cdn/{user_id}.jpg",
+        "avatar_variants": {"thumb": f"https://cdn/{user_id}_thumb.webp"},
+        "location": "Recife",
+        **fields,
+    }
+
+
+def _post(index: int, author_id: str = "ana", comments: int = 3) -> dict:
+    return {
+        "id": f"p{index}",
+        "author_id": author_id,
+        "content": f"post {index} " + "lorem ipsum " * 20,
+        "media_urls": [f"https://cdn/p{index}.jpg"],
+        "media": [{"url": f"https://cdn/p{index}.jpg", "variants": {"feed": f"https://cdn/p{index}_feed.webp"}}],
+        "created_at": AT - timedelta(minutes=index),
+        "updated_at": AT,
+        "like_count": 10 + index,
+        "comment_count": comments,
+        "shares": 2,
+        "latest_comments": [
+            {"id": f"c{index}-{n}", "author_id": "bia" if n % 2 else "caio", "content": f"comment {n}", "created_at": AT + timedelta(seconds=n)}
+            for n in range(comments)
+        ],
+    }
+
+
+AUTHORS = {user_id: _author(user_id) for user_id in ("ana", "bia", "caio")}
+
+
+def test_feed_post_matches_the_response_model():
+    result = serializers.feed_post(_post(1), AUTHORS, {"p1"}, "feed")
+
+    assert FeedPost(**result).model_dump() == result
+    assert result["media_urls"] == ["https://cdn/p1_feed.webp"]
+    assert result["author"] == {"id": "ana", "name": "Ana", "avatar": "https://cdn/ana_thumb.webp", "is_verified": False}
+    assert result["is_liked"] is True
+    assert [preview["id"] for preview in result["latest_comments"]] == ["c1-0", "c1-1", "c1-2"]
+
+
+def test_feed_posts_skip_missing_authors_and_their_comments():
+    authors = {"ana": AUTHORS["ana"], "bia": AUTHORS["bia"]}
+    posts = [_post(1), _post(2, author_id="gone")]
+
+    result = serializers.feed_posts(posts, authors, set(), None)
+
+    assert [post["id"] for post in result] == ["p1"]
+    assert [preview["author"]["id"] for preview in result[0]["latest_comments"]] == ["bia"]
+    assert result[0]["media_urls"] == ["https://cdn/p1.jpg"]
+
+
+def test_post_detail_and_comments_match_the_response_models():
+    comments = [
+        {"id": "c1", "author_id": "bia", "content": "oi", "created_at": AT, "like_count": 1, "likes": ["x"]},
+        {"id": "c2", "author_id": "gone", "content": "tchau", "created_at": AT},
+    ]
+
+    result = serializers.post_detail(_post(1), comments, AUTHORS, {"c1"}, None)
+
+    assert PostDetail(**result).model_dump() == result
+    assert result["comments"] == [CommentOut(**result["comments"][0]).model_dump()]
+    assert result["comments"][0]["like_count"] == 2
+    assert result["comments"][0]["is_liked"] is True
+
+
+def test_grouped_notification_lists_recent_actors_once():
+    notification = {
+        "id": "n1",
+        "type": NotificationType.POST_LIKE,
+        "sender_id": "caio",
+        "message": "Caio liked your post",
+        "reference_id": "p1",
+        "created_at": AT,
+        "actor_count": 38,
+        "actor_ids": ["ana", "bia", "ana", "caio"],
+    }
+
+    result = serializers.notification(notification, AUTHORS)
+
+    assert NotificationOut(**result).model_dump() == result
+    assert result["message"] == "Caio and 37 others liked your post"
+    assert [actor["id"] for actor in result["actors"]] == ["caio", "ana", "bia"]
+    assert result["is_read"] is False
+
+
+def test_notification_from_deleted_sender():
+    notification = {"id": "n1", "type": "friend_request", "sender_id": "gone", "message": "Gone sent you a friend request", "created_at": AT}
+
+    result = serializers.notification(notification, AUTHORS)
+
+    assert result["sender"] is None
+    assert result["actors"] == []
+    assert result["message"] == "Gone sent you a friend request"
+
+
+def test_friend_card_extra_fields():
+    result = serializers.friend_card(AUTHORS["bia"], mutual_friends=3)
+
+    assert FriendCard(**result).model_dump() == {key: result[key] for key in FriendCard.model_fields}
+    assert result["mutual_friends"] == 3
+    assert result["location"] == "Recife"
+
+
+def test_json_response_encodes_like_the_model_and_keeps_route_headers():
+    response = Response()
+    response.headers["X-Next-Cursor"] = "abc"
+    content = serializers.feed_posts([_post(1)], AUTHORS, set(), None)
+
+    result = serializers.json_response(content, response)
+
+    assert result.headers["x-next-cursor"] == "abc"
+    assert int(result.headers["content-length"]) == len(result.body)
+    decoded = orjson.loads(result.body)
+    assert decoded == jsonable_encoder([FeedPost(**post) for post in content])
+    assert decoded[0]["created_at"] == "2026-03-01T12:29:15.123000"
+
+
+@pytest.mark.benchmark
+def test_feed_page_serialization_benchmark():
+    posts = [_post(index) for index in range(20)]
+    rounds = 500
+
+    def measure(render):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            render()
+        return 1000 * (time.perf_counter() - started) / rounds
+
+    # Antes: dicts montados na rota, validados pelo response_model e convertidos com jsonable_encoder
+    def generic():
+        page = [FeedPost(**post) for post in serializers.feed_posts(posts, AUTHORS, set(), "feed")]
+        return JSONResponse(jsonable_encoder(page)).body
+
+    def fast():
+        return serializers.json_response(serializers.feed_posts(posts, AUTHORS, set(), "feed")).body
+
+    assert orjson.loads(generic()) == orjson.loads(fast())
+    generic_ms, fast_ms = measure(generic), measure(fast)
+    print(f"\npágina do feed (20 posts): genérico {generic_ms:.2f} ms, orjson {fast_ms:.2f} ms ({generic_ms / fast_ms:.1f}x)")
+    assert fast_ms < generic_ms / 2
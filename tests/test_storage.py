@@ -0,0 +1,149 @@
+import asyncio
+import io
+import os
+import threading
+import time
+
+import pytest
+from fastapi import UploadFile
+from starlette.datastructures import Headers
+
+import storage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def local(tmp_path):
+    return storage.LocalStorage(root=tmp_path, base_url="/api/media/", secret="test")
+
+
+def _upload(content: bytes, filename: str = "photo.jpg") -> UploadFile:
+    return UploadFile(io.BytesIO(content), filename=filename, headers=Headers({"content-type": "image/jpeg"}))
+
+
+class SlowBackend:
+    """Backend em memória que demora em cada envio e registra a concorrência"""
+
+    def __init__(self, delay: float = 0.02, fail_keys=()):
+        self.delay = delay
+        self.fail_keys = set(fail_keys)
+        self.objects = {}
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def put(self, key, body, content_type):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if key in self.fail_keys:
+                raise OSError("falha no envio")
+            self.objects[key] = body.read()
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def url(self, key):
+        return f"https://cdn/{key}"
+
+
+def test_local_storage_round_trip(local, tmp_path):
+    local.put("posts/a.jpg", io.BytesIO(b"abc"), "image/jpeg")
+
+    assert local.get("posts/a.jpg") == b"abc"
+    assert local.exists("posts/a.jpg") == {"size": 3, "content_type": "image/jpeg"}
+    assert local.url("posts/a.jpg") == "/api/media/posts/a.jpg"
+    # Nenhum temporário deixado ao lado do arquivo
+    assert os.listdir(tmp_path / "posts") == ["a.jpg"]
+
+    local.delete("posts/a.jpg")
+    local.delete("posts/a.jpg")
+    assert local.exists("posts/a.jpg") is None
+
+
+def test_local_storage_rejects_keys_outside_the_root(local):
+    for key in ("../escape.jpg", "posts/../../escape.jpg", "/etc/passwd"):
+        with pytest.raises(ValueError):
+            local.path(key)
+
+
+def test_local_presign_is_bound_to_key_type_and_size(local):
+    target = local.presign_upload("posts/a.jpg", "image/jpeg", 1000, 60)
+    fields = target["fields"]
+    expires_at = int(fields["expires"])
+
+    assert fields["signature"] == local.sign("posts/a.jpg", "image/jpeg", 1000, expires_at)
+    assert fields["signature"] != local.sign("posts/b.jpg", "image/jpeg", 1000, expires_at)
+    assert fields["signature"] != local.sign("posts/a.jpg", "image/png", 1000, expires_at)
+    assert fields["signature"] != local.sign("posts/a.jpg", "image/jpeg", 10_000, expires_at)
+
+
+async def test_upload_many_keeps_order_and_limits_concurrency():
+    backend = SlowBackend()
+    media = storage.MediaStorage(backend, max_concurrency=3)
+
+    urls = await media.upload_many([_upload(bytes([index]) * 10, f"{index}.jpg") for index in range(10)], "posts")
+
+    assert [backend.objects[url[len("https://cdn/"):]] for url in urls] == [bytes([index]) * 10 for index in range(10)]
+    assert len(set(urls)) == 10 and all(url.startswith("https://cdn/posts/") and url.endswith(".jpg") for url in urls)
+    assert backend.max_active == 3
+    stats = media.stats()
+    assert (stats["uploads"], stats["failures"], stats["in_flight"], stats["bytes"]) == (10, 0, 0, 100)
+
+
+async def test_failed_upload_is_counted_and_raised():
+    backend = SlowBackend(delay=0, fail_keys={"posts/bad.jpg"})
+    media = storage.MediaStorage(backend)
+
+    with pytest.raises(OSError):
+        await media.put("posts/bad.jpg", io.BytesIO(b"x"), "image/jpeg")
+    assert media.stats()["failures"] == 1
+    assert media.stats()["in_flight"] == 0
+
+
+async def test_key_from_url(local):
+    media = storage.MediaStorage(local)
+    url = await media.put("avatars/a.jpg", io.BytesIO(b"x"), "image/jpeg")
+
+    assert media.key_from_url(url) == "avatars/a.jpg"
+    assert media.key_from_url("https://elsewhere/avatars/a.jpg") is None
+    assert media.key_from_url(None) is None
+
+
+@pytest.mark.benchmark
+async def test_upload_throughput_benchmark(tmp_path):
+    files, size = 64, 2 * 1024 * 1024
+    content = os.urandom(size)
+
+    async def measure(media):
+        # Atraso máximo do event loop durante os envios
+        lag = 0.0
+        done = False
+
+        async def ticker():
+            nonlocal lag
+            while not done:
+                started = time.perf_counter()
+                await asyncio.sleep(0.005)
+                lag = max(lag, time.perf_counter() - started - 0.005)
+
+        task = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        await media.upload_many([_upload(content, f"{index}.bin") for index in range(files)], "bench")
+        elapsed = time.perf_counter() - started
+        done = True
+        await task
+        return files * size / elapsed / 1e6, lag * 1000
+
+    local_mb_s, local_lag = await measure(storage.MediaStorage(storage.LocalStorage(root=tmp_path, secret="test")))
+    # Envio com latência de rede simulada: o paralelismo limitado é o que dá vazão
+    serial_mb_s, _ = await measure(storage.MediaStorage(SlowBackend(delay=0.05), max_concurrency=1))
+    parallel_mb_s, parallel_lag = await measure(storage.MediaStorage(SlowBackend(delay=0.05), max_concurrency=8))
+    print(f"\nlocal: {local_mb_s:.0f} MB/s (event loop até {local_lag:.1f} ms); "
+          f"latência simulada: serial {serial_mb_s:.0f} MB/s, 8 simultâneos {parallel_mb_s:.0f} MB/s "
+          f"(event loop até {parallel_lag:.1f} ms)")
+    assert parallel_mb_s > 4 * serial_mb_s
+    assert parallel_lag < 50
@@ -0,0 +1,109 @@
+import asyncio
+import itertools
+import time
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import suggestions
+
+
+def _random_graph(size: int, edges: int, seed: int = 7):
+    rng = np.random.default_rng(seed)
+    pairs = {tuple(sorted(pair)) for pair in rng.integers(0, size, (edges, 2)).tolist() if pair[0] != pair[1]}
+    return np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+
+def _brute_force(size: int, friend_pairs, excluded_pairs, top_k: int):
+    friends = {user: set() for user in range(size)}
+    for a, b in friend_pairs.tolist():
+        friends[a].add(b)
+        friends[b].add(a)
+    excluded = {user: set(friends[user]) | {user} for user in range(size)}
+    for a, b in excluded_pairs.tolist():
+        excluded[a].add(b)
+        excluded[b].add(a)
+
+    result = {}
+    for user in range(size):
+        counts = Counter(fof for friend in friends[user] for fof in friends[friend])
+        candidates = {candidate: count for candidate, count in counts.items() if candidate not in excluded[user]}
+        if candidates:
+            result[user] = candidates
+    return result
+
+
+def test_sparse_scores_match_brute_force_across_blocks(monkeypatch):
+    monkeypatch.setattr(suggestions, "SUGGESTIONS_BLOCK_ROWS", 17)
+    friend_pairs = _random_graph(120, 600)
+    excluded_pairs = _random_graph(120, 80, seed=11)
+
+    scores = suggestions.score_mutual_friends(120, friend_pairs, excluded_pairs, top_k=5)
+    expected = _brute_force(120, friend_pairs, excluded_pairs, top_k=5)
+
+    assert scores.keys() == expected.keys()
+    for user, candidates in expected.items():
+        assert scores[user] == suggestions._top_k(candidates.items(), 5)
+
+
+async def _seed(db, accepted, pending=()):
+    requests = [
+        {"id": f"{a}-{b}", "requester_id": a, "recipient_id": b, "status": "accepted"} for a, b in accepted
+    ] + [
+        {"id": f"{a}-{b}", "requester_id": a, "recipient_id": b, "status": "pending"} for a, b in pending
+    ]
+    await db.friend_requests.insert_many(requests)
+
+
+@pytest.mark.anyio
+async def test_batch_job_matches_incremental_refresh(db):
+    users = [f"u{index}" for index in range(12)]
+    accepted = [(a, b) for (i, a), (j, b) in itertools.combinations(enumerate(users), 2) if (i * 7 + j) % 3 == 0]
+    pending = [("u0", "u5"), ("u7", "u2")]
+    await _seed(db, accepted, pending)
+
+    assert await suggestions.build_all(db, top_k=4) == 12
+    batch = {
+        document["user_id"]: document["candidates"]
+        async for document in db.friend_suggestions.find({}, {"_id": 0})
+    }
+    for user_id in users:
+        incremental = await suggestions.refresh_user(db, user_id, top_k=4)
+        assert incremental == batch[user_id]
+
+
+@pytest.mark.anyio
+async def test_changed_friendships_mark_users_stale_and_refresh(db):
+    await _seed(db, [("a", "b"), ("b", "c")])
+    await suggestions.build_all(db)
+    assert (await db.friend_suggestions.find_one({"user_id": "a"}))["candidates"] == [{"id": "c", "mutual_friends": 1}]
+
+    # a e c viram amigos: nenhum dos dois deve mais sugerir o outro
+    await db.friend_requests.insert_one({"id": "a-c", "requester_id": "a", "recipient_id": "c", "status": "accepted"})
+    await suggestions.mark_stale(db, "a", "c")
+    import friend_graph
+    friend_graph.graph.invalidate("a", "b", "c")
+
+    assert await suggestions.refresh_stale(db) == 3
+    assert (await db.friend_suggestions.find_one({"user_id": "a"}))["candidates"] == []
+
+
+def test_endpoint_reads_the_stored_document(db, make_client):
+    asyncio.run(_seed(db, [("me", "f"), ("f", "x"), ("f", "y"), ("y", "me2")]))
+    asyncio.run(db.users.insert_many([{"id": user_id, "name": user_id.upper()} for user_id in ("x", "y")]))
+    asyncio.run(suggestions.build_all(db))
+
+    response = make_client("me").get("/api/friends/suggestions")
+    assert response.status_code == 200
+    assert [(card["id"], card["mutual_friends"]) for card in response.json()] == [("x", 1), ("y", 1)]
+
+
+@pytest.mark.benchmark
+def test_full_job_scales_to_100k_users():
+    friend_pairs = _random_graph(100_000, 1_000_000)
+    started = time.perf_counter()
+    scores = suggestions.score_mutual_friends(100_000, friend_pairs, np.empty((0, 2), dtype=np.int64), top_k=50)
+    elapsed = time.perf_counter() - started
+    print(f"\n100k usuários, {len(friend_pairs)} amizades: {elapsed:.1f}s, {len(scores)} com sugestões")
+    assert len(scores) > 90_000
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import pagination
+import timelines
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def small_window(monkeypatch):
+    monkeypatch.setattr(timelines, "TIMELINE_MAX_ENTRIES", 5)
+
+
+async def _post(db, index: int, author_id: str = "me") -> dict:
+    post = {
+        "id": f"p{index:03d}",
+        "author_id": author_id,
+        "content": "",
+        "privacy": "friends",
+        "created_at": datetime(2026, 1, 1) + timedelta(minutes=index),
+    }
+    await db.posts.insert_one(dict(post))
+    await timelines.fan_out_post(db, post)
+    return post
+
+
+async def _read_all(db, user_id: str, limit: int):
+    ids, cursor = [], None
+    while True:
+        entries = await timelines.read_timeline(db, user_id, limit=limit, cursor=cursor)
+        ids += [entry["post_id"] for entry in entries]
+        if len(entries) < limit:
+            return ids
+        last = entries[-1]
+        cursor = pagination.encode_cursor(last["created_at"], last["post_id"])
+
+
+async def test_full_window_is_marked_truncated(db):
+    await db.timelines.insert_one({"user_id": "me", "entries": []})
+    for index in range(5):
+        await _post(db, index)
+    assert not (await db.timelines.find_one({"user_id": "me"})).get("truncated")
+
+    await _post(db, 5)
+    timeline = await db.timelines.find_one({"user_id": "me"})
+    assert timeline["truncated"] is True
+    assert len(timeline["entries"]) == 5
+
+
+async def test_pagination_continues_after_retract_shrinks_truncated_window(db):
+    await db.timelines.insert_one({"user_id": "me", "entries": []})
+    posts = [await _post(db, index) for index in range(8)]
+
+    # Duas entradas saem da janela cheia: ela fica abaixo do limite
+    for post in posts[-2:]:
+        await db.posts.delete_one({"id": post["id"]})
+        await timelines.retract_post(db, post["id"])
+
+    ids = await _read_all(db, "me", limit=2)
+    assert ids == [post["id"] for post in reversed(posts[:-2])]
+
+
+async def test_short_untruncated_timeline_ends_without_legacy_query(db):
+    await db.timelines.insert_one({"user_id": "me", "entries": []})
+    posts = [await _post(db, index) for index in range(3)]
+    await timelines.retract_post(db, posts[0]["id"])
+
+    # O post retirado continua na coleção, mas não deve voltar pela consulta antiga
+    ids = await _read_all(db, "me", limit=2)
+    assert ids == ["p002", "p001"]
+
+
+async def test_rebuild_breaks_created_at_ties_by_id(db):
+    at = datetime(2026, 1, 1)
+    await db.posts.insert_many([
+        {"id": f"p{index}", "author_id": "me", "content": "", "privacy": "friends", "created_at": at}
+        for index in (3, 7, 1, 9, 5, 2, 8)
+    ])
+
+    entries = await timelines.rebuild_timeline(db, "me", [])
+
+    assert [entry["post_id"] for entry in entries] == ["p9", "p8", "p7", "p5", "p3"]
+    timeline = await db.timelines.find_one({"user_id": "me"})
+    assert [entry["post_id"] for entry in timeline["entries"]] == ["p9", "p8", "p7", "p5", "p3"]
+    assert timeline["truncated"] is True
+
+
+async def _during_rebuild(db, monkeypatch, action):
+    # Executa `action` logo depois de a reconstrução ler os posts
+    cursor_class = type(db.posts.find({}))
+    to_list = cursor_class.to_list
+
+    async def to_list_then_act(self, *args, **kwargs):
+        result = await to_list(self, *args, **kwargs)
+        monkeypatch.setattr(cursor_class, "to_list", to_list)
+        await action()
+        return result
+
+    monkeypatch.setattr(cursor_class, "to_list", to_list_then_act)
+
+
+async def test_rebuild_keeps_a_concurrent_fan_out(db, monkeypatch):
+    await db.timelines.insert_one({"user_id": "me", "entries": []})
+    await _post(db, 1)
+    await _during_rebuild(db, monkeypatch, lambda: _post(db, 2))
+
+    await timelines.rebuild_timeline(db, "me", [])
+
+    timeline = await db.timelines.find_one({"user_id": "me"})
+    assert [entry["post_id"] for entry in timeline["entries"]] == ["p002", "p001"]
+
+
+async def test_rebuild_does_not_bring_back_a_concurrently_deleted_post(db, monkeypatch):
+    posts = [await _post(db, index) for index in range(3)]
+    await db.timelines.delete_one({"user_id": "me"})
+
+    async def delete():
+        await db.posts.delete_one({"id": posts[1]["id"]})
+        await timelines.retract_post(db, posts[1]["id"])
+
+    await _during_rebuild(db, monkeypatch, delete)
+    await timelines.rebuild_timeline(db, "me", [])
+
+    timeline = await db.timelines.find_one({"user_id": "me"})
+    assert [entry["post_id"] for entry in timeline["entries"]] == ["p002", "p000"]
+
+
+async def test_rebuild_drops_former_friends_and_is_idempotent(db):
+    await db.timelines.insert_one({"user_id": "me", "entries": []})
+    await db.friend_requests.insert_one({"id": "f", "requester_id": "me", "recipient_id": "ana", "status": "accepted"})
+    await _post(db, 1, author_id="ana")
+    await _post(db, 2)
+
+    await timelines.rebuild_timeline(db, "me", [])
+    await timelines.rebuild_timeline(db, "me", [])
+
+    timeline = await db.timelines.find_one({"user_id": "me"})
+    assert [entry["post_id"] for entry in timeline["entries"]] == ["p002"]
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import unread_counters
+
+pytestmark = pytest.mark.anyio
+
+HOUR_AGO = datetime.utcnow() - timedelta(hours=1)
+LAST_WEEK = datetime.utcnow() - timedelta(days=7)
+
+
+@pytest.fixture
+def counters():
+    return unread_counters.UnreadCounters(ttl=0)
+
+
+async def _seed(db, user_id: str, unread: int, stored: int, at: datetime):
+    await db.notifications.insert_many([
+        {"id": f"{user_id}-{index}", "recipient_id": user_id, "is_read": index >= unread, "created_at": at}
+        for index in range(unread + 2)
+    ])
+    await db.notification_counters.insert_one({"user_id": user_id, "unread": stored, "updated_at": at})
+
+
+async def _stored(db, user_id: str) -> int:
+    return (await db.notification_counters.find_one({"user_id": user_id}))["unread"]
+
+
+async def test_incremental_reconcile_repairs_only_recent_users(db, counters):
+    await _seed(db, "recent", unread=2, stored=5, at=datetime.utcnow())
+    await _seed(db, "stale", unread=1, stored=4, at=LAST_WEEK)
+
+    assert await counters.reconcile(db, since=HOUR_AGO) == 1
+    assert await _stored(db, "recent") == 2
+    assert await _stored(db, "stale") == 4
+
+    assert await counters.reconcile(db) == 1
+    assert await _stored(db, "stale") == 1
+    assert await counters.get(db, "stale") == 1
+
+
+async def test_notification_without_increment_is_found_by_created_at(db, counters):
+    await _seed(db, "user", unread=1, stored=1, at=LAST_WEEK)
+    # O flush gravou a notificação, mas o incremento do contador falhou
+    await db.notifications.insert_one({"id": "new", "recipient_id": "user", "is_read": False, "created_at": datetime.utcnow()})
+
+    assert await counters.reconcile(db, since=HOUR_AGO) == 1
+    assert await _stored(db, "user") == 2
+
+
+async def test_missing_counter_is_created(db, counters):
+    await db.notifications.insert_one({"id": "n", "recipient_id": "new", "is_read": False, "created_at": datetime.utcnow()})
+
+    await counters.reconcile(db, since=HOUR_AGO)
+    assert await _stored(db, "new") == 1
+
+
+async def test_reconcile_does_not_overwrite_concurrent_increment(db, counters, monkeypatch):
+    await _seed(db, "user", unread=2, stored=5, at=datetime.utcnow())
+    collection_class = type(db.notifications)
+    aggregate = collection_class.aggregate
+
+    async def aggregate_then_increment(self, *args, **kwargs):
+        # Um grupo novo é gravado e contado entre a leitura do contador e a correção
+        await self.database.notifications.insert_one({"id": "late", "recipient_id": "user", "is_read": False, "created_at": datetime.utcnow()})
+        await counters.increment(self.database, {"user": 1})
+        async for row in aggregate(self, *args, **kwargs):
+            yield row
+
+    monkeypatch.setattr(collection_class, "aggregate", aggregate_then_increment)
+    assert await counters.reconcile(db, since=HOUR_AGO) == 0
+    assert await _stored(db, "user") == 6
+
+    # A próxima passada encontra o contador alterado e corrige
+    monkeypatch.setattr(collection_class, "aggregate", aggregate)
+    assert await counters.reconcile(db, since=HOUR_AGO) == 1
+    assert await _stored(db, "user") == 3
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+import indexes
+import user_search
+
+pytestmark = pytest.mark.anyio
+
+
+def _user(user_id: str, name: str, **fields) -> dict:
+    return {"id": user_id, "name": name, "email": f"{user_id}@example.com", **user_search.search_fields(name), **fields}
+
+
+async def _befriend(db, user_id: str, *friend_ids: str):
+    await db.friend_requests.insert_many([
+        {"id": f"{user_id}-{friend_id}", "requester_id": user_id, "recipient_id": friend_id, "status": "accepted"}
+        for friend_id in friend_ids
+    ])
+
+
+def test_normalize_strips_accents_and_repeats():
+    assert user_search.normalize("  Ána  MARIA ána ") == ["ana", "maria"]
+    assert user_search.search_fields("Dasilva")["search_trigrams"] == ["asi", "das", "ilv", "lva", "sil"]
+
+
+async def test_prefix_trigram_and_email_matches(db):
+    await db.users.insert_many([
+        _user("me", "Me"),
+        _user("a", "João Dasilva"),
+        _user("b", "Maria Silva"),
+        _user("c", "Pedro Souza"),
+    ])
+
+    assert {user["id"] for user in await user_search.search(db, "silva", "me")} == {"a", "b"}
+    assert [user["id"] for user in await user_search.search(db, "joao", "me")] == ["a"]
+    assert [user["id"] for user in await user_search.search(db, "c@example.com", "me")] == ["c"]
+    assert await user_search.search(db, "me@example.com", "me") == []
+
+
+async def test_friends_beyond_the_candidate_limit_come_first(db, monkeypatch):
+    monkeypatch.setattr(user_search, "SEARCH_CANDIDATES", 50)
+    # Muitos homônimos inseridos antes dos amigos: sem a busca por amigos eles ficariam de fora
+    await db.users.insert_many([_user(f"ana-{index:03}", "Ana Lima") for index in range(300)])
+    await db.users.insert_many([_user("me", "Me"), _user("friend", "Ana Souza"), _user("bridge", "Bruno")])
+    await _befriend(db, "me", "friend", "bridge")
+    await _befriend(db, "bridge", "ana-010")
+
+    users = await user_search.search(db, "ana", "me", limit=5)
+
+    # Amigo, amigo de amigo e os demais em ordem de nome
+    assert [user["id"] for user in users] == ["friend", "ana-010", "ana-000", "ana-001", "ana-002"]
+
+
+async def test_friend_found_by_trigram_after_the_prefix_pass(db, monkeypatch):
+    monkeypatch.setattr(user_search, "SEARCH_CANDIDATES", 10)
+    await db.users.insert_many([_user(f"other-{index}", f"Dasilva {index}") for index in range(30)])
+    await db.users.insert_many([_user("me", "Me"), _user("friend", "Carla Dasilva")])
+    await _befriend(db, "me", "friend")
+
+    users = await user_search.search(db, "silva", "me", limit=5)
+    assert users[0]["id"] == "friend"
+
+
+@pytest.mark.benchmark
+async def test_search_benchmark_million_users(real_db):
+    await indexes.ensure_indexes(real_db)
+    first_names = ["Ana", "Bruno", "Carla", "Diego", "Elisa", "Felipe", "Gabriela", "Hugo"]
+    last_names = ["Silva", "Souza", "Costa", "Lima", "Dasilva", "Oliveira", "Pereira", "Almeida"]
+    batch = []
+    for index in range(1_000_000):
+        batch.append(_user(f"u{index}", f"{first_names[index % 8]} {last_names[index // 8 % 8]} {index}"))
+        if len(batch) == 10_000:
+            await real_db.users.insert_many(batch)
+            batch = []
+    await _befriend(real_db, "u0", *(f"u{index}" for index in range(999_000, 1_000_000)))
+
+    for query in ("ana", "ana silva", "silva", "gabriela dasilva 99"):
+        started = time.perf_counter()
+        for _ in range(20):
+            users = await user_search.search(real_db, query, "u0")
+        elapsed = (time.perf_counter() - started) / 20
+        print(f"\n{query!r}: {1000 * elapsed:.1f} ms, primeiro: {users[0]['id'] if users else None}")
+        assert elapsed < 0.5
@@ -0,0 +1,69 @@
+import asyncio
+import io
+
+import derivatives
+import media_blobs
+from routes import media
+from storage import LocalStorage, MediaStorage
+
+
+def _user(**fields):
+    return {
+        "id": "me",
+        "name": "Me",
+        "email": "me@example.com",
+        "privacy_settings": {"profile": "public"},
+        **fields,
+    }
+
+
+def test_profile_update_ignores_unchanged_images(db, make_client):
+    asyncio.run(db.users.insert_one(_user(
+        avatar="https://cdn/avatar.jpg",
+        avatar_variants={"thumb": "https://cdn/avatar-thumb.webp"},
+    )))
+
+    # Cliente que reenvia o perfil inteiro, com a imagem atual
+    response = make_client("me").put("/api/users/me", json={"bio": "hello", "avatar": "https://cdn/avatar.jpg"})
+    assert response.status_code == 200
+
+    user = asyncio.run(db.users.find_one({"id": "me"}))
+    assert user["bio"] == "hello"
+    assert derivatives.avatar_thumb(user) == "https://cdn/avatar-thumb.webp"
+
+
+def test_profile_update_rejects_images_not_uploaded_by_the_user(db, make_client):
+    asyncio.run(db.users.insert_one(_user(avatar="https://cdn/avatar.jpg")))
+
+    response = make_client("me").put("/api/users/me", json={"bio": "hello", "cover_photo": "https://elsewhere/cover.jpg"})
+    assert response.status_code == 400
+
+    user = asyncio.run(db.users.find_one({"id": "me"}))
+    assert "bio" not in user
+    assert "cover_photo" not in user
+
+
+def test_profile_update_commits_a_direct_upload_like_the_avatar_route(db, make_client, tmp_path, monkeypatch):
+    backend = LocalStorage(root=tmp_path, base_url="https://cdn", secret="test")
+    monkeypatch.setattr(media, "media_storage", MediaStorage(backend))
+    monkeypatch.setattr(media_blobs, "media_storage", MediaStorage(backend))
+
+    async def skip_derivatives(*args):
+        pass
+
+    monkeypatch.setattr(derivatives.processor, "process_user_image", skip_derivatives)
+    asyncio.run(db.users.insert_one(_user(
+        avatar="https://cdn/users/me/avatar/old.png",
+        avatar_variants={"thumb": "https://cdn/users/me/avatar/old_thumb.webp"},
+    )))
+    asyncio.run(media_blobs.register_keys(db, ["users/me/avatar/old.png"]))
+    backend.put("users/me/avatar/new.png", io.BytesIO(b"image"), "image/png")
+
+    response = make_client("me").put("/api/users/me", json={"avatar": "https://cdn/users/me/avatar/new.png"})
+    assert response.status_code == 200
+    assert response.json()["avatar"] == "https://cdn/users/me/avatar/new.png"
+
+    user = asyncio.run(db.users.find_one({"id": "me"}))
+    assert "avatar_variants" not in user
+    blobs = {blob["key"]: blob["ref_count"] for blob in asyncio.run(db.media_blobs.find().to_list(None))}
+    assert blobs == {"users/me/avatar/old.png": 0, "users/me/avatar/new.png": 1}
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+import timelines
+from visibility import PostVisibility
+
+pytestmark = pytest.mark.anyio
+
+AT = datetime(2026, 1, 1)
+LEVELS = ("public", "friends", "private")
+# Leitor -> posts visíveis de cada autor
+EXPECTED = {
+    "me": {"me": LEVELS, "friend": ("public", "friends"), "stranger": ("public",)},
+    "friend": {"me": ("public", "friends"), "friend": LEVELS, "stranger": ("public",)},
+    "stranger": {"me": ("public",), "friend": ("public",), "stranger": LEVELS},
+}
+
+
+@pytest.fixture
+async def posts(db):
+    await db.friend_requests.insert_one({"id": "f", "requester_id": "me", "recipient_id": "friend", "status": "accepted"})
+    posts = [
+        {"id": f"{author_id}-{privacy}", "author_id": author_id, "privacy": privacy, "created_at": AT + timedelta(minutes=index)}
+        for index, (author_id, privacy) in enumerate((a, p) for a in ("me", "friend", "stranger") for p in LEVELS)
+    ]
+    await db.posts.insert_many([dict(post) for post in posts])
+    return posts
+
+
+def _expected(viewer_id: str):
+    return {f"{author_id}-{privacy}" for author_id, levels in EXPECTED[viewer_id].items() for privacy in levels}
+
+
+@pytest.mark.parametrize("viewer_id", list(EXPECTED))
+async def test_list_and_single_post_access_agree(db, posts, viewer_id):
+    visibility = PostVisibility(db, viewer_id)
+
+    listed = {post["id"] for post in await visibility.filter_visible(posts)}
+    single = set()
+    for post in posts:
+        try:
+            await visibility.require(post)
+            single.add(post["id"])
+        except HTTPException as error:
+            assert error.status_code == 403
+    queried = set(await db.posts.distinct("id", await visibility.mongo_filter()))
+    by_author = set(await db.posts.distinct("id", await visibility.mongo_filter(["me", "friend", "stranger"])))
+
+    assert listed == single == queried == by_author == _expected(viewer_id)
+
+
+async def test_mongo_filter_limited_to_some_authors(db, posts):
+    visibility = PostVisibility(db, "me")
+
+    assert set(await db.posts.distinct("id", await visibility.mongo_filter(["friend"]))) == {"friend-public", "friend-friends"}
+    assert await db.posts.distinct("id", await visibility.mongo_filter([])) == []
+
+
+async def test_legacy_feed_pages_use_the_same_rule(db, posts, monkeypatch):
+    # Páginas além da janela materializada vêm da consulta original
+    monkeypatch.setattr(timelines, "TIMELINE_MAX_ENTRIES", 2)
+
+    for viewer_id in EXPECTED:
+        entries = await timelines.read_timeline(db, viewer_id, limit=20)
+        assert {entry["post_id"] for entry in entries} == _expected(viewer_id)